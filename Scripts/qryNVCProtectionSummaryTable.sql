@@ -0,0 +1,75 @@
+/*
+
+	Materialized NVC protection summary table for the GAP analytic database.
+
+	Joins lu_boundary, lu_boundary_gap_landfire, gap_landfire and padus1_4
+	once and stores cell counts by PAD status, manager, NVC class, NVC group
+	and ecoregion in nvc_protection_summary. NVCSummarization.py and
+	ManagementSummary.py query this table instead of repeating the join.
+	PAD is LEFT joined so cells outside PAD-US keep a NULL status and group
+	totals can be taken from the same table.
+
+	The ecoregion is the lu_boundary.ecoregions_l4 value of each boundary.
+
+	This is the SQL Server version of usnvc/summarytable.py. The scripts
+	build the table themselves when it is missing or out of date (see
+	nvc_protection_summary_meta); this file is for rebuilding it by hand,
+	after which the scripts rebuild it once to record its parameters.
+
+*/
+
+
+USE GAP_AnalyticDB;
+GO
+
+
+IF OBJECT_ID('nvc_protection_summary', 'U') IS NOT NULL DROP TABLE nvc_protection_summary;
+GO
+
+CREATE TABLE nvc_protection_summary (
+	pad_status VARCHAR(2),
+	manage_name VARCHAR(255),
+	manage_type VARCHAR(255),
+	nvc_class VARCHAR(255),
+	nvc_group VARCHAR(255),
+	ecoregion VARCHAR(255),
+	n_cells BIGINT
+);
+GO
+
+INSERT INTO nvc_protection_summary (pad_status, manage_name, manage_type, nvc_class, nvc_group, ecoregion, n_cells)
+SELECT
+	padus1_4.gap_sts,
+	padus1_4.d_mang_nam,
+	padus1_4.d_mang_typ,
+	gap_landfire.nvc_class,
+	gap_landfire.nvc_group,
+	CAST(lu_boundary.ecoregions_l4 AS VARCHAR(255)),
+	sum(lu_boundary_gap_landfire.count)
+FROM	lu_boundary_gap_landfire
+	INNER JOIN gap_landfire
+	ON	lu_boundary_gap_landfire.gap_landfire = gap_landfire.value
+	INNER JOIN lu_boundary
+	ON	lu_boundary.value = lu_boundary_gap_landfire.boundary
+	LEFT JOIN padus1_4
+	ON	lu_boundary.padus1_4 = padus1_4.objectid
+GROUP BY
+	padus1_4.gap_sts,
+	padus1_4.d_mang_nam,
+	padus1_4.d_mang_typ,
+	gap_landfire.nvc_class,
+	gap_landfire.nvc_group,
+	lu_boundary.ecoregions_l4;
+GO
+
+CREATE INDEX ix_nvcps_group ON nvc_protection_summary (nvc_group, pad_status);
+GO
+
+CREATE INDEX ix_nvcps_class ON nvc_protection_summary (nvc_class, pad_status);
+GO
+
+CREATE INDEX ix_nvcps_manage ON nvc_protection_summary (manage_name, pad_status);
+GO
+
+CREATE INDEX ix_nvcps_eco ON nvc_protection_summary (ecoregion, pad_status);
+GO
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from usnvc.analysis import load_vat
+from usnvc.cube import CountCube
+from usnvc.lookups import natural_type
+from usnvc.outofcore import build_cube_out_of_core
+from usnvc.recode import TABLE_RULES
+from usnvc.synthetic import make_attribute_table
+
+
+def _cells(cube):
+    # Every cube cell as a sorted frame of labels, independent of code order
+    df = cube.rollup(cube.dims, dropna=False)
+    for d in cube.dims:
+        df[d] = df[d].astype(object).where(df[d].notna(), None).astype(str)
+    return df.sort_values(list(cube.dims)).reset_index(drop=True)
+
+
+def test_out_of_core_cube_matches_pandas(tmp_path):
+    df = make_attribute_table(30000, dupShare=0.05, seed=3)
+    rng = np.random.default_rng(3)
+    # Blanks in text and number columns, and rows repeated far apart
+    df.loc[rng.random(len(df)) < 0.02, 'MANG_NAME'] = np.nan
+    df.loc[rng.random(len(df)) < 0.02, 'US_L4CODE'] = np.nan
+    df = pd.concat([df, df.sample(2000, random_state=3)])
+    csvPath = str(tmp_path / 'attribute_table.csv')
+    df.to_csv(csvPath, index=False)
+
+    dfTable = load_vat(csvPath, str(tmp_path / 'vatcache'), rules=TABLE_RULES)
+    expect = CountCube.from_table(dfTable.assign(NaturalType=natural_type(dfTable['CLASS'])))
+    # 8 MB splits the ~7 MB CSV into 10 partitions read in 1000-row chunks
+    cube = build_cube_out_of_core(csvPath, memoryMB=8, workers=3, rules=TABLE_RULES,
+                                  addNaturalType=True, verbose=False)
+
+    assert sorted(cube.dims) == sorted(expect.dims)
+    assert cube.total() == expect.total()
+    pd.testing.assert_frame_equal(_cells(cube), _cells(expect)[_cells(cube).columns])
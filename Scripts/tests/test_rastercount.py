@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from usnvc.rastercount import check_alignment, combine_arrays, combine_rasters
+
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin  # noqa: E402
+
+NAMES = ('NVCGRP_LOOKUP2', 'PADUS2_1DISS6ATT', 'ECOREGIONS_L4')
+NODATA = (0, 65535, -1)
+DTYPES = ('uint8', 'uint16', 'int32')
+# 45 x 70 cells in 16-cell tiles: partial tiles along the bottom and right
+SHAPE = (45, 70)
+TILE = 16
+
+
+def _layers(seed=0):
+    rng = np.random.default_rng(seed)
+    layers = [rng.integers(1, 12, SHAPE), rng.integers(1, 40, SHAPE),
+              rng.integers(100, 106, SHAPE)]
+    for a, nd in zip(layers, NODATA):
+        a[rng.random(SHAPE) < 0.1] = nd
+    return [a.astype(dt) for a, dt in zip(layers, DTYPES)]
+
+
+def _write(path, a, nd, transform=from_origin(-1000000.0, 2000000.0, 30.0, 30.0)):
+    with rasterio.open(path, 'w', driver='GTiff', height=a.shape[0], width=a.shape[1],
+                       count=1, dtype=a.dtype, crs='EPSG:5070', transform=transform,
+                       nodata=nd) as dst:
+        dst.write(a, 1)
+    return path
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    layers = _layers()
+    paths = [_write(str(tmp_path / 'r{0}.tif'.format(i)), a, nd)
+             for i, (a, nd) in enumerate(zip(layers, NODATA))]
+    return paths, layers
+
+
+def _value_counts(layers):
+    valid = np.ones(SHAPE, dtype=bool)
+    for a, nd in zip(layers, NODATA):
+        valid &= a != nd
+    df = pd.DataFrame({n: a[valid].astype(np.int64) for n, a in zip(NAMES, layers)})
+    return df.value_counts().rename('COUNT').reset_index()
+
+
+def _key(dfVat):
+    return dfVat[list(NAMES) + ['COUNT']].sort_values(list(NAMES)).reset_index(drop=True)
+
+
+def test_combine_rasters_matches_arrays_and_value_counts(rasters):
+    paths, layers = rasters
+    dfVat = combine_rasters(paths, NAMES, tileSize=TILE)
+    dfArr = combine_arrays(layers, NAMES, nodata=list(NODATA), tileSize=TILE)
+    pd.testing.assert_frame_equal(dfVat, dfArr)
+    pd.testing.assert_frame_equal(_key(dfVat), _key(_value_counts(layers)),
+                                  check_dtype=False)
+    assert dfVat['COUNT'].sum() == _value_counts(layers)['COUNT'].sum()
+
+
+def test_tile_cache_gives_same_table(rasters, tmp_path):
+    paths, _ = rasters
+    expect = combine_rasters(paths, NAMES, tileSize=TILE)
+    cacheDir = str(tmp_path / 'tiles')
+    for _ in range(2):
+        pd.testing.assert_frame_equal(
+            combine_rasters(paths, NAMES, tileSize=TILE, tileCacheDir=cacheDir), expect)
+
+
+def test_check_alignment(rasters, tmp_path):
+    paths, layers = rasters
+    assert check_alignment(paths) == (SHAPE[0], SHAPE[1], [float(n) for n in NODATA])
+    shifted = _write(str(tmp_path / 'shifted.tif'), layers[0], NODATA[0],
+                     from_origin(-999970.0, 2000000.0, 30.0, 30.0))
+    with pytest.raises(ValueError):
+        check_alignment(paths[:2] + [shifted])
+
+
+def test_workers_match_serial(rasters):
+    paths, _ = rasters
+    serial = combine_rasters(paths, NAMES, tileSize=TILE, workers=1)
+    pd.testing.assert_frame_equal(combine_rasters(paths, NAMES, tileSize=TILE, workers=3),
+                                  serial)
+
+
+@pytest.mark.parametrize('mergeEvery', [1, 2, 5, 15, 16, 100])
+def test_merge_every_boundaries(rasters, mergeEvery):
+    # 3 x 5 = 15 windows: merges after every window, mid-way, exactly at
+    # the last window, and never
+    paths, _ = rasters
+    pd.testing.assert_frame_equal(
+        combine_rasters(paths, NAMES, tileSize=TILE, mergeEvery=mergeEvery),
+        combine_rasters(paths, NAMES, tileSize=TILE, mergeEvery=64))
+
+
+def test_checkpoint_resume(rasters, tmp_path, monkeypatch):
+    import usnvc.rastercount as rc
+
+    paths, _ = rasters
+    expect = combine_rasters(paths, NAMES, tileSize=TILE)
+    ckptDir = str(tmp_path / 'ckpt')
+    countTile = rc.count_tile
+    calls = []
+
+    def interrupted(*args, **kwargs):
+        if len(calls) == 6:
+            raise KeyboardInterrupt
+        calls.append(args[1])
+        return countTile(*args, **kwargs)
+
+    monkeypatch.setattr(rc, 'count_tile', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        combine_rasters(paths, NAMES, tileSize=TILE, checkpointDir=ckptDir, mergeEvery=4)
+    done = list(calls)
+
+    def counting(*args, **kwargs):
+        calls.append(args[1])
+        return countTile(*args, **kwargs)
+
+    calls.clear()
+    monkeypatch.setattr(rc, 'count_tile', counting)
+    resumed = combine_rasters(paths, NAMES, tileSize=TILE, checkpointDir=ckptDir, mergeEvery=4)
+    pd.testing.assert_frame_equal(resumed, expect)
+    assert len(calls) == 15 - len(done) and not set(calls) & set(done)
+
+    # A finished run is answered from the checkpoints alone
+    calls.clear()
+    pd.testing.assert_frame_equal(
+        combine_rasters(paths, NAMES, tileSize=TILE, checkpointDir=ckptDir), expect)
+    assert not calls
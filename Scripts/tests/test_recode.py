@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from usnvc.recode import (NATURAL_GROUP_RULES, NATURAL_TYPE_RULES, PLANTATION_RULES, PLOT_RULES,
+                          TABLE_RULES, apply_rules)
+from usnvc.synthetic import make_attribute_table
+
+
+@pytest.mark.parametrize('rules', [TABLE_RULES, TABLE_RULES + NATURAL_TYPE_RULES,
+                                   TABLE_RULES + PLANTATION_RULES + PLOT_RULES,
+                                   NATURAL_GROUP_RULES + PLOT_RULES])
+@pytest.mark.parametrize('categorical', [True, False])
+def test_composed_rules_match_row_masks(rules, categorical):
+    df = make_attribute_table(20000, seed=5)
+    # Blanks in the rule columns, and plain text columns as read from the CSV
+    df.loc[df.index[::7], 'GROUP'] = np.nan
+    df.loc[df.index[::11], 'CLASS'] = np.nan
+    if not categorical:
+        df = df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+
+    masked = apply_rules(df, rules)
+    composed = apply_rules(df, rules, counts=False)
+
+    pd.testing.assert_frame_equal(composed.frame, masked.frame)
+    assert composed.fired() == masked.fired()
+    assert composed.report['nRows'].isna().all()
@@ -0,0 +1,33 @@
+import pandas as pd
+
+from usnvc.streaming import iter_csv_chunks, stream_counts
+from usnvc.synthetic import make_attribute_table
+from usnvc.vatcache import VAT_COLUMNS
+
+
+def _mixed_dtype_csv(path, nRows=20000, nRepeat=3000, chunksize=1000):
+    # GAPST_CD has blanks in the first half only, and the repeated rows
+    # (appended at the end, whole chunks of them) have none, so the same
+    # row parses as float64 in one chunk and as int64 in another
+    df = make_attribute_table(nRows, dupShare=0, seed=1)
+    half = nRows // 2
+    status = df['GAPST_CD'].astype('Float64')
+    status.iloc[half:] = status.iloc[half:].fillna(4)
+    df['GAPST_CD'] = status.astype('Int64')
+    first = df.iloc[:half]
+    repeat = first[first['GAPST_CD'].notna()].sample(nRepeat, random_state=0)
+    assert nRepeat % chunksize == 0
+    pd.concat([df, repeat]).to_csv(path, index=False)
+
+
+def test_stream_dedupe_matches_drop_duplicates(tmp_path):
+    path = str(tmp_path / 'attribute_table.csv')
+    _mixed_dtype_csv(path)
+    chunks = list(iter_csv_chunks(path, chunksize=1000))
+    assert len({c['GAPST_CD'].dtype for c in chunks}) == 2
+
+    keys = ['GAPST_CD', 'CLASS']
+    dfStream = stream_counts(iter(chunks), keys, dedupe=True)
+    dfAll = pd.read_csv(path)[list(VAT_COLUMNS)].drop_duplicates()
+    dfExpect = dfAll.groupby(keys)['COUNT'].sum().reset_index()
+    pd.testing.assert_frame_equal(dfStream, dfExpect, check_dtype=False)
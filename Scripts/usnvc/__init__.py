@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        usnvc
+
+        Shared helpers for the USNVC protection analyses. The scripts in
+        this directory and the notebooks import from here instead of
+        re-implementing table loading and summaries.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+from .vatcache import VAT_COLUMNS, build_vat_cache, load_attribute_table
+from .cellarea import AREA_COL, AreaGrid
+from .cube import CUBE_DIMS, CountCube
+from .binning import (EDGES_30, EDGES_50, assign_bins, bin_labels, bin_protection,
+                      bin_protection_long, bin_protection_scenarios)
+from .thresholds import STATUS_SETS, ThresholdSweep, percent_protected, sweep, sweep_status_sets
+from .summarytable import (SUMMARY_TABLE, build_summary_table, ensure_summary_table,
+                           group_pivot_sql, management_sql)
+from .database import (AnalyticDB, DuckDBBackend, SQLiteBackend, SqlServerBackend,
+                       backend_from_url, copy_tables, get_db)
+from .protection import CELL_KM2, PAD_COLUMNS, add_protection_columns, pad_pivot
+from .streaming import (CountAccumulator, RowDeduper, iter_csv_chunks, iter_sql_chunks,
+                        stream_counts, stream_group_pivot)
+from .rastercount import (COMBINE_NAMES, combine_arrays, combine_rasters, count_arrays,
+                          count_tile, merge_counts, window_areas, TileCheckpoint)
+from .pipeline import Pipeline, Stage, protection_pipeline
+from .lookups import (ECO_CODE_LEVELS, GAP_STATUS_DTYPE, MANAGE_CATEGORIES, MANAGE_CAT_ORDER,
+                      NATURAL_CLASSES, NVC_CLASSES, Hierarchy, encode_table, manage_category,
+                      natural_type, relabel, strip_class_number, to_categorical)
+from .recode import (NATURAL_GROUP_RULES, NATURAL_TYPE_RULES, PLANTATION_RULES, PLOT_RULES,
+                     TABLE_RULES, RecodeResult, apply_rules, load_rules)
+from .synthetic import make_attribute_table
+from .profiling import RunProfiler, peak_rss_mb, reset_peak_rss, rss_mb, stage_peak_rss_mb
+from .analysis import (class_protection_bins, ecoregion_protection_breakdown,
+                       group_protection_pivot, load_vat, management_frame, query_group_pivot,
+                       query_management, summarize_by_manager)
+from .uncertainty import (ProtectionBootstrap, bootstrap_protection, confusion_from_accuracy,
+                          draw_class_probabilities, simulate_counts)
+from .partition import UNIT_COL, PartitionedTable
+from .tensor import TENSOR_DIMS, CountTensor
+from .outofcore import build_cube_out_of_core, csv_ranges, plan_partitions
+from .rollup import ROLLUP_TREES, RollupEngine, RollupSums, RollupTree, SparseRollupSums
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        analysis.py
+
+        The protection analyses as plain functions.
+
+        NVCSummarization.py, ManagementSummary.py and the notebook used to do
+        all of their work at import time. The steps are here instead, each
+        taking and returning frames, so they can be reused, batched and
+        timed one at a time:
+
+            load_vat                        attribute table with the recodes
+            query_group_pivot               group x PAD status from the DB
+            group_protection_pivot          PAD1 .. PAD4, km2 and % protected
+            class_protection_bins           groups per class in % bins
+            query_management                manager x status x class from the DB
+            management_frame                the same frame from a CountCube
+            summarize_by_manager            ManageCat x class km2 chart source
+            ecoregion_protection_breakdown  % PAD 1 & 2 / 3 / 4 by ecoregion
+
+        bin_protection is re-exported from usnvc.binning. Nothing here
+        imports a plotting package; the charts are in usnvc.plots.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from .binning import EDGES_50, bin_labels, bin_protection, bin_protection_long
+from .cellarea import AREA_COL
+from .cube import CountCube
+from .lookups import (CLASS_SHORT_NAMES, DB_NATURAL_CLASSES, PLOT_CLASS_ORDER,
+                      manage_category, relabel, strip_class_number)
+from .protection import CELL_KM2, add_protection_columns, pad_pivot
+from .recode import NATURAL_TYPE_RULES, TABLE_RULES, apply_rules
+from .summarytable import ECO_COLUMN
+from .tensor import CountTensor
+from .vatcache import VAT_COLUMNS, load_attribute_table
+
+
+__all__ = ['load_vat', 'query_group_pivot', 'group_protection_pivot', 'bin_protection',
+           'class_protection_bins', 'query_management', 'management_frame',
+           'summarize_by_manager',
+           'ecoregion_protection_breakdown']
+
+
+#############################################################################################
+###################################### LOADING ##############################################
+#############################################################################################
+
+
+def load_vat(csvPath, cacheDir=None, rules=TABLE_RULES, columns=VAT_COLUMNS, rebuild=False,
+             verbose=False):
+    '''
+    (str, str, list, list, bool, bool) -> DataFrame
+
+    Returns dfTable: the attribute table with the analysis columns, no
+    duplicate rows and the recode rules applied (by default the Great
+    Lakes Dune merges and the Upper Gila fix). Loads from the columnar
+    cache, building it on first use.
+
+    Arguments:
+    csvPath -- Path to attribute_table.csv
+    cacheDir -- Columnar cache folder, see usnvc.vatcache
+    rules -- Recode rules, see usnvc.recode; None or [] for none
+    columns -- Columns to keep
+    rebuild -- Rebuild the cache even if it is current
+    verbose -- Print which recode rules fired
+    '''
+    dfTable = load_attribute_table(csvPath, cacheDir, columns, rebuild=rebuild)
+    if rules:
+        dfTable = apply_rules(dfTable, list(rules), verbose=verbose, counts=False).frame
+    return dfTable
+
+
+def _summary_db(db, padTable, ecoColumn):
+    from .database import get_db
+    from .summarytable import ensure_summary_table
+    db = db or get_db()
+    with db.connection() as conn:
+        ensure_summary_table(conn, dialect=db.dialect, padTable=padTable, ecoColumn=ecoColumn)
+    return db
+
+
+def query_group_pivot(db=None, padTable='padus1_4', ecoColumn=ECO_COLUMN):
+    '''
+    (AnalyticDB, str, str) -> DataFrame
+
+    Returns the NVCClass, NVCGroup, nGroupTotalCells, PAD1 .. PAD3 frame
+    from the materialized summary table (built on first use, rebuilt when
+    padTable, ecoColumn or the source tables change).
+    '''
+    from .summarytable import group_pivot_sql
+    db = _summary_db(db, padTable, ecoColumn)
+    return db.query(group_pivot_sql())
+
+
+def query_management(db=None, padTable='padus1_4', ecoColumn=ECO_COLUMN):
+    '''
+    (AnalyticDB, str, str) -> DataFrame
+
+    Returns the PADStatus, ManageName, ManageType, NVCClass, nCells frame
+    from the materialized summary table (built on first use, rebuilt when
+    padTable, ecoColumn or the source tables change).
+    '''
+    from .summarytable import management_sql
+    db = _summary_db(db, padTable, ecoColumn)
+    return db.query(management_sql())
+
+
+#############################################################################################
+################################### GROUP PROTECTION ########################################
+#############################################################################################
+
+
+def group_protection_pivot(df, cellArea=CELL_KM2):
+    '''
+    (DataFrame, float) -> DataFrame
+
+    Returns one row per NVC group with PAD1 .. PAD4 cell counts, the
+    total, the km2 areas and the '% Protected 1 & 2' / '% Protected 1, 2 & 3'
+    columns.
+
+    Takes either the database frame of query_group_pivot (PAD4 is derived
+    as total - (1 + 2 + 3), as NVCSummarization.py does) or an attribute
+    table (the CLASS, GROUP, GROUP_CODE pivot of the notebook, with the
+    class number prefixes removed).
+    '''
+    if 'GAPST_CD' in df.columns:
+        dfSum = CountCube.from_table(df).rollup(['GAPST_CD', 'CLASS', 'GROUP', 'GROUP_CODE'])
+        dfSum['CLASS'] = strip_class_number(dfSum['CLASS']).astype(object)
+        dfPivot = pad_pivot(dfSum, ['CLASS', 'GROUP', 'GROUP_CODE'])
+    else:
+        dfPivot = df.copy()
+        dfPivot['PAD4'] = dfPivot['nGroupTotalCells'] - (dfPivot['PAD1'] + dfPivot['PAD2'] +
+                                                         dfPivot['PAD3'])
+    return add_protection_columns(dfPivot, cellArea)
+
+
+def class_protection_bins(dfPivot, classes=DB_NATURAL_CLASSES, by='NVCClass',
+                          value='% Protected 1 & 2', edges=EDGES_50, closed='open',
+                          catLabels=None):
+    '''
+    (DataFrame, list, str, str, list, str, list) -> DataFrame, DataFrame
+
+    Counts the groups of each class in percent-protected bins. Returns the
+    wide frame (LT1 .. GT50 and nGroups per class) and the long frame
+    (NVCClass, ProtCat, nGroups) used by the NVCSummarization.py charts.
+    closed='open' keeps that script's strict comparisons. catLabels name
+    the ProtCat values, bin_labels(edges) by default.
+    '''
+    dfClasses = dfPivot[dfPivot[by].isin(classes)]
+    dfProtBins = bin_protection(dfClasses, by=by, value=value, edges=edges, closed=closed,
+                                labels=bin_labels(edges, style='short'))
+    dfProtCats = bin_protection_long(dfClasses, by=by, value=value, edges=edges,
+                                     closed=closed, labels=catLabels or bin_labels(edges))
+    return dfProtBins, dfProtCats
+
+
+#############################################################################################
+##################################### MANAGEMENT ############################################
+#############################################################################################
+
+
+def _stage(prof, name, rowsIn=None):
+    # A RunProfiler stage, or a no-op when no profiler is given
+    return prof.stage(name, rowsIn) if prof is not None else contextlib.nullcontext(_NoRecord)
+
+
+class _NoRecord(object):
+    @staticmethod
+    def rows_out(obj):
+        pass
+
+
+def management_frame(cube):
+    '''
+    (CountCube or RollupSums) -> DataFrame
+
+    The cube's manager x status x class counts in the shape of the
+    database query summarize_by_manager takes (query_management), with
+    the summed km2 when the cube has cell areas. RollupSums over the
+    manager, nvc and status trees, or the SparseRollupSums of a scenario
+    (see usnvc.rollup), work the same.
+    '''
+    dfSum = cube.rollup(['GAPST_CD', 'MANG_NAME', 'MANG_TYPE', 'CLASS'])
+    dfMan = pd.DataFrame({'PADStatus': dfSum['GAPST_CD'], 'ManageName': dfSum['MANG_NAME'],
+                          'ManageType': dfSum['MANG_TYPE'], 'NVCClass': dfSum['CLASS'],
+                          'nCells': dfSum['COUNT']})
+    if AREA_COL in dfSum.columns:
+        dfMan['km2'] = dfSum[AREA_COL]
+    return dfMan
+
+
+def summarize_by_manager(df, classes=DB_NATURAL_CLASSES, cellArea=CELL_KM2, prof=None):
+    '''
+    (DataFrame, list, float, RunProfiler) -> DataFrame
+
+    Returns the ManagementSummary.py chart source: km2 'Protected' (GAP 1
+    & 2), 'Multiple Use' (GAP 3) and 'Total Area' per (ManageCat, class),
+    indexed by CatCls tuples in ManageCat then class order. Status pairs
+    missing from the data are 0.
+
+    Arguments:
+    df -- PADStatus, ManageName, NVCClass, nCells frame (query_management).
+        A km2 column of true areas is used instead of nCells * cellArea.
+    classes -- Classes to keep
+    cellArea -- Area of one cell in km2
+    prof -- Optional usnvc.profiling.RunProfiler timing each step
+    '''
+    with _stage(prof, 'class filter', df) as st:
+        dfNat = df[df['NVCClass'].isin(classes)]
+        sts = pd.to_numeric(dfNat['PADStatus'], errors='coerce').to_numpy()
+        keep = np.isin(sts, [1, 2, 3])
+        dfNat = dfNat[keep]
+        st.rows_out(dfNat)
+
+    with _stage(prof, 'km2 calc', dfNat) as st:
+        if 'km2' in dfNat.columns:
+            km2 = dfNat['km2'].to_numpy(dtype=np.float64)
+        else:
+            km2 = dfNat['nCells'].to_numpy() * cellArea
+        status = np.where(sts[keep] == 3, 'Multiple Use', 'Protected')
+        st.rows_out(km2)
+
+    with _stage(prof, 'ManageCat mapping', dfNat) as st:
+        dfNat = pd.DataFrame({
+            'ManageCat': manage_category(dfNat['ManageName']),
+            'NVCClass': relabel(strip_class_number(dfNat['NVCClass']), CLASS_SHORT_NAMES,
+                                categories=PLOT_CLASS_ORDER),
+            'Status': status,
+            'km2': km2})
+        st.rows_out(dfNat)
+
+    with _stage(prof, 'groupby', dfNat) as st:
+        dfSumKm = dfNat.groupby(['ManageCat', 'NVCClass', 'Status'], observed=True)['km2'].sum()
+        st.rows_out(dfSumKm)
+
+    with _stage(prof, 'pivot', dfSumKm) as st:
+        df4 = dfSumKm.unstack('Status', fill_value=0)
+        df4 = df4.reindex(columns=['Protected', 'Multiple Use'], fill_value=0)
+        st.rows_out(df4)
+
+    # Rows are already in ManageCat then class order from the ordered categoricals
+    with _stage(prof, 'sort', df4) as st:
+        dfSource = df4.sort_index()
+        dfSource.index = pd.Index([(str(c), str(n)) for c, n in dfSource.index], name='CatCls',
+                                  tupleize_cols=False)
+        dfSource.columns.name = None
+        dfSource['Total Area'] = dfSource['Protected'] + dfSource['Multiple Use']
+        st.rows_out(dfSource)
+    return dfSource
+
+
+#############################################################################################
+###################################### ECOREGIONS ###########################################
+#############################################################################################
+
+
+def ecoregion_protection_breakdown(data, eco='NA_L2NAME', rules=NATURAL_TYPE_RULES):
+    '''
+    (DataFrame or CountCube, str, list) -> DataFrame
+
+    Returns one row per ecoregion with the percent of its cells in
+    '% PAD 1 & 2', '% PAD 3', '% PAD 4 Converted' and
+    '% PAD 4 Not Converted' (the notebook's dfC). Cells without a GAP
+    status count as PAD 4. Percentages are of area when the cube carries
+    true cell areas, of cells otherwise.
+
+    Arguments:
+    data -- Attribute table, or a CountCube with a NaturalType dimension.
+        A table without NaturalType gets it from the rules first.
+    eco -- Ecoregion column, e.g. NA_L2NAME or US_L3NAME
+    rules -- Rules that add NaturalType (and drop Open Water)
+    '''
+    dims = [eco, 'GAPST_CD', 'NaturalType']
+    if isinstance(data, CountCube):
+        cube = data
+    else:
+        if 'NaturalType' not in data.columns:
+            data = apply_rules(data, list(rules), counts=False).frame
+        cube = CountCube.from_table(data, dims=dims)
+
+    # One (eco x status x type) array; dfC is its sums over status slots
+    return CountTensor.from_cube(cube, dims).breakdown(eco)
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        batch.py
+
+        Runs the protection summaries for many scenarios in one process.
+
+        A manifest (JSON, or YAML when PyYAML is installed) names the base
+        data and a list of scenarios. The base data is loaded and rolled up
+        into a CountCube once; the cube is saved as .npy files which every
+        worker memory-maps read-only, so the scenarios run in parallel on a
+        single shared copy. Each scenario slices the cube and writes its CSVs
+        (and charts when asked) to its own folder under outDir.
+
+            {"source": "attribute_table.csv",      (or "synthetic": 100000)
+             "cacheDir": "vatcache",
+             "outDir": "batch",
+             "workers": 4,
+             "defaults": {"statuses": [1, 2], "edges": [1, 17, 30]},
+             "scenarios": [
+                 {"name": "all"},
+                 {"name": "gap123", "statuses": [1, 2, 3]},
+                 {"name": "blm", "where": {"ManageCat": ["Bureau of Land Management"]}},
+                 {"name": "west", "where": {"NA_L2NAME": ["WESTERN CORDILLERA"]},
+                  "eco": "US_L3NAME", "edges": [1, 17, 50]}]}
+
+        For attribute tables larger than memory, "engine": "outofcore"
+        builds the base cube with usnvc.outofcore under "memoryMB" (default
+        2048), spilling to "spillDir" with "engineWorkers" processes (all
+        cores by default). The scenario outputs are the same.
+
+        Scenario keys (all but name are optional, defaults come from
+        "defaults" then DEFAULT_SCENARIO):
+
+            name        output folder name
+            where       {dimension: [labels]} rows to keep, any cube
+                        dimension plus ManageCat
+            exclude     {dimension: [labels]} rows to drop
+            statuses    GAP status codes counted as protected
+            edges       interior bin edges of the ecoregion bins
+            closed      bin closure, see usnvc.binning
+            eco         ecoregion column of the ecoregion outputs
+            outputs     any of OUTPUTS
+            charts      also draw the charts (needs matplotlib; bokeh for
+                        the management HTML), see usnvc.render
+            chartFormats  any of png, svg and html
+
+        Run from the Scripts folder:
+
+            python -m usnvc.batch manifest.json --workers 8
+
+        Timings and the throughput in scenarios per minute are printed and
+        saved to batch-run.json in outDir.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import re
+import sys
+import time
+import traceback
+
+import pandas as pd
+
+from .analysis import management_frame, summarize_by_manager
+from .binning import EDGES_30
+from .cube import CountCube
+from .lookups import NATURAL_CLASSES, manage_category, natural_type, strip_class_number
+from .protection import add_protection_columns, pad_pivot
+from .recode import TABLE_RULES, load_rules
+from .render import FORMATS, render_chart
+from .rollup import RollupEngine
+from .thresholds import percent_protected
+
+
+ENGINES = ('pandas', 'outofcore')
+
+OUTPUTS = ('group', 'groupEcoregion', 'macrogroupEcoregion', 'breakdown', 'management')
+
+DEFAULT_SCENARIO = {'where': None,
+                    'exclude': None,
+                    'statuses': [1, 2],
+                    'edges': list(EDGES_30),
+                    'closed': 'right',
+                    'eco': 'NA_L2NAME',
+                    'outputs': list(OUTPUTS),
+                    'charts': False,
+                    'chartFormats': ['png']}
+
+# The shared cube of a worker process, set by _init_worker
+_CUBE = None
+
+
+#############################################################################################
+###################################### MANIFEST #############################################
+#############################################################################################
+
+
+def load_manifest(path):
+    '''
+    (str) -> dict
+
+    Reads a batch manifest from a .json file or, when PyYAML is installed,
+    a .yaml/.yml file, and fills every scenario with the defaults. Raises
+    ValueError for a manifest without a source or with bad scenarios.
+    '''
+    with open(path) as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            import yaml
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+    return check_manifest(manifest)
+
+
+def check_manifest(manifest):
+    '''
+    (dict) -> dict
+
+    Returns a copy of the manifest with the scenario defaults applied.
+    Raises ValueError when it is not usable.
+    '''
+    manifest = dict(manifest)
+    if not manifest.get('source') and not manifest.get('synthetic'):
+        raise ValueError('Manifest needs a "source" attribute table or a "synthetic" size')
+    defaults = dict(DEFAULT_SCENARIO, **manifest.get('defaults', {}))
+
+    scenarios, seen = [], set()
+    for i, sc in enumerate(manifest.get('scenarios') or [{'name': 'all'}]):
+        sc = dict(defaults, **sc)
+        name = sc.get('name')
+        if not name:
+            raise ValueError('Scenario {0} has no name'.format(i))
+        if name in seen:
+            raise ValueError('Duplicate scenario name: {0}'.format(name))
+        seen.add(name)
+        unknown = set(sc['outputs']) - set(OUTPUTS)
+        if unknown:
+            raise ValueError('Scenario {0}: unknown outputs {1}'.format(name, sorted(unknown)))
+        scenarios.append(sc)
+    manifest['scenarios'] = scenarios
+    return manifest
+
+
+def folder_name(name):
+    '''
+    (str) -> str
+
+    Returns the scenario name with characters unsafe in file names
+    replaced by underscores.
+    '''
+    return re.sub(r'[^\w.-]+', '_', str(name)).strip('_') or 'scenario'
+
+
+#############################################################################################
+###################################### BASE DATA ############################################
+#############################################################################################
+
+
+def build_base_cube(manifest, verbose=True):
+    '''
+    (dict) -> CountCube
+
+    Loads the manifest's attribute table once (through the columnar cache
+    and the recode rules, see usnvc.analysis.load_vat), adds NaturalType
+    and returns the CountCube every scenario is answered from. With
+    "engine": "outofcore" the table is never loaded whole; see
+    usnvc.outofcore.
+    '''
+    if manifest.get('engine', 'pandas') not in ENGINES:
+        raise ValueError('Unknown engine {0!r}, expected one of {1}'.format(
+            manifest['engine'], ENGINES))
+    if manifest.get('engine') == 'outofcore' and not manifest.get('synthetic'):
+        from .outofcore import DEFAULT_MEMORY_MB, build_cube_out_of_core
+        rules = manifest.get('rules')
+        rules = load_rules(rules) if isinstance(rules, str) else (rules or TABLE_RULES)
+        return build_cube_out_of_core(manifest['source'],
+                                      memoryMB=manifest.get('memoryMB', DEFAULT_MEMORY_MB),
+                                      workers=manifest.get('engineWorkers'),
+                                      spillDir=manifest.get('spillDir'), rules=rules,
+                                      addNaturalType=True, verbose=verbose)
+    if manifest.get('synthetic'):
+        from .synthetic import make_attribute_table
+        dfTable = make_attribute_table(int(manifest['synthetic']),
+                                       seed=manifest.get('seed', 0)).drop_duplicates()
+    else:
+        from .analysis import load_vat
+        rules = manifest.get('rules')
+        rules = load_rules(rules) if isinstance(rules, str) else (rules or TABLE_RULES)
+        dfTable = load_vat(manifest['source'], manifest.get('cacheDir'), rules=rules,
+                           verbose=verbose)
+    dfTable = dfTable.assign(NaturalType=natural_type(dfTable['CLASS']))
+    return CountCube.from_table(dfTable)
+
+
+def _filters(cube, filters):
+    # ManageCat is not a cube dimension; select its managers instead
+    if not filters:
+        return None
+    filters = dict(filters)
+    if 'ManageCat' in filters:
+        cats = filters.pop('ManageCat')
+        cats = [cats] if isinstance(cats, str) else list(cats)
+        names = cube.labels['MANG_NAME']
+        hit = manage_category(pd.Series(names)).isin(cats).to_numpy()
+        filters['MANG_NAME'] = list(names[hit]) + filters.get('MANG_NAME', [])
+    unknown = set(filters) - set(cube.dims)
+    if unknown:
+        raise KeyError('Not cube dimensions: {0}'.format(sorted(unknown)))
+    return filters
+
+
+#############################################################################################
+###################################### SCENARIOS ############################################
+#############################################################################################
+
+
+def status_label(statuses):
+    '''
+    (list) -> str
+
+    Returns the percent column suffix of a status set, '1 & 2' for
+    [1, 2] and '1, 2 & 3' for [1, 2, 3] as in add_protection_columns.
+    '''
+    sts = [str(s) for s in statuses]
+    return sts[0] if len(sts) == 1 else ', '.join(sts[:-1]) + ' & ' + sts[-1]
+
+
+def _protection_pivot(cube, keys, statuses, value, where=None, exclude=None):
+    # cube is a CountCube or the RollupSums of a scenario
+    dfSum = cube.rollup(['GAPST_CD'] + keys, where=where, exclude=exclude)
+    if 'CLASS' in keys:
+        dfSum['CLASS'] = strip_class_number(dfSum['CLASS'])
+    dfPivot = add_protection_columns(pad_pivot(dfSum, keys))
+    if value not in dfPivot.columns:
+        dfPivot[value] = percent_protected(dfPivot, statuses)
+    return dfPivot
+
+
+def run_scenario(cube, scenario, outDir, engine=None):
+    '''
+    (CountCube, dict, str, RollupEngine) -> dict
+
+    Runs one scenario on the base cube and writes its outputs to
+    outDir/<name>. Returns the scenario record: name, folder, seconds,
+    cube rows and the files written.
+
+    The scenario's cube rows are summed once over the NVC, ecoregion,
+    manager and status paths (sparse, present combinations only), and
+    every output, the management summary included, is a roll-up of those
+    sums, see usnvc.rollup. engine is the base cube's RollupEngine, built
+    here when not given.
+
+    Outputs:
+    group -- GroupPercentProtected.csv, PAD pivot of every NVC group
+    groupEcoregion -- GroupPercentProtectedbyEcoregion.csv, natural
+        non-Ruderal groups per ecoregion in each percent bin
+    macrogroupEcoregion -- MacrogroupPercentProtectedbyEcoregion.csv, the
+        same for macrogroups
+    breakdown -- EcoregionProtectionBreakdown.csv, % PAD 1 & 2 / 3 / 4
+        Converted / 4 Not Converted by ecoregion
+    management -- ManagementSummary.csv, ManageCat x class km2
+    '''
+    t0 = time.perf_counter()
+    where, exclude = _filters(cube, scenario['where']), _filters(cube, scenario['exclude'])
+    folder = os.path.join(outDir, folder_name(scenario['name']))
+    os.makedirs(folder, exist_ok=True)
+    written = []
+
+    def out(fileName):
+        written.append(os.path.join(folder, fileName))
+        return written[-1]
+
+    engine = engine or RollupEngine.from_cube(cube)
+    mask = engine.mask(where, exclude)
+    sums = engine.aggregate(['nvc', 'eco', 'manager', 'status'], mask=mask, sparse=True)
+    outputs, eco = scenario['outputs'], scenario['eco']
+    charts = scenario['chartFormats'] if scenario['charts'] else []
+
+    def chart(kind, df, fileName, **options):
+        # Drawn with this process's figure template, see usnvc.render
+        if charts:
+            written.extend(render_chart(kind, df, os.path.join(folder, fileName), charts,
+                                        **options))
+    statuses = [int(s) for s in scenario['statuses']]
+    value = '% Protected ' + status_label(statuses)
+
+    if 'group' in outputs:
+        dfGroup = _protection_pivot(sums, ['CLASS', 'GROUP', 'GROUP_CODE'], statuses, value)
+        dfGroup.to_csv(out('GroupPercentProtected.csv'), index=False)
+        chart('class_boxplot', dfGroup, 'GroupPercentProtected')
+
+    ruderal = [g for g in cube.labels['GROUP'] if 'Ruderal' in str(g)]
+    for key, level, fileName in (('groupEcoregion', 'GROUP', 'GroupPercentProtectedbyEcoregion'),
+                                 ('macrogroupEcoregion', 'MACROGROUP',
+                                  'MacrogroupPercentProtectedbyEcoregion')):
+        if key not in outputs:
+            continue
+        tensor = sums.tensor([eco, level, 'GAPST_CD'], where={'CLASS': list(NATURAL_CLASSES)},
+                             exclude={'GROUP': ruderal})
+        dfBins = tensor.bin_counts(eco, level, statuses, scenario['edges'], scenario['closed'])
+        dfBins = dfBins.sort_index()
+        dfBins.to_csv(out(fileName + '.csv'))
+        chart('ecoregion_bins', dfBins, fileName,
+              xlabel='Number of Groups' if level == 'GROUP' else 'Number of Macrogroups')
+
+    if 'breakdown' in outputs:
+        dfC = sums.tensor([eco, 'GAPST_CD', 'NaturalType']).breakdown(eco)
+        dfC.to_csv(out('EcoregionProtectionBreakdown.csv'))
+        chart('ecoregion_breakdown', dfC, 'EcoregionProtectionBreakdown')
+
+    if 'management' in outputs:
+        dfMan = management_frame(sums)
+        dfSource = summarize_by_manager(dfMan, classes=NATURAL_CLASSES)
+        dfSource.to_csv(out('ManagementSummary.csv'))
+        chart('management', dfSource, 'ManagementSummary')
+
+    return {'name': scenario['name'], 'folder': folder, 'cubeRows': sums.nRows,
+            'seconds': round(time.perf_counter() - t0, 4), 'files': written}
+
+
+def _init_worker(cubeDir):
+    global _CUBE, _ENGINE
+    _CUBE = CountCube.load(cubeDir, mmapMode='r')
+    _ENGINE = RollupEngine.from_cube(_CUBE)
+
+
+def _run_in_worker(scenario, outDir):
+    return run_scenario(_CUBE, scenario, outDir, _ENGINE)
+
+
+#############################################################################################
+######################################## BATCH ##############################################
+#############################################################################################
+
+
+def run_batch(manifest, outDir=None, workers=None, only=None, verbose=True):
+    '''
+    (dict, str, int, list, bool) -> dict
+
+    Loads the base cube once and runs every scenario of a checked manifest
+    (see check_manifest) over a process pool. A failing scenario is
+    recorded with its traceback and does not stop the others. Returns the
+    run record, which is also written to outDir/batch-run.json.
+
+    Arguments:
+    manifest -- Manifest dict
+    outDir -- Output folder, overrides the manifest's outDir
+    workers -- Worker processes, overrides the manifest's; 1 runs the
+        scenarios in this process
+    only -- Names of the scenarios to run, all by default
+    verbose -- Print progress
+    '''
+    outDir = outDir or manifest.get('outDir') or 'batch'
+    workers = int(workers or manifest.get('workers') or os.cpu_count() or 1)
+    scenarios = [sc for sc in manifest['scenarios'] if not only or sc['name'] in only]
+    os.makedirs(outDir, exist_ok=True)
+
+    t0 = time.perf_counter()
+    cube = build_base_cube(manifest, verbose=verbose)
+    loadSeconds = time.perf_counter() - t0
+    if verbose:
+        print('Base data: {0!r} in {1:.1f} s'.format(cube, loadSeconds))
+
+    records = []
+
+    def done(rec):
+        records.append(rec)
+        if verbose:
+            state = 'FAILED' if rec.get('error') else '{0:.2f} s'.format(rec['seconds'])
+            print('  [{0}/{1}] {2}: {3}'.format(len(records), len(scenarios), rec['name'], state))
+
+    t1 = time.perf_counter()
+    workers = min(workers, len(scenarios)) or 1
+    if workers == 1:
+        engine = RollupEngine.from_cube(cube)
+        for sc in scenarios:
+            try:
+                done(run_scenario(cube, sc, outDir, engine))
+            except Exception:
+                done({'name': sc['name'], 'error': traceback.format_exc()})
+    else:
+        cubeDir = cube.save(manifest.get('cubeDir') or os.path.join(outDir, '.cube'))
+        del cube
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                    initargs=(cubeDir,)) as pool:
+            futures = {pool.submit(_run_in_worker, sc, outDir): sc for sc in scenarios}
+            for fut in concurrent.futures.as_completed(futures):
+                try:
+                    done(fut.result())
+                except Exception:
+                    done({'name': futures[fut]['name'], 'error': traceback.format_exc()})
+    runSeconds = time.perf_counter() - t1
+
+    order = [sc['name'] for sc in scenarios]
+    records.sort(key=lambda r: order.index(r['name']))
+    run = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+           'workers': workers,
+           'scenarios': len(scenarios),
+           'failed': sum(1 for r in records if r.get('error')),
+           'loadSeconds': round(loadSeconds, 3),
+           'runSeconds': round(runSeconds, 3),
+           'scenariosPerMinute': round(len(scenarios) / runSeconds * 60, 2) if runSeconds else None,
+           'results': records}
+    with open(os.path.join(outDir, 'batch-run.json'), 'w') as f:
+        json.dump(run, f, indent=1)
+
+    if verbose:
+        print('{0} scenarios on {1} workers in {2:.1f} s: {3} scenarios/minute'.format(
+            len(scenarios), workers, runSeconds, run['scenariosPerMinute']))
+        for r in records:
+            if r.get('error'):
+                print('+' * 45)
+                print('Scenario {0} failed:\n{1}'.format(r['name'], r['error']))
+    return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the USNVC summaries for many scenarios')
+    parser.add_argument('manifest', help='JSON (or YAML) scenario manifest')
+    parser.add_argument('--out', default=None, help='Output folder, overrides the manifest')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes, 1 to run in this process')
+    parser.add_argument('--only', nargs='+', default=None, help='Scenario names to run')
+    parser.add_argument('--charts', action='store_true', help='Draw charts for every scenario')
+    parser.add_argument('--chart-formats', nargs='+', default=None, choices=FORMATS,
+                        help='Chart file formats, png by default')
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest)
+    for sc in manifest['scenarios']:
+        sc['charts'] = sc['charts'] or args.charts
+        sc['chartFormats'] = args.chart_formats or sc['chartFormats']
+    run = run_batch(manifest, args.out, args.workers, args.only)
+    return 1 if run['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
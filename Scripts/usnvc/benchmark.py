@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        benchmark.py
+
+        Scaling benchmarks of the summaries on synthetic attribute tables.
+
+        For each table size (10^4 .. 10^8 rows) the stages of the analyses
+        are timed on a table from usnvc.synthetic:
+
+            load         read attribute_table.csv (sizes up to csvMaxRows)
+            dedupe       drop_duplicates over the analysis columns
+            rollup       CountCube and the group, management and
+                         ecoregion roll-ups
+            pivot        PAD status pivot with km2 and percent columns
+            bins         percent protected bins by L2 ecoregion
+            breakdown    % PAD 1 & 2 / 3 / 4 Converted / 4 Not Converted by
+                         L2 ecoregion
+            chartprep    ManageCat x class x status source of the
+                         management chart
+
+        Each size runs in a fresh worker process so its peak RSS is its own.
+        The peak RSS of a stage is its own high-water mark where the kernel
+        peak can be reset (Linux), and the process peak so far elsewhere;
+        peakScope says which. Wall time, peak RSS and rows in/out per stage
+        are appended to a JSON history file, and every run is compared with
+        the previous one so regressions show up.
+
+        Run from the Scripts folder:
+
+            python -m usnvc.benchmark --sizes 1e4 1e5 1e6 --history bench.json
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from .analysis import ecoregion_protection_breakdown, management_frame, summarize_by_manager
+from .binning import EDGES_30, bin_protection
+from .cube import CountCube
+from .lookups import NATURAL_CLASSES, natural_type
+from .profiling import peak_rss_mb, reset_peak_rss, stage_peak_rss_mb
+from .protection import add_protection_columns, pad_pivot
+from .synthetic import make_attribute_table
+from .vatcache import VAT_COLUMNS, read_attribute_csv
+
+
+DEFAULT_SIZES = (10 ** 4, 10 ** 5, 10 ** 6)
+
+STAGES = ('load', 'dedupe', 'rollup', 'pivot', 'bins', 'breakdown', 'chartprep')
+
+# Slower than this ratio to the previous run is reported as a regression
+REGRESSION_RATIO = 1.25
+
+
+#############################################################################################
+###################################### MEASUREMENT ##########################################
+#############################################################################################
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+#############################################################################################
+######################################## STAGES #############################################
+#############################################################################################
+
+
+def run_size(nRows, csvMaxRows=10 ** 6, seed=0, workDir=None):
+    '''
+    (int, int, int, str) -> list
+
+    Times every stage on one synthetic table size in this process and
+    returns one record per stage. peakRssMB is the stage's own high-water
+    mark (the kernel peak is reset when the stage starts) with peakScope
+    'stage', or where that is not possible the process peak so far with
+    peakScope 'process'; run it in a fresh process so that peak is this
+    size's own.
+    '''
+    records = []
+    scope = {}
+
+    def start():
+        scope['stage'] = reset_peak_rss()
+        return time.perf_counter()
+
+    def record(stage, t0, nIn, nOut):
+        secs = time.perf_counter() - t0
+        peak = stage_peak_rss_mb() if scope['stage'] else peak_rss_mb()
+        records.append({'rows': nRows, 'stage': stage, 'seconds': round(secs, 6),
+                        'peakRssMB': round(peak, 1),
+                        'peakScope': 'stage' if scope['stage'] else 'process',
+                        'rowsIn': int(nIn), 'rowsOut': int(nOut)})
+
+    dfAtt = make_attribute_table(nRows, seed=seed)
+
+    if nRows <= csvMaxRows:
+        tmp = tempfile.mkdtemp(dir=workDir)
+        csvPath = os.path.join(tmp, 'attribute_table.csv')
+        dfAtt.to_csv(csvPath, index=False)
+        del dfAtt
+        t0 = start()
+        dfAtt = read_attribute_csv(csvPath, VAT_COLUMNS, dropDuplicates=False)
+        record('load', t0, nRows, len(dfAtt))
+        os.remove(csvPath)
+        os.rmdir(tmp)
+
+    t0 = start()
+    dfTable = dfAtt.drop_duplicates()
+    record('dedupe', t0, len(dfAtt), len(dfTable))
+    del dfAtt
+
+    t0 = start()
+    dfTable = dfTable.assign(NaturalType=natural_type(dfTable['CLASS']))
+    cube = CountCube.from_table(dfTable)
+    dfGroup = cube.rollup(['GAPST_CD', 'CLASS', 'GROUP', 'GROUP_CODE'])
+    cube.rollup(['GAPST_CD', 'MANG_NAME', 'MANG_TYPE', 'CLASS'])
+    ruderal = [g for g in cube.labels['GROUP'] if 'Ruderal' in str(g)]
+    dfEco = cube.rollup(['GAPST_CD', 'NA_L2NAME', 'GROUP'], where={'CLASS': NATURAL_CLASSES},
+                        exclude={'GROUP': ruderal})
+    record('rollup', t0, len(dfTable), len(cube))
+    del dfTable
+
+    t0 = start()
+    dfGroupPivot = add_protection_columns(pad_pivot(dfGroup, ['CLASS', 'GROUP', 'GROUP_CODE']))
+    dfEcoPivot = add_protection_columns(pad_pivot(dfEco, ['NA_L2NAME', 'GROUP']))
+    record('pivot', t0, len(dfGroup) + len(dfEco), len(dfGroupPivot) + len(dfEcoPivot))
+
+    t0 = start()
+    dfBins = bin_protection(dfEcoPivot, by='NA_L2NAME', edges=EDGES_30, closed='right')
+    record('bins', t0, len(dfEcoPivot), len(dfBins))
+
+    t0 = start()
+    dfBreak = ecoregion_protection_breakdown(cube)
+    record('breakdown', t0, len(cube), len(dfBreak))
+
+    t0 = start()
+    dfSource = summarize_by_manager(management_frame(cube), classes=NATURAL_CLASSES)
+    record('chartprep', t0, len(cube), len(dfSource))
+    return records
+
+
+def _run_size_star(args):
+    return run_size(*args)
+
+
+#############################################################################################
+####################################### HISTORY #############################################
+#############################################################################################
+
+
+def load_history(path):
+    '''
+    (str) -> list
+
+    Returns the runs saved in a history file, [] when there is none.
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def compare_runs(previous, current, ratio=REGRESSION_RATIO):
+    '''
+    (dict, dict, float) -> DataFrame
+
+    Joins the stage timings of two runs on (rows, stage) and flags stages
+    that got slower than ratio times the previous wall time.
+    '''
+    dfPrev = pd.DataFrame(previous['results'])
+    dfCur = pd.DataFrame(current['results'])
+    dfCmp = dfCur.merge(dfPrev[['rows', 'stage', 'seconds', 'peakRssMB']],
+                        on=['rows', 'stage'], how='left', suffixes=('', 'Prev'))
+    dfCmp['ratio'] = dfCmp['seconds'] / dfCmp['secondsPrev']
+    dfCmp['regression'] = dfCmp['ratio'] > ratio
+    return dfCmp
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, history='benchmark_history.json', csvMaxRows=10 ** 6,
+                   seed=0, label=None, workDir=None):
+    '''
+    (list, str, int, int, str, str) -> dict
+
+    Runs every size in its own worker process, appends the run to the
+    history file, prints the timings and the comparison with the previous
+    run, and returns the run record.
+
+    Arguments:
+    sizes -- Table sizes in rows
+    history -- JSON history file, None to not save
+    csvMaxRows -- Largest size for which the CSV load is timed; bigger
+        tables are generated in memory only
+    seed -- Random seed of the synthetic tables
+    label -- Free text saved with the run, e.g. a branch name
+    workDir -- Folder for the temporary CSVs
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for n in sizes:
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            results.extend(pool.map(_run_size_star, [(int(n), csvMaxRows, seed, workDir)]))
+
+    run = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+           'label': label,
+           'commit': _git_commit(),
+           'host': platform.node(),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'pandas': pd.__version__,
+           'cpus': os.cpu_count(),
+           'results': [r for part in results for r in part]}
+
+    dfRun = pd.DataFrame(run['results'])
+    print(dfRun.pivot(index='stage', columns='rows', values='seconds')
+          .reindex(list(STAGES)).to_string(float_format=lambda x: '{0:.3f}'.format(x)))
+    print('Peak RSS (MB):', dfRun.groupby('rows')['peakRssMB'].max().to_dict())
+
+    if history:
+        runs = load_history(history)
+        if runs:
+            dfCmp = compare_runs(runs[-1], run)
+            slow = dfCmp[dfCmp['regression']]
+            if len(slow):
+                print('+' * 45)
+                print('Slower than the previous run ({0}):'.format(runs[-1]['timestamp']))
+                print(slow[['rows', 'stage', 'secondsPrev', 'seconds', 'ratio']]
+                      .to_string(index=False))
+        runs.append(run)
+        with open(history, 'w') as f:
+            json.dump(runs, f, indent=1)
+    return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='USNVC summary scaling benchmarks')
+    parser.add_argument('--sizes', nargs='+', type=float, default=list(DEFAULT_SIZES),
+                        help='Table sizes in rows, e.g. 1e4 1e6 1e8')
+    parser.add_argument('--history', default='benchmark_history.json',
+                        help='JSON file the run is appended to')
+    parser.add_argument('--csv-max-rows', type=float, default=1e6,
+                        help='Largest size whose CSV load is timed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default=None, help='Text saved with the run')
+    args = parser.parse_args(argv)
+    run_benchmarks([int(s) for s in args.sizes], args.history, int(args.csv_max_rows),
+                   args.seed, args.label)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        binning.py
+
+        Counts NVC groups in percent-protected bins (< 1%, 1-17%, 17-30%,
+        > 30% and the like) per class, ecoregion or manager.
+
+        The scripts built these tables with a loop over classes and four or
+        five full-length boolean masks per class. Here the values are binned
+        once with np.digitize and counted per group key with one bincount,
+        so many threshold sets can be run over the same table cheaply.
+
+        Edge handling is selectable:
+            'right'  -- bins are (a, b], as pd.cut(..., right=True) in the
+                        notebooks
+            'left'   -- bins are [a, b)
+            'open'   -- bins are (a, b); values exactly on an edge are not
+                        counted in any bin. This reproduces the strict
+                        < / > comparisons of NVCSummarization.py, which skip
+                        groups at exactly 1, 17 or 50 %.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+import pandas as pd
+
+from .cube import pack_keys
+
+
+PROTECT_COL = '% Protected 1 & 2'
+
+# Bin edges used in the v3 notebook and in NVCSummarization.py
+EDGES_30 = (1, 17, 30)
+EDGES_50 = (1, 17, 50)
+
+CLOSED_RULES = ('right', 'left', 'open')
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Bin Labels--------------------
+
+def bin_labels(edges, style='range'):
+    '''
+    (list, str) -> list
+
+    Returns a label for each bin defined by the interior edges.
+
+    Arguments:
+    edges -- Interior bin edges, e.g. (1, 17, 30)
+    style -- 'range' gives '< 1%', '1 - 17%', ..., '> 30%' as in the
+        notebook; 'short' gives 'LT1', 'LT17', ..., 'GT30' as in the
+        dfProtBins columns of NVCSummarization.py
+    '''
+    fmt = lambda x: '{0:g}'.format(x)
+    if style == 'short':
+        return ['LT' + fmt(e) for e in edges] + ['GT' + fmt(edges[-1])]
+    labels = ['< {0}%'.format(fmt(edges[0]))]
+    labels += ['{0} - {1}%'.format(fmt(a), fmt(b)) for a, b in zip(edges[:-1], edges[1:])]
+    labels.append('> {0}%'.format(fmt(edges[-1])))
+    return labels
+
+
+## --------------Bin Assignment--------------------
+
+def assign_bins(values, edges, closed='right'):
+    '''
+    (array, list, str) -> ndarray
+
+    Returns the bin number (0 .. len(edges)) of every value in one pass.
+    Values that fall in no bin (NaN, or exactly on an edge when closed is
+    'open') get -1.
+
+    Arguments:
+    values -- Percent protected values
+    edges -- Sorted interior bin edges
+    closed -- 'right', 'left' or 'open', see the module notes
+    '''
+    if closed not in CLOSED_RULES:
+        raise ValueError('closed must be one of {0}'.format(CLOSED_RULES))
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    if np.any(np.diff(edges) <= 0):
+        raise ValueError('Bin edges must be strictly increasing')
+
+    bins = np.digitize(values, edges, right=(closed == 'right'))
+    if closed == 'open':
+        bins[np.isin(values, edges)] = -1
+    bins[np.isnan(values)] = -1
+    return bins
+
+
+def _group_codes(df, by):
+    '''
+    Factorizes the group-by columns in order of first appearance and returns
+    one code per row, the number of groups and a frame of the group labels.
+    '''
+    codeArrays, labels = [], []
+    for col in by:
+        c, lab = pd.factorize(df[col], sort=False)
+        codeArrays.append(c)
+        labels.append(lab)
+    radices = [len(lab) for lab in labels]
+    key = pack_keys(codeArrays, radices)
+    uniq, inv = np.unique(key, return_inverse=True)
+    # Keep the groups in order of first appearance, like df[col].unique()
+    first = np.full(len(uniq), len(key), dtype=np.int64)
+    np.minimum.at(first, inv.ravel(), np.arange(len(key)))
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    keys = df.iloc[first[order]][by].reset_index(drop=True)
+    return rank[inv.ravel()], len(uniq), keys
+
+
+## --------------Counting--------------------
+
+def bin_counts(bins, groupCodes, nGroups, nBins):
+    '''
+    (ndarray, ndarray, int, int) -> ndarray
+
+    Returns an (nGroups, nBins) matrix of row counts from one bincount
+    over the packed (group, bin) codes. Rows with bin -1 are skipped.
+    '''
+    keep = bins >= 0
+    flat = groupCodes[keep].astype(np.int64) * nBins + bins[keep]
+    return np.bincount(flat, minlength=nGroups * nBins).reshape(nGroups, nBins)
+
+
+def bin_protection(df, by='NVCClass', value=PROTECT_COL, edges=EDGES_30,
+                   closed='right', labels=None, total='nGroups'):
+    '''
+    (DataFrame, list, str, list, str, list, str) -> DataFrame
+
+    Counts rows (NVC groups) per percent-protected bin for every group key.
+    Returns one row per key with a column per bin and a total column,
+    the layout of dfProtBins.
+
+    Arguments:
+    df -- Frame with one row per NVC group, e.g. the group pivot
+    by -- Column or list of columns to count within (class, ecoregion,
+        manager ...). Keys keep their order of first appearance.
+    value -- Column of percentages to bin
+    edges -- Interior bin edges, e.g. (1, 17, 30)
+    closed -- 'right', 'left' or 'open', see the module notes
+    labels -- Bin column names, defaults to bin_labels(edges)
+    total -- Name of the column holding all rows per key (including rows
+        dropped on an 'open' edge), or None to leave it out
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    edges = list(edges)
+    if labels is None:
+        labels = bin_labels(edges)
+    if len(labels) != len(edges) + 1:
+        raise ValueError('Need {0} labels for {1} edges'.format(len(edges) + 1, len(edges)))
+
+    groupCodes, nGroups, dfOut = _group_codes(df, by)
+    bins = assign_bins(df[value].to_numpy(), edges, closed)
+    counts = bin_counts(bins, groupCodes, nGroups, len(labels))
+
+    for i, lab in enumerate(labels):
+        dfOut[lab] = counts[:, i]
+    if total:
+        dfOut[total] = np.bincount(groupCodes, minlength=nGroups)
+    return dfOut
+
+
+def bin_protection_long(df, by='NVCClass', value=PROTECT_COL, edges=EDGES_30,
+                        closed='right', labels=None, catName='ProtCat', countName='nGroups'):
+    '''
+    (DataFrame, list, str, list, str, list, str, str) -> DataFrame
+
+    Same counts as bin_protection in long form, one row per key and bin,
+    the layout of dfProtCats used for the seaborn bar plots.
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    if labels is None:
+        labels = bin_labels(list(edges))
+    dfWide = bin_protection(df, by, value, edges, closed, labels, total=None)
+    dfLong = dfWide.melt(id_vars=by, value_vars=labels, var_name=catName, value_name=countName)
+    # Order as key then bin, the order the per-class loop appended rows in
+    dfLong['_key'] = np.tile(np.arange(len(dfWide)), len(labels))
+    dfLong = dfLong.sort_values('_key', kind='stable').drop(columns='_key')
+    return dfLong.reset_index(drop=True)
+
+
+def bin_protection_scenarios(df, scenarios, by='NVCClass', value=PROTECT_COL,
+                             closed='right', scenarioName='Scenario'):
+    '''
+    (DataFrame, dict, list, str, str, str) -> DataFrame
+
+    Runs bin_protection for many threshold sets. The group keys and the
+    value column are extracted once; each scenario then costs one digitize
+    and one bincount. Returns the wide tables stacked with a scenario column.
+
+    Arguments:
+    df -- Frame with one row per NVC group
+    scenarios -- Dictionary of scenario name -> interior bin edges
+    by -- Column or list of columns to count within
+    value -- Column of percentages to bin
+    closed -- 'right', 'left' or 'open', see the module notes
+    scenarioName -- Name of the scenario column in the output
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    groupCodes, nGroups, dfKeys = _group_codes(df, by)
+    values = df[value].to_numpy()
+    nTotal = np.bincount(groupCodes, minlength=nGroups)
+
+    frames = []
+    for name, edges in scenarios.items():
+        edges = list(edges)
+        labels = bin_labels(edges)
+        counts = bin_counts(assign_bins(values, edges, closed), groupCodes, nGroups, len(labels))
+        dfOut = dfKeys.copy()
+        dfOut.insert(0, scenarioName, name)
+        # Bins differ between scenarios so keep them in long form
+        for i, lab in enumerate(labels):
+            part = dfOut.copy()
+            part['Bin'] = i
+            part['ProtCat'] = lab
+            part['nGroups'] = counts[:, i]
+            part['nTotal'] = nTotal
+            frames.append(part)
+    return pd.concat(frames, ignore_index=True)
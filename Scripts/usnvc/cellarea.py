@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        cellarea.py
+
+        True ground area of raster cells.
+
+        The summaries turn cell counts into km2 with CELL_KM2 = 0.0009, the
+        area of a 30 m cell. That only holds on an equal-area grid such as
+        the CONUS, Alaska or Hawaii Albers rasters. On a geographic
+        (longitude / latitude) grid the area of a cell shrinks with the
+        cosine of its latitude, and on a conformal grid such as Mercator it
+        changes with the map scale.
+
+        AreaGrid works out the area of every cell once from the raster's
+        geotransform and CRS:
+
+            equal-area projection   one constant, |a * e - b * d|
+            geographic grid         one area per row (latitude band), from
+                                    the ellipsoid's authalic zone areas
+            any other projection    per cell, from the projection's areal
+                                    scale factor (needs pyproj)
+
+        The per-row areas are cached in memory and, with a cacheDir, on disk.
+        usnvc.rastercount sums each window's cell areas through the same
+        unique/inverse pass that counts the cells, so the combine carries
+        an exact AREA_KM2 column next to COUNT. CountCube, pad_pivot and
+        summarize_by_manager use that column in place of COUNT * CELL_KM2
+        when it is there.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import hashlib
+import os
+
+import numpy as np
+
+
+# Name of the summed cell area column next to COUNT
+AREA_COL = 'AREA_KM2'
+
+# PROJ projections that preserve area
+EQUAL_AREA_PROJECTIONS = ('aea', 'laea', 'cea', 'moll', 'sinu', 'eqearth', 'eck4', 'eck6',
+                          'hammer', 'igh', 'tcea', 'leac', 'bonne')
+
+# Semi-major axis (m) and inverse flattening
+ELLIPSOIDS = {'GRS80': (6378137.0, 298.257222101),
+              'WGS84': (6378137.0, 298.257223563),
+              'clrk66': (6378206.4, 294.9786982)}
+
+DATUM_ELLIPSOIDS = {'NAD83': 'GRS80', 'WGS84': 'WGS84', 'NAD27': 'clrk66'}
+
+# Meters per CRS unit
+UNITS = {'m': 1.0, 'km': 1000.0, 'ft': 0.3048, 'us-ft': 1200.0 / 3937.0}
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------CRS Parameters--------------------
+
+def crs_params(crs):
+    '''
+    (CRS, dict or str) -> dict
+
+    Returns the PROJ parameters of a rasterio CRS, a PROJ dict or any
+    string rasterio accepts (e.g. 'EPSG:5070').
+    '''
+    if isinstance(crs, dict):
+        return dict(crs)
+    if isinstance(crs, str):
+        from rasterio.crs import CRS
+        crs = CRS.from_user_input(crs)
+    return crs.to_dict()
+
+
+def ellipsoid(params):
+    '''
+    (dict) -> float, float
+
+    Returns the semi-major axis in meters and the squared eccentricity of
+    the CRS's ellipsoid. Raises ValueError when it cannot be told.
+    '''
+    if 'a' in params:
+        a = float(params['a'])
+        if 'rf' in params:
+            f = 1.0 / float(params['rf'])
+        elif 'f' in params:
+            f = float(params['f'])
+        elif 'b' in params:
+            f = 1.0 - float(params['b']) / a
+        else:
+            f = 0.0
+    else:
+        name = params.get('ellps') or DATUM_ELLIPSOIDS.get(params.get('datum'))
+        if name not in ELLIPSOIDS:
+            raise ValueError('Unknown ellipsoid in {0}'.format(params))
+        a, rf = ELLIPSOIDS[name]
+        f = 1.0 / rf
+    return a, f * (2.0 - f)
+
+
+def zone_area(lat, a, e2):
+    '''
+    (ndarray, float, float) -> ndarray
+
+    Area in m2 between the equator and latitude lat (degrees) per radian
+    of longitude on the ellipsoid (Snyder 1987, eq. 3-12).
+    '''
+    s = np.sin(np.radians(lat))
+    if e2 == 0:
+        return a * a * s
+    e = np.sqrt(e2)
+    q = s / (1.0 - e2 * s * s) - np.log((1.0 - e * s) / (1.0 + e * s)) / (2.0 * e)
+    return a * a * (1.0 - e2) / 2.0 * q
+
+
+def latitude_band_areas(top, dLat, dLon, nRows, a, e2):
+    '''
+    (float, float, float, int, float, float) -> ndarray
+
+    Returns the area in km2 of one cell in each of nRows rows of a
+    geographic grid whose first row starts at latitude top and whose rows
+    are dLat degrees apart (negative for north-up) and dLon degrees wide.
+    '''
+    edges = top + dLat * np.arange(nRows + 1, dtype=np.float64)
+    zones = zone_area(edges, a, e2)
+    return np.abs(np.diff(zones)) * np.radians(abs(dLon)) / 1e6
+
+
+#############################################################################################
+###################################### AREA GRID ############################################
+#############################################################################################
+
+class AreaGrid(object):
+    '''
+    Cell areas in km2 of a raster grid.
+
+    Attributes:
+    transform -- Geotransform (a, b, c, d, e, f) as in affine / rasterio
+    crs -- CRS as given (kept for pyproj in the per-cell case)
+    height, width -- Grid size in cells
+    kind -- 'constant', 'rows' or 'cells', see the module notes
+    cellKm2 -- Nominal cell area from the geotransform, in km2 when the
+        CRS is projected
+    '''
+
+    def __init__(self, transform, crs, height, width, cacheDir=None):
+        self.transform = tuple(transform)[:6]
+        self.crs = crs.to_wkt() if hasattr(crs, 'to_wkt') else crs
+        self.height, self.width = int(height), int(width)
+        self.cacheDir = cacheDir
+        self._rows = None
+
+        a, b, _, d, e, _ = self.transform
+        params = crs_params(crs)
+        self.params = params
+        if params.get('proj') in ('longlat', 'latlong', 'lonlat', 'latlon'):
+            if b or d:
+                raise ValueError('Rotated geographic grids are not supported')
+            self.kind = 'rows'
+            self.cellKm2 = None
+        else:
+            toMeter = float(params.get('to_meter', UNITS.get(params.get('units', 'm'), 1.0)))
+            self.cellKm2 = abs(a * e - b * d) * toMeter * toMeter / 1e6
+            self.kind = 'constant' if params.get('proj') in EQUAL_AREA_PROJECTIONS else 'cells'
+
+    @classmethod
+    def from_raster(cls, path, cacheDir=None):
+        '''
+        (str, str) -> AreaGrid
+
+        Reads the geotransform, CRS and size of a raster.
+        '''
+        import rasterio
+        with rasterio.open(path) as src:
+            return cls(src.transform, src.crs, src.height, src.width, cacheDir)
+
+    def __repr__(self):
+        return 'AreaGrid({0}x{1}, {2})'.format(self.height, self.width, self.kind)
+
+    @property
+    def key(self):
+        '''
+        SHA-1 of the grid definition, names the cached row areas.
+        '''
+        h = hashlib.sha1(repr((self.transform, sorted(self.params.items()),
+                               self.height, self.width)).encode())
+        return h.hexdigest()
+
+    ## --------------Row Areas--------------------
+
+    def rows(self):
+        '''
+        () -> ndarray
+
+        Returns the area in km2 of one cell in each row ('constant' and
+        'rows' grids). Computed once, then served from memory or the
+        cacheDir.
+        '''
+        if self._rows is not None:
+            return self._rows
+        if self.kind == 'cells':
+            raise ValueError('Cell areas of this projection vary along rows too; use window')
+        if self.kind == 'constant':
+            self._rows = np.full(self.height, self.cellKm2)
+            return self._rows
+
+        path = None
+        if self.cacheDir is not None:
+            path = os.path.join(self.cacheDir, 'rowareas-{0}.npy'.format(self.key))
+            try:
+                self._rows = np.load(path)
+                return self._rows
+            except (OSError, ValueError):
+                pass
+        a, _, _, _, e, f = self.transform
+        self._rows = latitude_band_areas(f, e, a, self.height, *ellipsoid(self.params))
+        if path is not None:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as fh:
+                np.save(fh, self._rows)
+            os.replace(tmp, path)
+        return self._rows
+
+    ## --------------Window Areas--------------------
+
+    def window(self, window):
+        '''
+        (tuple) -> ndarray
+
+        Returns the cell areas of a (row_off, col_off, nrows, ncols)
+        window: an (nrows, 1) column that broadcasts over the window when
+        the area only depends on the row, otherwise (nrows, ncols).
+        '''
+        r, c, h, w = window
+        if self.kind != 'cells':
+            return self.rows()[r:r + h, None]
+        return self._projected_areas(r, c, h, w)
+
+    def _projected_areas(self, r, c, h, w):
+        # Nominal cell area divided by the areal scale at each cell center
+        from pyproj import CRS, Proj, Transformer
+
+        a, b, x0, d, e, y0 = self.transform
+        cols, rows = np.meshgrid(np.arange(c, c + w) + 0.5, np.arange(r, r + h) + 0.5)
+        x = a * cols + b * rows + x0
+        y = d * cols + e * rows + y0
+        crs = CRS.from_user_input(self.crs)
+        toGeo = Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True)
+        lon, lat = toGeo.transform(x, y)
+        scale = Proj(crs).get_factors(lon, lat).areal_scale
+        return self.cellKm2 / np.asarray(scale, dtype=np.float64)
+
+    def total(self):
+        '''
+        () -> float
+
+        Returns the area of the whole grid in km2.
+        '''
+        if self.kind != 'cells':
+            return float(self.rows().sum() * self.width)
+        return float(self.window((0, 0, self.height, self.width)).sum())
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        cube.py
+
+        Pre-aggregated cell count cube over the attribute table.
+
+        The summaries group the same table on different key sets, for example
+        (GAPST_CD, MANG_NAME, MANG_TYPE, CLASS) for the management summary,
+        (GAPST_CD, GROUP, GROUP_CODE, CLASS) for the group pivot and
+        (GAPST_CD, NA_L2NAME, GROUP) for the ecoregion bins. Each of those is a
+        full scan over string columns.
+
+        CountCube integer-encodes every dimension once and sums COUNT over
+        the distinct dimension combinations in a single pass. Any roll-up or
+        slice is then answered from the cube's rows, which are far fewer than
+        the base table's, without touching the strings again.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from .cellarea import AREA_COL
+
+
+# Dimensions kept in the cube when they are present in the table.
+# NaturalType only exists once the notebook has added it.
+CUBE_DIMS = ['GAPST_CD',
+'MANG_NAME',
+'MANG_TYPE',
+'CLASS',
+'MACROGROUP',
+'GROUP',
+'GROUP_CODE',
+'NA_L2NAME',
+'US_L3NAME',
+'US_L4NAME',
+'NaturalType']
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Integer Encoding--------------------
+
+def encode_column(s):
+    '''
+    (Series) -> ndarray, Index
+
+    Returns integer codes and the sorted labels they refer to. Missing
+    values get the code -1. Categorical columns reuse their existing codes
+    so the strings are not scanned again.
+    '''
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return np.asarray(s.cat.codes, dtype=np.int32), s.cat.categories
+    codes, labels = pd.factorize(s, sort=True)
+    return codes.astype(np.int32), labels
+
+
+def pack_keys(codeArrays, radices):
+    '''
+    (list, list) -> ndarray
+
+    Packs several integer code arrays into one int64 key per row using a
+    mixed radix, so a multi-column group-by becomes a single np.unique.
+    Codes of -1 (missing) become the last digit, so missing keys sort
+    after every label as in pandas; that is why each radix is the number
+    of labels plus one. Raises OverflowError when the key space
+    does not fit in 63 bits.
+
+    Arguments:
+    codeArrays -- Equal-length integer code arrays, one per dimension
+    radices -- Number of labels in each dimension
+    '''
+    space = 1
+    for r in radices:
+        space *= int(r) + 1
+    if space >= 2 ** 63:
+        raise OverflowError('Key space of {0} does not fit in int64'.format(space))
+
+    key = np.zeros(len(codeArrays[0]) if codeArrays else 0, dtype=np.int64)
+    for codes, r in zip(codeArrays, radices):
+        key *= int(r) + 1
+        key += np.asarray(codes, dtype=np.int64) % (int(r) + 1)
+    return key
+
+
+def unpack_keys(key, radices):
+    '''
+    (ndarray, list) -> list
+
+    Inverse of pack_keys. Returns one code array per dimension with
+    missing values restored to -1.
+    '''
+    out = []
+    key = np.asarray(key, dtype=np.int64).copy()
+    for r in reversed(radices):
+        digit = (key % (int(r) + 1)).astype(np.int32)
+        digit[digit == r] = -1
+        out.append(digit)
+        key //= int(r) + 1
+    return out[::-1]
+
+
+def group_sum(codeArrays, radices, values):
+    '''
+    (list, list, ndarray) -> list, ndarray
+
+    Sums values over the distinct combinations of the code arrays.
+    Returns the code arrays of the distinct combinations (in sorted key
+    order) and the summed values. values may be 2-D (rows x measures) to
+    sum several measures through one unique pass.
+    '''
+    try:
+        key = pack_keys(codeArrays, radices)
+        uniq, inv = np.unique(key, return_inverse=True)
+        outCodes = unpack_keys(uniq, radices)
+    except OverflowError:
+        # Too many dimensions for one packed key, fall back to row-unique
+        stacked = np.column_stack([np.asarray(c, dtype=np.int64) for c in codeArrays])
+        uniq, inv = np.unique(stacked, axis=0, return_inverse=True)
+        outCodes = [uniq[:, i].astype(np.int32) for i in range(uniq.shape[1])]
+    inv = inv.ravel()
+    values = np.asarray(values)
+    if values.ndim == 1:
+        return outCodes, np.bincount(inv, weights=values, minlength=len(uniq))
+    sums = np.column_stack([np.bincount(inv, weights=values[:, j], minlength=len(uniq))
+                            for j in range(values.shape[1])])
+    return outCodes, sums
+
+
+#############################################################################################
+###################################### COUNT CUBE ###########################################
+#############################################################################################
+
+class CountCube(object):
+    '''
+    Cell counts summed over the distinct combinations of a set of
+    integer-encoded dimensions.
+
+    Attributes:
+    dims -- Dimension (column) names in cube order
+    codes -- Dictionary of dimension name -> int32 code array
+    labels -- Dictionary of dimension name -> Index of labels
+    counts -- Summed cell counts, one per cube row
+    value -- Name of the summed column, COUNT by default
+    areas -- Summed true cell areas in km2 (AREA_KM2, see usnvc.cellarea),
+        None when the table has no area column
+    '''
+
+    def __init__(self, dims, codes, labels, counts, value='COUNT', areas=None):
+        self.dims = list(dims)
+        self.codes = codes
+        self.labels = labels
+        self.counts = np.asarray(counts)
+        self.value = value
+        self.areas = None if areas is None else np.asarray(areas, dtype=np.float64)
+
+    ## --------------Building--------------------
+
+    @classmethod
+    def from_table(cls, df, dims=CUBE_DIMS, value='COUNT'):
+        '''
+        (DataFrame, list, str) -> CountCube
+
+        Builds the cube in one pass over the table. Dimensions that are not
+        columns of the table are skipped. An AREA_KM2 column is summed
+        alongside the counts.
+
+        Arguments:
+        df -- Attribute table (dfTable) or any frame with a count column
+        dims -- Candidate dimension columns
+        value -- Column of cell counts to sum
+        '''
+        dims = [d for d in dims if d in df.columns]
+        codeArrays, labels = [], {}
+        for d in dims:
+            c, lab = encode_column(df[d])
+            codeArrays.append(c)
+            labels[d] = lab
+        radices = [len(labels[d]) for d in dims]
+        values = df[value].to_numpy()
+        areas = None
+        if AREA_COL in df.columns:
+            measures = np.column_stack([values.astype(np.float64),
+                                        df[AREA_COL].to_numpy(dtype=np.float64)])
+            cubeCodes, sums = group_sum(codeArrays, radices, measures)
+            sums, areas = sums[:, 0], sums[:, 1]
+        else:
+            cubeCodes, sums = group_sum(codeArrays, radices, values.astype(np.float64))
+        if values.dtype.kind in 'iub':
+            # bincount sums in float64, which is exact for cell counts
+            sums = np.rint(sums).astype(np.int64)
+        return cls(dims, dict(zip(dims, cubeCodes)), labels, sums, value, areas)
+
+    ## --------------Saving--------------------
+
+    def save(self, folder):
+        '''
+        (str) -> str
+
+        Writes the cube to a folder: one .npy file per code array, the
+        counts (and areas), and the labels and dimension order in a small
+        pickle. Returns the folder.
+        '''
+        os.makedirs(folder, exist_ok=True)
+        for i, d in enumerate(self.dims):
+            np.save(os.path.join(folder, 'codes{0}.npy'.format(i)), self.codes[d])
+        np.save(os.path.join(folder, 'counts.npy'), self.counts)
+        areasPath = os.path.join(folder, 'areas.npy')
+        if self.areas is not None:
+            np.save(areasPath, self.areas)
+        elif os.path.exists(areasPath):
+            os.remove(areasPath)
+        with open(os.path.join(folder, 'labels.pkl'), 'wb') as f:
+            pickle.dump({'dims': self.dims, 'labels': self.labels, 'value': self.value}, f)
+        return folder
+
+    @classmethod
+    def load(cls, folder, mmapMode='r'):
+        '''
+        (str, str) -> CountCube
+
+        Reads a cube written by save. With mmapMode='r' the arrays are
+        memory-mapped read-only, so processes loading the same folder share
+        one copy of them in the page cache.
+        '''
+        with open(os.path.join(folder, 'labels.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+        codes = {d: np.load(os.path.join(folder, 'codes{0}.npy'.format(i)), mmap_mode=mmapMode)
+                 for i, d in enumerate(meta['dims'])}
+        counts = np.load(os.path.join(folder, 'counts.npy'), mmap_mode=mmapMode)
+        areasPath = os.path.join(folder, 'areas.npy')
+        areas = np.load(areasPath, mmap_mode=mmapMode) if os.path.exists(areasPath) else None
+        return cls(meta['dims'], codes, meta['labels'], counts, meta['value'], areas)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __repr__(self):
+        return 'CountCube({0} rows; {1})'.format(
+            len(self), ', '.join('{0}={1}'.format(d, len(self.labels[d])) for d in self.dims))
+
+    ## --------------Slicing--------------------
+
+    def _mask(self, where=None, exclude=None):
+        mask = np.ones(len(self), dtype=bool)
+        for filters, keep in ((where, True), (exclude, False)):
+            for d, vals in (filters or {}).items():
+                if np.isscalar(vals) or vals is None:
+                    vals = [vals]
+                idx = self.labels[d].get_indexer([v for v in vals if v is not None])
+                idx = list(idx[idx >= 0])
+                if any(v is None for v in vals):
+                    idx.append(-1)
+                hit = np.isin(self.codes[d], idx)
+                mask &= hit if keep else ~hit
+        return mask
+
+    def slice(self, where=None, exclude=None):
+        '''
+        (dict, dict) -> CountCube
+
+        Returns the cube rows matching the filters. Both arguments map a
+        dimension name to a label or list of labels; None selects missing
+        values.
+
+        Arguments:
+        where -- Keep rows whose label is in the list
+        exclude -- Drop rows whose label is in the list
+        '''
+        mask = self._mask(where, exclude)
+        return CountCube(self.dims, {d: c[mask] for d, c in self.codes.items()},
+                         self.labels, self.counts[mask], self.value,
+                         None if self.areas is None else self.areas[mask])
+
+    ## --------------Rolling Up--------------------
+
+    def rollup(self, by, where=None, exclude=None, dropna=True):
+        '''
+        (list, dict, dict, bool) -> DataFrame
+
+        Sums the cube over every dimension not in by. Returns the same frame
+        as df.groupby(by)[value].sum().reset_index(), including the sorted
+        row order and the dropping of missing keys, plus AREA_KM2 when the
+        cube has areas.
+
+        Arguments:
+        by -- Dimensions to keep
+        where -- Optional filters, see slice
+        exclude -- Optional exclusions, see slice
+        dropna -- Drop combinations where any key is missing
+        '''
+        by = [by] if isinstance(by, str) else list(by)
+        mask = self._mask(where, exclude)
+        if dropna:
+            for d in by:
+                mask &= self.codes[d] >= 0
+        codeArrays = [self.codes[d][mask] for d in by]
+        radices = [len(self.labels[d]) for d in by]
+        if self.areas is None:
+            outCodes, sums = group_sum(codeArrays, radices, self.counts[mask])
+        else:
+            measures = np.column_stack([self.counts[mask], self.areas[mask]])
+            outCodes, sums = group_sum(codeArrays, radices, measures)
+            sums, areas = sums[:, 0], sums[:, 1]
+
+        data = {}
+        for d, c in zip(by, outCodes):
+            lab = self.labels[d]
+            if (c >= 0).all():
+                data[d] = lab.take(c)
+            else:
+                data[d] = pd.Categorical.from_codes(c, lab).astype(object)
+        out = pd.DataFrame(data)
+        if self.counts.dtype.kind in 'iub':
+            sums = np.rint(sums)
+        out[self.value] = sums.astype(self.counts.dtype)
+        if self.areas is not None:
+            out[AREA_COL] = areas
+        return out
+
+    def total(self, where=None, exclude=None):
+        '''
+        (dict, dict) -> number
+
+        Returns the total cell count of the rows matching the filters.
+        '''
+        return self.counts[self._mask(where, exclude)].sum().item()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        database.py
+
+        Shared access to the GAP analytic database.
+
+        Replaces the ConnectToDB / ConnectAnalyticDB pair that was copied
+        into each script. A backend knows how to open a connection:
+
+            SqlServerBackend -- the GAP_AnalyticDB instance through pyodbc
+            SQLiteBackend    -- a local SQLite file with the same tables
+            DuckDBBackend    -- a local DuckDB file with the same tables
+
+        AnalyticDB keeps a small pool of open connections to one backend and
+        reuses them across queries, and logs the latency and row count of
+        every call. get_db() returns one shared AnalyticDB per database URL,
+        so repeated calls in a process skip connection setup.
+
+        The database is chosen with a URL, from the USNVC_DB environment
+        variable when none is given:
+
+            mssql://CHUCK\\SQL2014/GAP_AnalyticDB
+            sqlite:///D:/USGS Analyses/GAP_AnalyticDB.sqlite
+            duckdb:///data/gap_analytic.duckdb
+
+        copy_tables() loads the lookup tables from one database into another,
+        which is how the SQLite/DuckDB stand-ins are made for batch nodes
+        without SQL Server.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_URL = 'mssql://CHUCK\\SQL2014/GAP_AnalyticDB'
+
+# Tables of the analytic database the analyses read
+ANALYTIC_TABLES = ['lu_boundary',
+'lu_boundary_gap_landfire',
+'gap_landfire',
+'padus1_4']
+
+
+#############################################################################################
+###################################### BACKENDS #############################################
+#############################################################################################
+
+class Backend(object):
+    '''
+    Interface of a database backend. Subclasses set dialect (used to pick
+    SQL variants, see summarytable.py) and implement connect().
+    '''
+    dialect = None
+
+    def connect(self):
+        '''
+        () -> connection
+
+        Opens and returns a new DB-API connection.
+        '''
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '{0}()'.format(type(self).__name__)
+
+
+class SqlServerBackend(Backend):
+    '''
+    SQL Server through pyodbc, using a trusted connection.
+    '''
+    dialect = 'mssql'
+
+    # Tried in order; Native Client 10.0 was the old fallback in the scripts
+    DRIVERS = ('SQL Server Native Client 11.0',
+               'SQL Server Native Client 10.0',
+               'ODBC Driver 17 for SQL Server')
+
+    def __init__(self, server='CHUCK\\SQL2014', database='GAP_AnalyticDB', drivers=DRIVERS):
+        self.server = server
+        self.database = database
+        self.drivers = tuple(drivers)
+
+    def connection_string(self, driver):
+        return ('DRIVER={0};SERVER={1};UID=;PWD=;TRUSTED_CONNECTION=Yes;'
+                'DATABASE={2};'.format(driver, self.server, self.database))
+
+    def connect(self):
+        import pyodbc
+        err = None
+        for driver in self.drivers:
+            try:
+                return pyodbc.connect(self.connection_string(driver))
+            except pyodbc.Error as e:
+                err = e
+                log.debug('Driver %s failed: %s', driver, e)
+        raise err
+
+    def __repr__(self):
+        return 'SqlServerBackend({0!r}, {1!r})'.format(self.server, self.database)
+
+
+class SQLiteBackend(Backend):
+    '''
+    Local SQLite file holding copies of the analytic tables.
+    '''
+    dialect = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        import sqlite3
+        # Pooled connections may be handed to another thread
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def __repr__(self):
+        return 'SQLiteBackend({0!r})'.format(self.path)
+
+
+class DuckDBBackend(Backend):
+    '''
+    Local DuckDB file holding copies of the analytic tables.
+    '''
+    dialect = 'duckdb'
+
+    def __init__(self, path, readOnly=False):
+        self.path = path
+        self.readOnly = readOnly
+
+    def connect(self):
+        import duckdb
+        return duckdb.connect(self.path, read_only=self.readOnly)
+
+    def __repr__(self):
+        return 'DuckDBBackend({0!r})'.format(self.path)
+
+
+def backend_from_url(url):
+    '''
+    (str) -> Backend
+
+    Returns the backend for a database URL, see the module notes.
+    '''
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        raise ValueError('Not a database URL: {0}'.format(url))
+    scheme = scheme.lower()
+    if scheme == 'mssql':
+        server, _, database = rest.rpartition('/')
+        return SqlServerBackend(server or rest, database or 'GAP_AnalyticDB')
+    # sqlite:///relative or sqlite:////absolute, as in SQLAlchemy URLs
+    path = rest[1:] if rest.startswith('/') else rest
+    if scheme == 'sqlite':
+        return SQLiteBackend(path or ':memory:')
+    if scheme == 'duckdb':
+        return DuckDBBackend(path or ':memory:')
+    raise ValueError('Unknown database scheme: {0}'.format(scheme))
+
+
+#############################################################################################
+################################### CONNECTION POOL #########################################
+#############################################################################################
+
+class AnalyticDB(object):
+    '''
+    Pooled connections to one backend plus logged query helpers.
+
+    Connections are opened on demand, up to poolSize are kept open after
+    use and handed out again by later calls.
+    '''
+
+    def __init__(self, backend, poolSize=2):
+        if isinstance(backend, str):
+            backend = backend_from_url(backend)
+        self.backend = backend
+        self.poolSize = poolSize
+        self._idle = []
+        self._lock = threading.Lock()
+        self.nQueries = 0
+        self.nConnects = 0
+
+    @property
+    def dialect(self):
+        return self.backend.dialect
+
+    ## --------------Connections--------------------
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        t0 = time.perf_counter()
+        conn = self.backend.connect()
+        self.nConnects += 1
+        log.info('Connected to %r in %.3f s', self.backend, time.perf_counter() - t0)
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.poolSize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Context manager yielding a pooled connection. A connection that
+        raised is rolled back and closed instead of going back to the pool.
+        '''
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            finally:
+                conn.close()
+            raise
+        self._release(conn)
+
+    def close(self):
+        '''
+        Closes every idle pooled connection.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    ## --------------Queries--------------------
+
+    def query(self, sql, params=None):
+        '''
+        (str, list) -> DataFrame
+
+        Runs a query on a pooled connection and returns the result as a
+        DataFrame. Latency and row count are logged.
+        '''
+        t0 = time.perf_counter()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            if params is None:
+                cur.execute(sql)
+            else:
+                cur.execute(sql, params)
+            cols = [d[0] for d in cur.description]
+            rows = cur.fetchall()
+        df = pd.DataFrame.from_records([tuple(r) for r in rows], columns=cols)
+        self._log(sql, time.perf_counter() - t0, len(df))
+        return df
+
+    def execute(self, sql, params=None):
+        '''
+        (str, list) -> int
+
+        Runs a statement on a pooled connection, commits, and returns the
+        driver's row count (-1 when unknown).
+        '''
+        t0 = time.perf_counter()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            if params is None:
+                cur.execute(sql)
+            else:
+                cur.execute(sql, params)
+            n = getattr(cur, 'rowcount', -1)
+            conn.commit()
+        self._log(sql, time.perf_counter() - t0, n)
+        return n
+
+    def _log(self, sql, seconds, nRows):
+        self.nQueries += 1
+        first = ' '.join(sql.split())[:60]
+        log.info('%.3f s, %s rows: %s', seconds, nRows, first)
+
+    def __repr__(self):
+        return 'AnalyticDB({0!r}, poolSize={1})'.format(self.backend, self.poolSize)
+
+
+_databases = {}
+_databasesLock = threading.Lock()
+
+
+def get_db(url=None, poolSize=2):
+    '''
+    (str, int) -> AnalyticDB
+
+    Returns the shared AnalyticDB for a URL, creating it on first use.
+    The URL defaults to the USNVC_DB environment variable, then to the
+    GAP_AnalyticDB SQL Server instance.
+    '''
+    if url is None:
+        url = os.environ.get('USNVC_DB', DEFAULT_URL)
+    with _databasesLock:
+        db = _databases.get(url)
+        if db is None:
+            db = _databases[url] = AnalyticDB(url, poolSize)
+    return db
+
+
+## --------------Local Copies of the Analytic Tables--------------------
+
+def copy_tables(source, target, tables=ANALYTIC_TABLES, chunksize=500000):
+    '''
+    (AnalyticDB, AnalyticDB, list, int) -> dict
+
+    Copies tables from one database to a SQLite or DuckDB target, replacing
+    them there, and returns the row count per table. Rows are moved in
+    chunks so large lookup tables are not held in memory at once.
+
+    Arguments:
+    source -- Database to read from, usually the SQL Server instance
+    target -- SQLite or DuckDB database to write to
+    tables -- Table names to copy
+    chunksize -- Rows per chunk
+    '''
+    if target.dialect not in ('sqlite', 'duckdb'):
+        raise ValueError('Tables can only be copied into SQLite or DuckDB')
+
+    counts = {}
+    for table in tables:
+        t0 = time.perf_counter()
+        n = 0
+        with source.connection() as src, target.connection() as dst:
+            dst.cursor().execute('DROP TABLE IF EXISTS {0}'.format(table))
+            cur = src.cursor()
+            cur.execute('SELECT * FROM {0}'.format(table))
+            cols = [d[0] for d in cur.description]
+            first = True
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows and not first:
+                    break
+                dfChunk = pd.DataFrame.from_records([tuple(r) for r in rows], columns=cols)
+                _write_chunk(dst, target.dialect, table, dfChunk, first)
+                first = False
+                n += len(dfChunk)
+                if not rows:
+                    break
+            dst.commit()
+        counts[table] = n
+        log.info('Copied %s: %d rows in %.1f s', table, n, time.perf_counter() - t0)
+    return counts
+
+
+def _write_chunk(conn, dialect, table, dfChunk, create):
+    if dialect == 'sqlite':
+        dfChunk.to_sql(table, conn, if_exists='replace' if create else 'append', index=False)
+        return
+    conn.register('_usnvc_chunk', dfChunk)
+    if create:
+        conn.execute('CREATE TABLE {0} AS SELECT * FROM _usnvc_chunk'.format(table))
+    else:
+        conn.execute('INSERT INTO {0} SELECT * FROM _usnvc_chunk'.format(table))
+    conn.unregister('_usnvc_chunk')
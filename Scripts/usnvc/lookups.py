@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        lookups.py
+
+        Shared lookups for the NVC hierarchy, PAD managers, GAP status and
+        ecoregions, as integer codes and ordered categoricals.
+
+        The scripts and the notebook repeat the same string lists: the
+        natural classes, the manager name -> ManageCat dictionary, the
+        hand-numbered (ManageCat, class) sort order and the class number
+        prefix strip. They are kept here once. Columns built from them are
+        ordered categoricals, so a frame stores small integer codes, sorting
+        follows the category order, and a recode such as merging
+        'Great Lakes Sand Beach' into 'Great Lakes Dune' rewrites the
+        category list (relabel) instead of every row.
+
+        Hierarchy holds a coarse-to-fine chain of levels (class ->
+        macrogroup -> group, or L2 -> L3 -> L4 ecoregion) with one parent
+        code array per level, so finer codes roll up to coarser ones by
+        indexing.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import re
+
+import numpy as np
+import pandas as pd
+
+
+## --------------GAP Status--------------------
+
+GAP_STATUSES = (1, 2, 3, 4)
+GAP_STATUS_DTYPE = pd.CategoricalDtype(list(GAP_STATUSES), ordered=True)
+
+
+## --------------NVC Classes--------------------
+
+# NVC classes as named in the attribute table, in the order they are reported
+NVC_CLASSES = ['1 Forest & Woodland',
+'2 Shrub & Herb Vegetation',
+'3 Desert & Semi-Desert',
+'4 Polar & High Montane Scrub Grassland & Barrens',
+'5 Aquatic Vegetation',
+'6 Open Rock Vegetation',
+'7 Agricultural & Developed Vegetation',
+'Nonvascular & Sparse Vascular Rock Vegetation',
+'Developed-High Intensity',
+'Developed-Low Intensity',
+'Developed-Medium Intensity',
+'Developed-Roads',
+'Open Water',
+'Quarries-Strip Mines-Gravel Pits-Energy Development',
+'Recently Disturbed or Modified']
+
+# Natural/non-anthropogenic NVC classes as named in the attribute table
+NATURAL_CLASSES = ['1 Forest & Woodland',
+'2 Shrub & Herb Vegetation',
+'3 Desert & Semi-Desert',
+'4 Polar & High Montane Scrub Grassland & Barrens',
+'6 Open Rock Vegetation']
+
+# The natural classes as named in the GAP analytic database (no number prefix)
+DB_NATURAL_CLASSES = ['Forest & Woodland',
+'Shrub & Herb Vegetation',
+'Desert & Semi-Desert',
+'Polar & High Montane Scrub, Grassland & Barrens',
+'Open Rock Vegetation']
+
+# Classes 1 - 6 are 'Not Converted', everything else 'Converted'
+NOT_CONVERTED_CLASSES = NVC_CLASSES[:6]
+
+# Shorter class names used on the plots
+CLASS_SHORT_NAMES = {'Polar & High Montane Scrub Grassland & Barrens': 'Polar & High Montane',
+                     'Polar & High Montane Scrub, Grassland & Barrens': 'Polar & High Montane'}
+
+# Order of the classes on the management plots
+PLOT_CLASS_ORDER = ['Forest & Woodland',
+'Shrub & Herb Vegetation',
+'Desert & Semi-Desert',
+'Polar & High Montane',
+'Open Rock Vegetation',
+'Eastern Plantation']
+
+CLASS_NUMBER = re.compile(r'\d\s')
+
+
+## --------------PAD Managers--------------------
+
+# Standardized management categories for the PAD-US manager names
+MANAGE_CATEGORIES = {'Bureau of Land Management':'Bureau of Land Management',
+'Forest Service':'Forest Service',
+'National Park Service':'National Park Service',
+'U.S. Fish & Wildlife Service':'U.S. Fish & Wildlife Service',
+'U.S. Fish and Wildlife Service':'U.S. Fish & Wildlife Service',
+'American Indian Lands':'Other',
+'American Indian Areas':'Other',
+'City Land':'Other',
+'County Land':'Other',
+'Joint':'Other',
+'Non-Governmental Organization':'Other',
+'Other':'Other',
+'Other or Unknown Local Government':'Other',
+'Private':'Other',
+'Private-not in PADUS':'Other',
+'Regional Agency Land':'Other',
+'Regional Water Districts':'Other',
+'Unknown':'Other',
+'Agricultural Research Service':'Other Federal',
+'Army Corps of Engineers':'Other Federal',
+'Bonneville Power Administration':'Other Federal',
+'Bureau of Indian Affairs':'Other Federal',
+'Bureau of Reclamation':'Other Federal',
+'Department of Defense':'Other Federal',
+'Department of Energy':'Other Federal',
+'National Oceanic and Atmospheric Administration':'Other Federal',
+'Other or Unknown Federal Land':'Other Federal',
+'Tennessee Valley Authority':'Other Federal',
+'Natural Resources Conservation Service':'Other Federal',
+'Other or Unknown State Land':'State',
+'State Department of Conservation':'State',
+'State Department of Land':'State',
+'State Department of Natural Resources':'State',
+'State Fish and Wildlife':'State',
+'State Land Board':'State',
+'State Park and Recreation':'State'}
+
+# Order of the management categories on the plots
+MANAGE_CAT_ORDER = ['Bureau of Land Management',
+'Forest Service',
+'National Park Service',
+'U.S. Fish & Wildlife Service',
+'Other Federal',
+'State',
+'Other']
+
+
+## --------------Hierarchy Levels--------------------
+
+NVC_LEVELS = ('CLASS', 'MACROGROUP', 'GROUP')
+ECO_LEVELS = ('NA_L2NAME', 'US_L3NAME', 'US_L4NAME')
+ECO_CODE_LEVELS = ('NA_L2CODE', 'US_L3CODE', 'US_L4CODE')
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Categoricals--------------------
+
+def to_categorical(s, categories=None, ordered=True):
+    '''
+    (Series, list, bool) -> Series
+
+    Returns s as a categorical. Values in categories keep that order;
+    any other values follow in sorted order so nothing becomes missing.
+    A categorical s with no categories given is returned as is.
+    '''
+    if categories is None:
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            return s
+        return s.astype(pd.CategoricalDtype(sorted(s.dropna().unique()), ordered=ordered))
+    categories = list(categories)
+    known = set(categories)
+    extra = sorted(v for v in pd.unique(s.dropna()) if v not in known)
+    return s.astype(pd.CategoricalDtype(categories + extra, ordered=ordered))
+
+
+def relabel(s, mapping, categories=None):
+    '''
+    (Series, dict or function, list) -> Series
+
+    Recodes a column by rewriting its categories, not its rows: each
+    category is mapped once, categories that map to the same label are
+    merged, and the row codes are translated with one lookup array. Labels
+    mapped to None become missing. Object columns are made categorical
+    first.
+
+    Arguments:
+    s -- Column to recode
+    mapping -- Dict of old -> new labels (unlisted labels are kept) or a
+        function of the old label
+    categories -- Order of the new categories; by default the order of the
+        first old category of each new label
+    '''
+    s = to_categorical(s)
+    old = s.cat.categories
+    if callable(mapping):
+        new = [mapping(c) for c in old]
+    else:
+        new = [mapping.get(c, c) for c in old]
+    new = [None if (n is None or (isinstance(n, float) and np.isnan(n))) else n for n in new]
+    labels = list(dict.fromkeys(n for n in new if n is not None))
+    if categories is not None:
+        labels = list(categories) + [n for n in labels if n not in set(categories)]
+    pos = {n: i for i, n in enumerate(labels)}
+    # Lookup array from old codes to new codes, with a slot at -1 for missing
+    lut = np.array([pos[n] if n is not None else -1 for n in new] + [-1], dtype=np.int32)
+    codes = lut[np.asarray(s.cat.codes)]
+    cat = pd.Categorical.from_codes(codes, labels, ordered=s.cat.ordered)
+    return pd.Series(cat, index=s.index, name=s.name)
+
+
+def strip_class_number(s):
+    '''
+    (Series) -> Series
+
+    Removes the '1 ' .. '7 ' number prefixes from class names, applied to
+    the categories only.
+    '''
+    return relabel(s, lambda c: CLASS_NUMBER.sub('', c) if isinstance(c, str) else c)
+
+
+def manage_category(s):
+    '''
+    (Series) -> Series
+
+    Returns the ManageCat column for a column of PAD-US manager names as an
+    ordered categorical in MANAGE_CAT_ORDER. Unknown managers are missing,
+    as with .map(categories) in the notebook.
+    '''
+    return relabel(s, MANAGE_CATEGORIES.get, categories=MANAGE_CAT_ORDER)
+
+
+def natural_type(classes):
+    '''
+    (Series) -> Series
+
+    Returns 'Not Converted' for classes 1 - 6 and 'Converted' for every
+    other class, including missing ones.
+    '''
+    s = relabel(classes, lambda c: 'Not Converted' if c in NOT_CONVERTED_CLASSES
+                else 'Converted', categories=['Not Converted', 'Converted'])
+    return s.fillna('Converted')
+
+
+#############################################################################################
+###################################### HIERARCHIES ##########################################
+#############################################################################################
+
+class Hierarchy(object):
+    '''
+    Coarse-to-fine chain of categorical levels, e.g. CLASS -> MACROGROUP ->
+    GROUP.
+
+    Each level has an ordered CategoricalDtype. The coarsest level is
+    sorted by name (or a given order); every finer level is sorted by its
+    parent first, so code order follows the hierarchy. parents[level] maps
+    a level's codes to its parent's codes (-1 where a label has no parent).
+
+    Attributes:
+    levels -- Level (column) names, coarse to fine
+    dtypes -- Ordered CategoricalDtype of each level
+    parents -- Parent code array of each level but the first
+    '''
+
+    def __init__(self, levels, dtypes, parents):
+        self.levels = list(levels)
+        self.dtypes = dtypes
+        self.parents = parents
+
+    @classmethod
+    def from_table(cls, df, levels=NVC_LEVELS, order=None):
+        '''
+        (DataFrame, list, list) -> Hierarchy
+
+        Builds the hierarchy from the distinct level combinations of a
+        table. A finer label found under more than one parent is kept under
+        the first one in sort order.
+
+        Arguments:
+        df -- Attribute table or any frame with the level columns
+        levels -- Level columns, coarse to fine
+        order -- Optional order of the coarsest level's labels
+        '''
+        levels = list(levels)
+        dfLev = df[levels].drop_duplicates()
+        for col in levels:
+            if isinstance(dfLev[col].dtype, pd.CategoricalDtype):
+                dfLev[col] = dfLev[col].astype(object)
+        dtypes, parents = {}, {}
+        top = [v for v in pd.unique(dfLev[levels[0]].dropna())]
+        if order is None:
+            top = sorted(top)
+        else:
+            top = list(order) + sorted(v for v in top if v not in set(order))
+        dtypes[levels[0]] = pd.CategoricalDtype(top, ordered=True)
+
+        for parent, child in zip(levels[:-1], levels[1:]):
+            pairs = dfLev[[parent, child]].dropna(subset=[child]).drop_duplicates()
+            pcode = pd.Series(pd.Categorical(pairs[parent], dtype=dtypes[parent]).codes,
+                              index=pairs.index)
+            # Unparented labels sort last
+            pcode = pcode.where(pcode >= 0, len(dtypes[parent].categories))
+            pairs = pairs.assign(_p=pcode.to_numpy()).sort_values(['_p', child])
+            pairs = pairs.drop_duplicates(subset=[child])
+            dtypes[child] = pd.CategoricalDtype(list(pairs[child]), ordered=True)
+            p = pairs['_p'].to_numpy(dtype=np.int32)
+            p[p == len(dtypes[parent].categories)] = -1
+            parents[child] = p
+        return cls(levels, dtypes, parents)
+
+    def encode(self, df):
+        '''
+        (DataFrame) -> DataFrame
+
+        Returns a copy of df with every level column converted to its
+        ordered categorical. Labels not in the hierarchy become missing.
+        '''
+        df = df.copy()
+        for col in self.levels:
+            if col in df.columns:
+                df[col] = df[col].astype(object).astype(self.dtypes[col])
+        return df
+
+    def codes(self, s, level):
+        '''
+        (Series, str) -> ndarray
+
+        Returns the integer codes of a column at a level, -1 for missing.
+        '''
+        return np.asarray(pd.Categorical(s, dtype=self.dtypes[level]).codes, dtype=np.int32)
+
+    def rollup_codes(self, codes, level, to):
+        '''
+        (ndarray, str, str) -> ndarray
+
+        Maps codes of one level to the codes of a coarser level by following
+        the parent arrays, e.g. group codes to class codes.
+        '''
+        i, j = self.levels.index(level), self.levels.index(to)
+        if j > i:
+            raise ValueError('{0} is not coarser than {1}'.format(to, level))
+        codes = np.asarray(codes, dtype=np.int32)
+        for lev in self.levels[j + 1:i + 1][::-1]:
+            p = np.append(self.parents[lev], -1)
+            codes = p[codes]
+        return codes
+
+    def labels(self, level):
+        '''
+        (str) -> Index
+
+        Returns the ordered labels of a level.
+        '''
+        return self.dtypes[level].categories
+
+
+def encode_table(df, nvc=None, eco=None):
+    '''
+    (DataFrame, Hierarchy, Hierarchy) -> DataFrame
+
+    Returns a copy of the attribute table with the NVC and ecoregion levels,
+    GAPST_CD and MANG_NAME as categoricals and a ManageCat column. The
+    hierarchies are built from the table when not given.
+    '''
+    if nvc is None:
+        nvc = Hierarchy.from_table(df, [c for c in NVC_LEVELS if c in df.columns],
+                                   order=NVC_CLASSES)
+    if eco is None and all(c in df.columns for c in ECO_LEVELS):
+        eco = Hierarchy.from_table(df, ECO_LEVELS)
+    df = nvc.encode(df)
+    if eco is not None:
+        df = eco.encode(df)
+    if 'GAPST_CD' in df.columns:
+        df['GAPST_CD'] = pd.to_numeric(df['GAPST_CD'].astype(object),
+                                       errors='coerce').astype(GAP_STATUS_DTYPE)
+    if 'MANG_NAME' in df.columns:
+        df['MANG_NAME'] = to_categorical(df['MANG_NAME'])
+        df['ManageCat'] = manage_category(df['MANG_NAME'])
+    return df
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        outofcore.py
+
+        Builds the count cube of an attribute table larger than memory.
+
+        With L4 ecoregions and single PADUS units the attribute table no
+        longer fits in RAM for the notebook's drop_duplicates and groupby.
+        This engine runs the dedupe -> recode -> aggregate stages under a
+        memory ceiling on all cores, in two phases:
+
+            spill       the CSV is cut into byte ranges, one per worker.
+                        Each worker parses its range in chunks, hashes every
+                        row over all the analysis columns and writes the
+                        rows to one of P partitions (Parquet when pyarrow
+                        is installed, pickle otherwise). Equal rows hash
+                        alike, so all copies of a row land in the same
+                        partition.
+            aggregate   each worker loads one partition at a time, drops
+                        its duplicate rows (which is the global dedupe),
+                        applies the recode rules and sums COUNT (and
+                        AREA_KM2) over the cube dimensions. The partial
+                        sums are small; they are summed once more into the
+                        CountCube.
+
+        P and the chunk size are chosen so that every worker's share of
+        memoryMB holds one partition (or one chunk) as a pandas frame; the
+        ceiling covers the frames, not each process's interpreter. The
+        pivots and percentages are then taken from the cube as on the
+        in-memory path, so the outputs are the same.
+
+        In a batch manifest, "engine": "outofcore" with "memoryMB" (and
+        optionally "spillDir") selects this engine for the base cube.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import concurrent.futures
+import glob
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from .cellarea import AREA_COL
+from .cube import CUBE_DIMS, CountCube
+from .lookups import natural_type
+from .profiling import peak_rss_mb
+from .recode import apply_rules
+from .streaming import _row_hash
+from .vatcache import VAT_COLUMNS
+
+
+log = logging.getLogger(__name__)
+
+# In-memory size of a parsed frame relative to its CSV text (object columns)
+EXPANSION = 2.0
+
+# Chunks buffered by a spill worker before they are written out together
+FLUSH_CHUNKS = 4
+
+DEFAULT_MEMORY_MB = 2048
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------CSV Byte Ranges--------------------
+
+class _RangeFile(object):
+    '''
+    Read-only binary file limited to the bytes [start, end), for
+    pd.read_csv.
+    '''
+
+    def __init__(self, path, start, end):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.left = end - start
+
+    def read(self, size=-1):
+        if self.left <= 0:
+            return b''
+        if size is None or size < 0 or size > self.left:
+            size = self.left
+        data = self.f.read(size)
+        self.left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if self.left <= 0:
+            return b''
+        line = self.f.readline(self.left if size is None or size < 0 else min(size, self.left))
+        self.left -= len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self.f.close()
+
+
+def csv_ranges(csvPath, n):
+    '''
+    (str, int) -> list, int
+
+    Splits a CSV after its header into up to n byte ranges that start and
+    end on line breaks. Returns the (start, end) ranges and the header's
+    length in bytes.
+    '''
+    size = os.path.getsize(csvPath)
+    with open(csvPath, 'rb') as f:
+        header = len(f.readline())
+        cuts = [header]
+        for i in range(1, n):
+            pos = max(header + (size - header) * i // n, cuts[-1])
+            f.seek(pos)
+            f.readline()
+            cuts.append(min(f.tell(), size))
+        cuts.append(size)
+    ranges = [(a, b) for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+    return ranges, header
+
+
+def _read_header(csvPath):
+    with open(csvPath, newline='') as f:
+        return pd.read_csv(f, nrows=0).columns.tolist()
+
+
+def _has_parquet():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _write_part(df, path, parquet):
+    if parquet:
+        df.to_parquet(path + '.parquet', index=False)
+    else:
+        df.to_pickle(path + '.pkl')
+
+
+def _read_part(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+## --------------Phase 1: Spill--------------------
+
+def _spill_range(csvPath, rangeId, start, end, header, columns, nParts, spillDir, chunksize,
+                 parquet):
+    '''
+    Parses one byte range of the CSV in chunks and writes its rows to the
+    hash partitions. Returns rows read, the dtype kind of each column
+    ('f' when any chunk parsed it as float) and the peak RSS in MB.
+    '''
+    upper = [c.upper() for c in header]
+    use = [i for i, c in enumerate(upper) if c in set(columns)]
+    names = [upper[i] for i in use]
+    fh = _RangeFile(csvPath, start, end)
+    nRows, kinds = 0, {}
+    buffered, nFlushed = [], 0
+
+    def flush():
+        # One file per partition for all the buffered chunks
+        df = pd.concat([c for c, _ in buffered], ignore_index=True)
+        part = np.concatenate([p for _, p in buffered])
+        order = np.argsort(part, kind='stable')
+        bounds = np.searchsorted(part[order], np.arange(nParts + 1))
+        for p in np.flatnonzero(np.diff(bounds)):
+            _write_part(df.iloc[order[bounds[p]:bounds[p + 1]]],
+                        os.path.join(spillDir, 'p{0:05d}'.format(p),
+                                     'r{0:04d}-f{1:05d}'.format(rangeId, nFlushed)), parquet)
+        del buffered[:]
+
+    try:
+        reader = pd.read_csv(fh, header=None, names=[upper[i] for i in range(len(upper))],
+                             usecols=use, chunksize=chunksize)
+        for chunk in reader:
+            chunk = chunk[[n for n in columns if n in names]]
+            for col in chunk.columns:
+                # A float chunk makes the whole column float, as in one read_csv
+                if kinds.get(col) != 'f':
+                    kinds[col] = chunk[col].dtype.kind
+            buffered.append((chunk, (_row_hash(chunk) % np.uint64(nParts)).astype(np.int64)))
+            nRows += len(chunk)
+            if sum(len(c) for c, _ in buffered) >= chunksize * FLUSH_CHUNKS:
+                flush()
+                nFlushed += 1
+        if buffered:
+            flush()
+    finally:
+        fh.close()
+    return nRows, kinds, peak_rss_mb()
+
+
+## --------------Phase 2: Aggregate--------------------
+
+def _aggregate_partition(folder, dims, dedupe, rules):
+    '''
+    Loads one partition, drops its duplicate rows, applies the recode
+    rules and sums the count columns over the dimensions present. Returns
+    the partial sums (categoricals as plain labels), rows in and the peak
+    RSS in MB.
+    '''
+    files = sorted(glob.glob(os.path.join(folder, '*')))
+    df = pd.concat([_read_part(f) for f in files], ignore_index=True)
+    nIn = len(df)
+    if dedupe:
+        df = df.drop_duplicates()
+    if rules:
+        df = apply_rules(df, list(rules), counts=False).frame
+    keys = [d for d in dims if d in df.columns]
+    values = [c for c in ('COUNT', AREA_COL) if c in df.columns]
+    part = df.groupby(keys, dropna=False, observed=True, sort=False)[values].sum().reset_index()
+    for col in keys:
+        if isinstance(part[col].dtype, pd.CategoricalDtype):
+            part[col] = part[col].astype(object)
+    return part, nIn, peak_rss_mb()
+
+
+#############################################################################################
+####################################### ENGINE ##############################################
+#############################################################################################
+
+
+def plan_partitions(csvPath, memoryMB=DEFAULT_MEMORY_MB, workers=None, sampleBytes=1 << 20):
+    '''
+    (str, float, int, int) -> dict
+
+    Works out the number of workers, partitions and the chunk size that
+    keep every worker's frames within its share of memoryMB.
+
+    Arguments:
+    csvPath -- Attribute table CSV
+    memoryMB -- Memory ceiling of the whole run
+    workers -- Worker processes, all cores by default
+    sampleBytes -- Bytes read to estimate the size of a row
+    '''
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(csvPath)
+    with open(csvPath, 'rb') as f:
+        sample = f.read(sampleBytes)
+    rowBytes = max(1.0, len(sample) / max(1, sample.count(b'\n')))
+    budget = memoryMB * 2 ** 20 / workers
+    # An aggregating worker holds a partition frame plus its deduped copy
+    nParts = max(workers, int(math.ceil(size * EXPANSION * 2 / budget)))
+    # A spilling worker holds its buffered chunks, their concatenation and
+    # one more chunk being parsed
+    chunksize = max(1000, int(budget / (EXPANSION * rowBytes * (2 * FLUSH_CHUNKS + 2))))
+    return {'workers': workers, 'partitions': nParts, 'chunksize': chunksize,
+            'csvBytes': size, 'rowBytes': round(rowBytes, 1), 'memoryMB': memoryMB}
+
+
+def build_cube_out_of_core(csvPath, memoryMB=DEFAULT_MEMORY_MB, workers=None, spillDir=None,
+                           rules=None, dedupe=True, dims=CUBE_DIMS, columns=VAT_COLUMNS,
+                           addNaturalType=False, keepSpill=False, verbose=True):
+    '''
+    (str, float, int, str, list, bool, list, list, bool, bool, bool) -> CountCube
+
+    Returns the CountCube of an attribute table CSV without holding the
+    table in memory: the same cube as CountCube.from_table on the
+    notebook's deduped and recoded table.
+
+    Arguments:
+    csvPath -- Path to attribute_table.csv
+    memoryMB -- Memory ceiling of the run, shared by the workers
+    workers -- Worker processes, all cores by default
+    spillDir -- Folder for the partition files (on a disk with room for
+        the table), the CSV's folder by default. They go in a temporary
+        subfolder, removed afterwards unless keepSpill
+    rules -- Recode rules applied after the dedupe, e.g. TABLE_RULES
+    dedupe -- Drop duplicate rows over the analysis columns first
+    dims -- Cube dimensions
+    columns -- Analysis columns read from the CSV
+    addNaturalType -- Add the NaturalType dimension from CLASS
+    keepSpill -- Keep the partition files
+    verbose -- Print the plan and phase timings
+    '''
+    plan = plan_partitions(csvPath, memoryMB, workers)
+    columns = [c.upper() for c in columns]
+    if spillDir is not None:
+        os.makedirs(spillDir, exist_ok=True)
+    spillDir = tempfile.mkdtemp(prefix='vatspill-', dir=spillDir or os.path.dirname(
+        os.path.abspath(csvPath)))
+    for p in range(plan['partitions']):
+        os.makedirs(os.path.join(spillDir, 'p{0:05d}'.format(p)), exist_ok=True)
+    if verbose:
+        print('Out-of-core plan: {0}'.format(plan))
+
+    parquet = _has_parquet()
+    header = _read_header(csvPath)
+    ranges, _ = csv_ranges(csvPath, plan['workers'])
+    stats = {'plan': plan}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(plan['workers']) as pool:
+            t0 = time.perf_counter()
+            futures = [pool.submit(_spill_range, csvPath, i, a, b, header, columns,
+                                   plan['partitions'], spillDir, plan['chunksize'], parquet)
+                       for i, (a, b) in enumerate(ranges)]
+            spilled = [f.result() for f in futures]
+            stats['spill'] = {'seconds': round(time.perf_counter() - t0, 3),
+                              'rows': sum(r for r, _, _ in spilled),
+                              'peakRssMB': max(m for _, _, m in spilled)}
+
+            t0 = time.perf_counter()
+            cubeDims = [d for d in dims if d != 'NaturalType']
+            folders = sorted(glob.glob(os.path.join(spillDir, 'p*')))
+            parts = list(pool.map(_aggregate_partition, folders,
+                                  [cubeDims] * len(folders), [dedupe] * len(folders),
+                                  [rules] * len(folders)))
+            stats['aggregate'] = {'seconds': round(time.perf_counter() - t0, 3),
+                                  'rows': sum(n for _, n, _ in parts),
+                                  'peakRssMB': max(m for _, _, m in parts)}
+    finally:
+        if not keepSpill:
+            shutil.rmtree(spillDir, ignore_errors=True)
+
+    t0 = time.perf_counter()
+    dfParts = pd.concat([p for p, _, _ in parts], ignore_index=True)
+    keys = [d for d in cubeDims if d in dfParts.columns]
+    values = [c for c in ('COUNT', AREA_COL) if c in dfParts.columns]
+    dfSum = dfParts.groupby(keys, dropna=False, sort=False)[values].sum().reset_index()
+    for col in keys:
+        # Integer columns of every range come back as floats after a concat
+        # with a partition that had none of their rows
+        if all(k.get(col) in ('i', 'u') for _, k, _ in spilled) and \
+                dfSum[col].dtype.kind == 'f' and dfSum[col].notna().all():
+            dfSum[col] = dfSum[col].astype(np.int64)
+    if addNaturalType:
+        dfSum['NaturalType'] = natural_type(dfSum['CLASS'])
+    cube = CountCube.from_table(dfSum, dims)
+    stats['merge'] = {'seconds': round(time.perf_counter() - t0, 3), 'rows': len(dfParts),
+                      'cubeRows': len(cube)}
+    log.info('Out-of-core cube: %s', stats)
+    if verbose:
+        for phase in ('spill', 'aggregate', 'merge'):
+            print('{0:<10} {1}'.format(phase, stats[phase]))
+    cube.stats = stats
+    return cube
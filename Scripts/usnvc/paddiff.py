@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        paddiff.py
+
+        Change in protection between two PAD-US releases.
+
+        Reporting how protection changed from PAD-US 1.4 (padus1_4 in the
+        SQL scripts) to 2.1 used to take two full pipeline runs and a hand
+        join of their CSVs. diff_cubes takes the count cubes of the two
+        combines (or their attribute tables) and returns, per key (group,
+        class, manager, ecoregion ...):
+
+            protected cells and km2 before / after and their change
+            % protected before / after and the change in points
+            the percent-protected bin before / after and the 1 / 17 / 30 %
+            thresholds crossed, e.g. '+17' or '-1'
+
+        The two releases may have different label sets (new managers,
+        renamed ecoregions). Each cube's codes are mapped onto the union of
+        the labels, the packed keys of both cubes go through one np.unique
+        (the outer join) and one bincount sums the counts per key, release
+        and GAP status. Keys found in one release only are kept and marked.
+
+        As in the PAD pivots, cells without a GAP status are left out of the
+        totals.
+
+        Run from the Scripts folder:
+
+            python -m usnvc.paddiff padus14/attribute_table.csv \\
+                padus21/attribute_table.csv --labels 1.4 2.1 --out paddiff
+
+        Either input may also be a folder written by CountCube.save.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from .binning import EDGES_30, assign_bins, bin_labels
+from .cube import CountCube, pack_keys, unpack_keys
+from .lookups import CLASS_NUMBER, manage_category
+from .protection import CELL_KM2
+from .thresholds import STATUS_SETS
+
+
+# Key sets written by the command line diff
+DIFF_KEYS = {'Group': ['CLASS', 'GROUP'],
+             'Class': ['CLASS'],
+             'Manager': ['ManageCat'],
+             'Ecoregion': ['NA_L2NAME']}
+
+# Number of gains and losses listed per key set
+TOP_N = 20
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Label Alignment--------------------
+
+def _dim_labels(cube, dim, stripClass=True):
+    '''
+    Returns the cube dimension a key is read from and the key label of
+    each of its codes. ManageCat comes from MANG_NAME; CLASS loses its
+    number prefix so VAT and database class names match.
+    '''
+    if dim == 'ManageCat':
+        return 'MANG_NAME', manage_category(pd.Series(cube.labels['MANG_NAME'])) \
+            .astype(object).to_numpy()
+    if dim not in cube.dims:
+        raise KeyError('Not a cube dimension: {0}'.format(dim))
+    labels = np.asarray(cube.labels[dim], dtype=object)
+    if dim == 'CLASS' and stripClass:
+        labels = np.array([CLASS_NUMBER.sub('', c).strip() if isinstance(c, str) else c
+                           for c in labels], dtype=object)
+    return dim, labels
+
+
+def _union(*labelArrays):
+    '''
+    Sorted union of label arrays, missing values left out.
+    '''
+    vals = pd.unique(pd.Series(np.concatenate(labelArrays)).dropna())
+    try:
+        return pd.Index(sorted(vals))
+    except TypeError:
+        return pd.Index(vals)
+
+
+def _status_slots(cube):
+    '''
+    Slot 0 .. 3 for GAP status 1 .. 4 of each status code, 4 for anything
+    else, with one more entry for code -1 (missing).
+    '''
+    num = pd.to_numeric(pd.Series(cube.labels['GAPST_CD']), errors='coerce').to_numpy()
+    slots = np.where(np.isin(num, [1, 2, 3, 4]), np.nan_to_num(num) - 1, 4).astype(np.int64)
+    return np.append(slots, 4)
+
+
+def _as_cube(data):
+    if isinstance(data, CountCube):
+        return data
+    return CountCube.from_table(data)
+
+
+#############################################################################################
+######################################### DIFF ##############################################
+#############################################################################################
+
+
+def diff_cubes(before, after, by, statuses=(1, 2), labels=('Before', 'After'), edges=EDGES_30,
+               closed='right', stripClass=True, cellArea=CELL_KM2):
+    '''
+    (CountCube, CountCube, list, tuple, tuple, list, str, bool, float) -> DataFrame
+
+    Returns one row per key of either release with the protected cells,
+    km2 and percent before and after, their changes, the bins and the
+    thresholds crossed.
+
+    Arguments:
+    before, after -- CountCubes (or attribute tables) of the two releases
+    by -- Key dimensions, e.g. ['CLASS', 'GROUP']; ManageCat is derived
+        from MANG_NAME
+    statuses -- GAP status codes counted as protected, or a key of
+        STATUS_SETS
+    labels -- Release names used in the column names, e.g. ('1.4', '2.1')
+    edges -- Thresholds checked for crossings, also the bin edges
+    closed -- Bin closure, see usnvc.binning
+    stripClass -- Match class names with and without the number prefix
+    cellArea -- km2 per cell when a cube has no summed cell areas
+    '''
+    if isinstance(statuses, str):
+        statuses = STATUS_SETS[statuses]
+    by = [by] if isinstance(by, str) else list(by)
+    cubes = [_as_cube(before), _as_cube(after)]
+    b, a = labels
+
+    # Map both cubes' codes onto the union labels of every key dimension
+    dimLabels = [[_dim_labels(c, d, stripClass) for d in by] for c in cubes]
+    unions = [_union(dimLabels[0][i][1], dimLabels[1][i][1]) for i in range(len(by))]
+    radices = [len(u) for u in unions]
+    keys, sides, slots, counts, areas = [], [], [], [], []
+    for side, (cube, dl) in enumerate(zip(cubes, dimLabels)):
+        codes = []
+        for (src, lab), union in zip(dl, unions):
+            lut = np.append(union.get_indexer(lab), -1)
+            codes.append(lut[cube.codes[src]])
+        keep = np.all([c >= 0 for c in codes], axis=0) if codes else np.ones(len(cube), bool)
+        keys.append(pack_keys([c[keep] for c in codes], radices))
+        sides.append(np.full(keep.sum(), side, dtype=np.int64))
+        slots.append(_status_slots(cube)[cube.codes['GAPST_CD']][keep])
+        counts.append(np.asarray(cube.counts, dtype=np.float64)[keep])
+        areas.append(np.asarray(cube.areas, dtype=np.float64)[keep] if cube.areas is not None
+                     else counts[-1] * cellArea)
+
+    # Outer join: one unique over both releases' keys, one bincount per measure
+    uniq, inv = np.unique(np.concatenate(keys), return_inverse=True)
+    flat = (inv.ravel() * 2 + np.concatenate(sides)) * 5 + np.concatenate(slots)
+    size = len(uniq) * 10
+    cells = np.bincount(flat, np.concatenate(counts), size).reshape(len(uniq), 2, 5)
+    km2 = np.bincount(flat, np.concatenate(areas), size).reshape(len(uniq), 2, 5)
+
+    prot = np.array([s - 1 for s in statuses])
+    total = cells[:, :, :4].sum(axis=2)
+    protCells = cells[:, :, prot].sum(axis=2)
+    protKm2 = km2[:, :, prot].sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(total > 0, protCells / total * 100, np.nan)
+    present = total > 0
+
+    dfOut = pd.DataFrame({d: u.take(c) for d, u, c in zip(by, unions, unpack_keys(uniq, radices))})
+    dfOut['In'] = np.where(present.all(axis=1), 'both',
+                           np.where(present[:, 0], b + ' only', a + ' only'))
+    name = '% Protected ' + ' & '.join(', '.join(str(s) for s in statuses).rsplit(', ', 1))
+    for i, lab in enumerate(labels):
+        dfOut['Cells ' + lab] = np.rint(total[:, i]).astype(np.int64)
+    for i, lab in enumerate(labels):
+        dfOut['Protected Cells ' + lab] = np.rint(protCells[:, i]).astype(np.int64)
+    dfOut['Delta Cells'] = dfOut['Protected Cells ' + a] - dfOut['Protected Cells ' + b]
+    for i, lab in enumerate(labels):
+        dfOut['Protected km2 ' + lab] = protKm2[:, i]
+    dfOut['Delta km2'] = protKm2[:, 1] - protKm2[:, 0]
+    for i, lab in enumerate(labels):
+        dfOut['{0} {1}'.format(name, lab)] = pct[:, i]
+    dfOut['Delta pp'] = pct[:, 1] - pct[:, 0]
+
+    edges = list(edges)
+    binNames = np.array(bin_labels(edges) + [None], dtype=object)
+    for i, lab in enumerate(labels):
+        dfOut['Bin ' + lab] = binNames[assign_bins(pct[:, i], edges, closed)]
+    dfOut['Crossed'] = _crossings(pct[:, 0], pct[:, 1], edges)
+    return dfOut
+
+
+def _crossings(pctBefore, pctAfter, edges):
+    '''
+    Returns, per row, the thresholds crossed as '+17' (up) or '-30'
+    (down), space separated, '' when none. A threshold e is crossed when
+    the percent moves between <= e and > e.
+    '''
+    out = np.full(len(pctBefore), '', dtype=object)
+    both = ~(np.isnan(pctBefore) | np.isnan(pctAfter))
+    for e in edges:
+        above0 = pctBefore > e
+        above1 = pctAfter > e
+        tag = '{0:g}'.format(e)
+        up = both & ~above0 & above1
+        down = both & above0 & ~above1
+        out[up] = out[up] + ' +' + tag
+        out[down] = out[down] + ' -' + tag
+    return np.array([s.strip() for s in out], dtype=object)
+
+
+def rank_changes(dfDiff, column='Delta km2', n=TOP_N):
+    '''
+    (DataFrame, str, int) -> DataFrame, DataFrame
+
+    Returns the n biggest gains and the n biggest losses of a diff by one
+    of its change columns ('Delta km2', 'Delta Cells' or 'Delta pp').
+    '''
+    vals = dfDiff[column].to_numpy(dtype=np.float64)
+    vals = np.where(np.isnan(vals), 0, vals)
+    n = min(n, len(vals))
+    # argpartition picks the extremes without sorting the whole table
+    top = np.argpartition(-vals, n - 1)[:n] if n else np.array([], dtype=np.int64)
+    bottom = np.argpartition(vals, n - 1)[:n] if n else np.array([], dtype=np.int64)
+    gains = dfDiff.iloc[top[np.argsort(-vals[top], kind='stable')]]
+    losses = dfDiff.iloc[bottom[np.argsort(vals[bottom], kind='stable')]]
+    return gains[gains[column] > 0], losses[losses[column] < 0]
+
+
+def threshold_crossings(dfDiff):
+    '''
+    (DataFrame) -> DataFrame
+
+    Returns the rows of a diff that crossed one of the thresholds,
+    largest change in points first.
+    '''
+    dfX = dfDiff[dfDiff['Crossed'] != '']
+    return dfX.iloc[np.argsort(-dfX['Delta pp'].abs().to_numpy(), kind='stable')]
+
+
+#############################################################################################
+###################################### COMMAND LINE #########################################
+#############################################################################################
+
+
+def load_cube(source, cacheDir=None, verbose=True):
+    '''
+    (str, str, bool) -> CountCube
+
+    Loads a saved cube folder, or builds the cube of an attribute table
+    CSV (through usnvc.batch.build_base_cube).
+    '''
+    if os.path.isdir(source):
+        return CountCube.load(source, mmapMode=None)
+    from .batch import build_base_cube
+    return build_base_cube({'source': source, 'cacheDir': cacheDir}, verbose=verbose)
+
+
+def run_diff(before, after, outDir, keySets=DIFF_KEYS, statuses=(1, 2),
+             labels=('Before', 'After'), edges=EDGES_30, n=TOP_N, verbose=True):
+    '''
+    (CountCube, CountCube, str, dict, tuple, tuple, list, int, bool) -> dict
+
+    Writes PADDiff_<name>.csv, the gains, losses and threshold crossings
+    of every key set to outDir and returns the file names per key set.
+    '''
+    os.makedirs(outDir, exist_ok=True)
+    written = {}
+    for name, by in keySets.items():
+        t0 = time.perf_counter()
+        dfDiff = diff_cubes(before, after, by, statuses, labels, edges)
+        gains, losses = rank_changes(dfDiff, n=n)
+        files = []
+        for suffix, df in (('', dfDiff), ('_Gains', gains), ('_Losses', losses),
+                           ('_Crossings', threshold_crossings(dfDiff))):
+            files.append(os.path.join(outDir, 'PADDiff_{0}{1}.csv'.format(name, suffix)))
+            df.to_csv(files[-1], index=False)
+        written[name] = files
+        if verbose:
+            print('{0:<10} {1:>7} keys  {2:>5} crossed  {3:.2f} s'.format(
+                name, len(dfDiff), (dfDiff['Crossed'] != '').sum(), time.perf_counter() - t0))
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Protection change between PAD-US releases')
+    parser.add_argument('before', help='Attribute table CSV or saved cube folder')
+    parser.add_argument('after', help='Attribute table CSV or saved cube folder')
+    parser.add_argument('--labels', nargs=2, default=['Before', 'After'],
+                        help='Release names, e.g. 1.4 2.1')
+    parser.add_argument('--out', default='paddiff', help='Output folder')
+    parser.add_argument('--statuses', nargs='+', type=int, default=[1, 2])
+    parser.add_argument('--edges', nargs='+', type=float, default=list(EDGES_30))
+    parser.add_argument('--top', type=int, default=TOP_N, help='Gains and losses listed')
+    parser.add_argument('--cache-dir', nargs=2, default=[None, None],
+                        help='Columnar caches of the two CSVs')
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    before = load_cube(args.before, args.cache_dir[0])
+    after = load_cube(args.after, args.cache_dir[1])
+    print('Loaded {0} and {1} in {2:.1f} s'.format(before, after, time.perf_counter() - t0))
+    run_diff(before, after, args.out, DIFF_KEYS, tuple(args.statuses), tuple(args.labels),
+             args.edges, args.top)
+
+
+if __name__ == '__main__':
+    main()
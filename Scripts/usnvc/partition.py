@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        partition.py
+
+        Attribute table stored clustered by ecoregion, with offset indexes
+        for fast subset queries.
+
+        Analyses of one L4 or L3 ecoregion or one PADUS unit used to filter
+        the whole table with a boolean mask each time. PartitionedTable
+        writes the table once with its rows sorted by the L4 ecoregion
+        code, in the order of a usnvc.lookups.Hierarchy over
+        NA_L2CODE -> US_L3CODE -> US_L4CODE. That order sorts every L4 by
+        its L3 and every L3 by its L2, so:
+
+            L4 ecoregion    one partition, rows offsets[i]:offsets[i + 1]
+            L3 / L2         a run of neighbouring partitions, one slice
+            PADUS unit      rows listed by a secondary permutation index
+                            (units are sorted within each partition, so
+                            a unit's rows sit close together)
+
+        Rows with no L4 code keep their coarser codes: every L3 has a
+        partition for its rows with no L4 code, placed after its L4
+        partitions, every L2 one for its rows with no L3 code, and a last
+        partition holds the rows with no code at all. An L3 or L2 query
+        and roll-up therefore count every row that has that code.
+
+        A query reads only the rows it returns from the memory-mapped
+        column files. Roll-ups build a cube over the partitions once per
+        set of dimensions; L3 and L2 totals use the codes of each
+        partition at that level and sum that cube, without going back to
+        the rows.
+
+        Columns are stored as in usnvc.vatcache: one .npy per column,
+        string columns as int32 codes with their labels in the manifest.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from .cellarea import AREA_COL
+from .cube import CountCube, encode_column, group_sum
+from .lookups import ECO_CODE_LEVELS, Hierarchy
+
+
+# PADUS unit column of the attribute table
+UNIT_COL = 'PADUS2_1DISS6ATT'
+
+# Bump this when the on-disk layout changes
+PARTITION_VERSION = 2
+
+MANIFEST = 'manifest.json'
+
+
+#############################################################################################
+################################### PARTITIONED TABLE #######################################
+#############################################################################################
+
+class PartitionedTable(object):
+    '''
+    Attribute table sorted into ecoregion partitions on disk.
+
+    Attributes:
+    folder -- Folder holding the layout
+    hierarchy -- Hierarchy of the ecoregion code levels, coarse to fine
+    levels -- Level columns, coarse to fine; the last one partitions
+    unit -- PADUS unit column with the secondary index
+    partCodes -- Code of every partition at each level (-1 below the
+        level its rows stop at), shape (partitions, levels)
+    offsets -- Row offsets of the partitions, len = partitions + 1
+    unitLabels -- Labels of the unit index
+    unitOffsets -- Offsets into unitRows, one segment per unit
+    unitRows -- Row numbers sorted by unit
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != PARTITION_VERSION:
+            raise ValueError('Partition layout in {0} is out of date'.format(folder))
+        with open(os.path.join(folder, 'index.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+        self.hierarchy = meta['hierarchy']
+        self.levels = list(self.hierarchy.levels)
+        self.partCodes = meta['partCodes']
+        self.unit = meta['unit']
+        self.unitLabels = meta['unitLabels']
+        self.offsets = np.load(os.path.join(folder, 'offsets.npy'))
+        self.unitOffsets = np.load(os.path.join(folder, 'unitoffsets.npy'))
+        self.unitRows = np.load(os.path.join(folder, 'unitrows.npy'), mmap_mode='r')
+        self.columns = {c['name']: c for c in self.manifest['columns']}
+        self._arrays = {}
+        self._cubes = {}
+
+    ## --------------Building--------------------
+
+    @classmethod
+    def from_table(cls, df, folder, levels=ECO_CODE_LEVELS, unit=UNIT_COL):
+        '''
+        (DataFrame, str, list, str) -> PartitionedTable
+
+        Sorts the table by ecoregion partition (then PADUS unit), writes it
+        to a folder with the partition and unit indexes and opens it. A row
+        goes to the partition of its finest ecoregion code.
+
+        Arguments:
+        df -- Attribute table (dfTable) with the level and unit columns
+        folder -- Output folder
+        levels -- Ecoregion code columns, coarse to fine
+        unit -- PADUS unit column
+        '''
+        levels = list(levels)
+        hier = Hierarchy.from_table(df, levels)
+        partCodes, lookup = _partition_paths(hier)
+        nParts = len(partCodes)
+        # Finest code present wins; rows with none go to the last partition
+        part = np.full(len(df), nParts - 1, dtype=np.int64)
+        done = np.zeros(len(df), dtype=bool)
+        for lev in levels[::-1]:
+            c = hier.codes(df[lev], lev)
+            m = (c >= 0) & ~done
+            part[m] = lookup[lev][c[m]]
+            done |= m
+
+        unitCodes, unitLabels = encode_column(df[unit])
+        unitCodes = unitCodes.astype(np.int64)
+        unitCodes[unitCodes < 0] = len(unitLabels)
+        order = np.lexsort((unitCodes, part))
+        offsets = np.searchsorted(part[order], np.arange(nParts + 1))
+
+        sortedUnits = unitCodes[order]
+        unitRows = np.argsort(sortedUnits, kind='stable')
+        unitOffsets = np.searchsorted(sortedUnits[unitRows], np.arange(len(unitLabels) + 1))
+
+        os.makedirs(folder, exist_ok=True)
+        colInfo = []
+        for col in df.columns:
+            s = df[col]
+            fname = '{0}.npy'.format(len(colInfo))
+            if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+                np.save(os.path.join(folder, fname), s.to_numpy()[order])
+                colInfo.append({'name': col, 'file': fname, 'kind': 'numeric'})
+            else:
+                codes, labels = encode_column(s)
+                np.save(os.path.join(folder, fname), codes[order])
+                colInfo.append({'name': col, 'file': fname, 'kind': 'category',
+                                'categories': [str(x) for x in labels]})
+        np.save(os.path.join(folder, 'offsets.npy'), offsets)
+        np.save(os.path.join(folder, 'unitoffsets.npy'), unitOffsets)
+        np.save(os.path.join(folder, 'unitrows.npy'), unitRows)
+        with open(os.path.join(folder, 'index.pkl'), 'wb') as f:
+            pickle.dump({'hierarchy': hier, 'partCodes': partCodes, 'unit': unit,
+                         'unitLabels': unitLabels}, f)
+
+        manifest = {'version': PARTITION_VERSION, 'nrows': len(df), 'levels': levels,
+                    'unit': unit, 'partitions': nParts, 'columns': colInfo}
+        # Write the manifest last so a half-written layout is never opened
+        tmp = os.path.join(folder, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(folder, MANIFEST))
+        return cls(folder)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __repr__(self):
+        return 'PartitionedTable({0} rows; {1} partitions; {2} units)'.format(
+            len(self), len(self.offsets) - 1, len(self.unitLabels))
+
+    ## --------------Columns--------------------
+
+    def _array(self, col):
+        if col not in self._arrays:
+            info = self.columns[col]
+            self._arrays[col] = np.load(os.path.join(self.folder, info['file']), mmap_mode='r')
+        return self._arrays[col]
+
+    def _frame(self, take, columns=None):
+        '''
+        Builds a frame from the rows picked by take(array) in every column.
+        '''
+        columns = list(self.columns) if columns is None else list(columns)
+        data = {}
+        for col in columns:
+            arr = take(self._array(col))
+            info = self.columns[col]
+            if info['kind'] == 'category':
+                data[col] = pd.Categorical.from_codes(arr, categories=info['categories'])
+            else:
+                data[col] = arr
+        return pd.DataFrame(data, columns=columns)
+
+    ## --------------Partitions--------------------
+
+    def _part_codes(self, level):
+        '''
+        Code at a level of every partition (-1 where its rows have none).
+        '''
+        return self.partCodes[:, self.levels.index(level)]
+
+    def partitions(self, level, keys):
+        '''
+        (str, list) -> ndarray
+
+        Returns the partitions of the given ecoregions, including those of
+        their rows with no finer code.
+
+        Arguments:
+        level -- One of the level columns, e.g. 'US_L3CODE'
+        keys -- Label or list of labels at that level
+        '''
+        if level not in self.levels:
+            raise KeyError('{0} is not a partition level {1}'.format(level, self.levels))
+        keys = [keys] if np.isscalar(keys) else list(keys)
+        codes = self.hierarchy.labels(level).get_indexer(keys)
+        codes = codes[codes >= 0]
+        return np.flatnonzero(np.isin(self._part_codes(level), codes))
+
+    def ranges(self, level, keys):
+        '''
+        (str, list) -> list
+
+        Returns the (start, stop) row ranges of the given ecoregions, with
+        neighbouring partitions merged, so one L3 or L2 is usually a
+        single range.
+        '''
+        parts = self.partitions(level, keys)
+        out = []
+        for a, b in zip(self.offsets[parts], self.offsets[parts + 1]):
+            if a == b:
+                continue
+            if out and out[-1][1] == a:
+                out[-1] = (out[-1][0], int(b))
+            else:
+                out.append((int(a), int(b)))
+        return out
+
+    ## --------------Queries--------------------
+
+    def rows(self, level, keys, columns=None):
+        '''
+        (str, list, list) -> DataFrame
+
+        Returns the rows of one or more ecoregions by slicing their
+        partitions; the cost is the number of rows returned.
+
+        Arguments:
+        level -- Level column, e.g. 'US_L4CODE', 'US_L3CODE' or 'NA_L2CODE'
+        keys -- Label or list of labels at that level
+        columns -- Columns to read, all when None
+        '''
+        spans = self.ranges(level, keys)
+
+        def take(arr):
+            if len(spans) == 1:
+                return np.asarray(arr[spans[0][0]:spans[0][1]])
+            return np.concatenate([arr[a:b] for a, b in spans] or [arr[:0]])
+        return self._frame(take, columns)
+
+    def unit_rows(self, units, columns=None):
+        '''
+        (list, list) -> DataFrame
+
+        Returns the rows of one or more PADUS units through the unit index.
+
+        Arguments:
+        units -- Unit value or list of values of the unit column
+        columns -- Columns to read, all when None
+        '''
+        units = [units] if np.isscalar(units) else list(units)
+        codes = self.unitLabels.get_indexer(units)
+        codes = np.sort(codes[codes >= 0])
+        idx = np.concatenate([self.unitRows[self.unitOffsets[c]:self.unitOffsets[c + 1]]
+                              for c in codes] or [np.empty(0, dtype=np.int64)])
+        idx.sort()
+        return self._frame(lambda arr: arr[idx], columns)
+
+    ## --------------Roll-ups--------------------
+
+    def cube(self, dims):
+        '''
+        (list) -> CountCube
+
+        Returns the cube of COUNT (and AREA_KM2) over the ecoregion levels
+        and the given dimensions. It is built once per set of dimensions
+        from the partition offsets and kept for later roll-ups; its level
+        codes are those of the partitions.
+        '''
+        dims = [d for d in dims if d not in self.levels]
+        key = tuple(dims)
+        if key in self._cubes:
+            return self._cubes[key]
+
+        nParts = len(self.offsets) - 1
+        part = np.repeat(np.arange(nParts, dtype=np.int32), np.diff(self.offsets))
+        codeArrays, labels = [part], {}
+        for d in dims:
+            info = self.columns[d]
+            if info['kind'] == 'category':
+                codeArrays.append(np.asarray(self._array(d)))
+                labels[d] = pd.Index(info['categories'])
+            else:
+                c, lab = encode_column(pd.Series(np.asarray(self._array(d))))
+                codeArrays.append(c)
+                labels[d] = lab
+        radices = [nParts] + [len(labels[d]) for d in dims]
+        counts = np.asarray(self._array('COUNT'))
+        areas = None
+        if AREA_COL in self.columns:
+            measures = np.column_stack([counts.astype(np.float64),
+                                        np.asarray(self._array(AREA_COL), dtype=np.float64)])
+            cubeCodes, sums = group_sum(codeArrays, radices, measures)
+            sums, areas = sums[:, 0], sums[:, 1]
+        else:
+            cubeCodes, sums = group_sum(codeArrays, radices, counts.astype(np.float64))
+        if counts.dtype.kind in 'iub':
+            sums = np.rint(sums).astype(np.int64)
+        codes = dict(zip(dims, cubeCodes[1:]))
+        for i, lev in enumerate(self.levels):
+            codes[lev] = self.partCodes[:, i][cubeCodes[0]]
+            labels[lev] = self.hierarchy.labels(lev)
+        cube = CountCube(self.levels + dims, codes, labels, sums, 'COUNT', areas)
+        self._cubes[key] = cube
+        return cube
+
+    def rollup(self, by, where=None, exclude=None, dropna=True):
+        '''
+        (list, dict, dict, bool) -> DataFrame
+
+        Sums COUNT over the by columns, as CountCube.rollup. Every
+        ecoregion level comes from the same partition cube, so rolling up
+        to L3 or L2 reuses the L4 sums, and rows with no L4 (or L3) code
+        still count towards their L3 (or L2).
+
+        Arguments:
+        by -- Columns to keep, ecoregion levels and any stored column
+        where -- Optional filters, see CountCube.slice
+        exclude -- Optional exclusions, see CountCube.slice
+        dropna -- Drop combinations where any key is missing
+        '''
+        by = [by] if isinstance(by, str) else list(by)
+        used = by + list(where or {}) + list(exclude or {})
+        return self.cube([d for d in used if d not in self.levels]).rollup(
+            by, where, exclude, dropna)
+
+
+def _partition_paths(hier):
+    '''
+    (Hierarchy) -> ndarray, dict
+
+    Lays out the partitions of a hierarchy: one for every label of every
+    level, holding the rows whose finest code is that label, plus one for
+    rows with no code. Returns the code of each partition at every level,
+    in partition order (sorted by path, missing codes last, so each label
+    is followed by its children and its own partition), and for each level
+    the partition of each of its codes.
+    '''
+    levels = hier.levels
+    paths, owner = [], []
+    for k, lev in enumerate(levels):
+        c = np.arange(len(hier.labels(lev)), dtype=np.int32)
+        cols = [hier.rollup_codes(c, lev, levels[j]) for j in range(k)] + [c]
+        cols += [np.full(len(c), -1, dtype=np.int32)] * (len(levels) - k - 1)
+        paths.append(np.column_stack(cols))
+        owner.append(np.full(len(c), k))
+    paths.append(np.full((1, len(levels)), -1, dtype=np.int32))
+    owner.append(np.array([-1]))
+    paths, owner = np.concatenate(paths), np.concatenate(owner)
+
+    keys = np.where(paths < 0, np.iinfo(np.int32).max, paths)
+    order = np.lexsort(keys.T[::-1])
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    lookup = {lev: rank[owner == k] for k, lev in enumerate(levels)}
+    return paths[order], lookup
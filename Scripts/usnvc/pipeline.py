@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        pipeline.py
+
+        Incremental recompute of the protection analyses.
+
+        The analyses run as a chain of stages (load -> recode -> aggregate
+        -> pivot -> bin -> plot). Each stage gets a fingerprint made from its
+        code, its parameters, the files it reads and the fingerprints of the
+        stages it depends on. A stage result is cached under that
+        fingerprint. A run starts from the stages asked for (by default the
+        last ones, here plot) and walks back only as far as the first
+        cached result on each path: a warm run loads the plot stage's list
+        of files and nothing else, and a change to the bin edges loads the
+        cached pivots and recomputes bin and plot.
+
+        Stages whose result is the whole attribute table are not pickled
+        (cache=False). load keeps the table in the columnar usnvc.vatcache
+        (parsed and deduplicated once, memory-mapped afterwards), and recode
+        is recomputed from it on the rare runs that need it, so the table is
+        stored once and never read back from a pickle.
+
+        The code part covers the stage function and the source files of the
+        usnvc modules it uses, followed through their relative imports, so
+        a change to pad_pivot or CountCube invalidates the stages that
+        call them. PIPELINE_VERSION can be bumped to invalidate everything.
+
+        A stage that writes files (outputs=True) returns their paths. Their
+        sizes and modification times are recorded with the cached result,
+        and the stage is rerun when any of them is deleted or edited.
+
+        A new PAD-US release changes the attribute table itself, so load and
+        everything after it rerun; the raster combine that produces the
+        table is where a release is incremental (see below). A change to
+        only the bin edges reruns bin and plot. Every run prints which
+        stages were reused and how long each took.
+
+        Raster tiles get the same treatment in rastercount.combine_rasters
+        through its content-addressed tileCacheDir.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import sys
+import time
+
+from .binning import EDGES_30, bin_protection
+from .cube import CountCube
+from .lookups import NATURAL_CLASSES, strip_class_number
+from .protection import add_protection_columns, pad_pivot
+from .recode import TABLE_RULES, apply_rules
+from .vatcache import VAT_COLUMNS, file_hash, load_attribute_table
+
+
+#############################################################################################
+##################################### FINGERPRINTS ##########################################
+#############################################################################################
+
+
+def _hash(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(repr(p).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+# Bump to invalidate every cached stage result
+PIPELINE_VERSION = 2
+
+
+def _code_fingerprint(func):
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = getattr(func, '__qualname__', repr(func))
+    return source, [(m, file_hash(path)) for m, path in _helper_modules(func)]
+
+
+def _module_file(name):
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return getattr(mod, '__file__', None)
+    spec = importlib.util.find_spec(name)
+    return spec.origin if spec is not None else None
+
+
+def _helper_modules(func):
+    '''
+    Returns (module name, source file) of every package module a function
+    uses: the modules of the package objects it names (including modules
+    imported inside it), then everything those import relatively.
+    '''
+    pkg = __name__.rpartition('.')[0]
+    own = getattr(func, '__module__', None)
+    names = set(getattr(getattr(func, '__code__', None), 'co_names', ()))
+    g = getattr(func, '__globals__', {})
+    todo = []
+    for n in names:
+        obj = g.get(n)
+        mod = getattr(obj, '__module__', None) if obj is not None else '{0}.{1}'.format(pkg, n)
+        if mod and mod.startswith(pkg + '.') and mod != own:
+            todo.append(mod)
+
+    found = {}
+    while todo:
+        mod = todo.pop()
+        if mod in found:
+            continue
+        path = _module_file(mod) if mod.count('.') == pkg.count('.') + 1 else None
+        if path is None or not path.endswith('.py'):
+            continue
+        found[mod] = path
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.level == 1:
+                if node.module:
+                    todo.append('{0}.{1}'.format(pkg, node.module))
+                else:
+                    todo.extend('{0}.{1}'.format(pkg, a.name) for a in node.names)
+    return sorted(found.items())
+
+
+class FileFingerprints(object):
+    '''
+    Content hashes of input files, remembered by size and modification time
+    so an unchanged file is not re-read on every run.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.known = json.load(f)
+        except (OSError, ValueError):
+            self.known = {}
+
+    def __call__(self, filePath):
+        filePath = os.path.abspath(filePath)
+        st = os.stat(filePath)
+        entry = self.known.get(filePath)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry['sha1']
+        sha1 = file_hash(filePath)
+        self.known[filePath] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1}
+        with open(self.path, 'w') as f:
+            json.dump(self.known, f)
+        return sha1
+
+
+#############################################################################################
+####################################### PIPELINE ############################################
+#############################################################################################
+
+class Stage(object):
+    '''
+    One step of a Pipeline.
+
+    Attributes:
+    name -- Stage name, unique in the pipeline
+    func -- Called as func(*depResults, **params)
+    deps -- Names of the stages whose results are passed to func
+    params -- Keyword arguments for func; part of the fingerprint
+    files -- Input files; their content hashes are part of the fingerprint
+    outputs -- Whether func writes files and returns their paths
+    cache -- Whether the result is pickled; False for stages that are
+        cheap to recompute or keep their own cache
+    '''
+
+    def __init__(self, name, func, deps=(), params=None, files=(), outputs=False, cache=True):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.params = dict(params or {})
+        self.files = list(files)
+        self.outputs = outputs
+        self.cache = cache
+
+
+class Pipeline(object):
+    '''
+    Stages with fingerprint-keyed result caching, see the module notes.
+    '''
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        os.makedirs(cacheDir, exist_ok=True)
+        self.stages = {}
+        self.order = []
+        self.files = FileFingerprints(os.path.join(cacheDir, 'files.json'))
+        self.report = []
+
+    def stage(self, name, func, deps=(), params=None, files=(), outputs=False, cache=True):
+        '''
+        (str, function, list, dict, list, bool, bool) -> Stage
+
+        Adds a stage. Dependencies must be added first. With outputs the
+        stage returns the paths of the files it writes; without cache its
+        result is never pickled. See the module notes.
+        '''
+        for d in deps:
+            if d not in self.stages:
+                raise ValueError('Stage {0} depends on unknown stage {1}'.format(name, d))
+        st = Stage(name, func, deps, params, files, outputs, cache)
+        self.stages[name] = st
+        self.order.append(name)
+        return st
+
+    def final_stages(self):
+        '''
+        () -> list
+
+        Returns the stages no other stage depends on, in order.
+        '''
+        used = set(d for st in self.stages.values() for d in st.deps)
+        return [name for name in self.order if name not in used]
+
+    ## --------------Fingerprints--------------------
+
+    def fingerprints(self):
+        '''
+        () -> dict
+
+        Returns the current fingerprint of every stage.
+        '''
+        fps = {}
+        for name in self.order:
+            st = self.stages[name]
+            fps[name] = _hash(PIPELINE_VERSION, name, _code_fingerprint(st.func),
+                              sorted(st.params.items()),
+                              [self.files(f) for f in st.files],
+                              [fps[d] for d in st.deps])
+        return fps
+
+    def _cache_path(self, name, fp):
+        return os.path.join(self.cacheDir, '{0}-{1}.pkl'.format(name, fp[:16]))
+
+    @staticmethod
+    def _output_stats(paths):
+        # Size and modification time of each output file, None when missing
+        stats = {}
+        for p in paths:
+            try:
+                st = os.stat(p)
+                stats[p] = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                stats[p] = None
+        return stats
+
+    def _outputs_intact(self, path):
+        try:
+            with open(path + '.outputs.json') as f:
+                recorded = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return self._output_stats(list(recorded)) == recorded
+
+    ## --------------Running--------------------
+
+    def run(self, targets=None, force=()):
+        '''
+        (list, list) -> dict
+
+        Brings the target stages (final_stages when None) up to date and
+        returns their results by name. A stage is loaded from the cache when
+        its fingerprint is unchanged, otherwise it is recomputed from its
+        dependencies, which are resolved the same way; stages no target
+        needs are not touched. Prints one line per stage touched.
+
+        Arguments:
+        targets -- Stage names to return
+        force -- Stage names to recompute even if cached
+        '''
+        targets = list(self.final_stages() if targets is None else targets)
+        fps = self.fingerprints()
+        results = {}
+        self.report = []
+
+        def resolve(name):
+            if name in results:
+                return results[name]
+            st = self.stages[name]
+            path = self._cache_path(name, fps[name])
+            t0 = time.perf_counter()
+            if st.cache and name not in force and os.path.exists(path) and \
+                    (not st.outputs or self._outputs_intact(path)):
+                with open(path, 'rb') as f:
+                    results[name] = pickle.load(f)
+                self.report.append({'stage': name, 'status': 'reused',
+                                    'seconds': time.perf_counter() - t0})
+                return results[name]
+            args = [resolve(d) for d in st.deps]
+            t0 = time.perf_counter()
+            results[name] = st.func(*args, **st.params)
+            secs = time.perf_counter() - t0
+            self.report.append({'stage': name, 'status': 'computed', 'seconds': secs})
+            if not st.cache:
+                return results[name]
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(results[name], f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            if st.outputs:
+                with open(path + '.outputs.json', 'w') as f:
+                    json.dump(self._output_stats(results[name]), f)
+            self._prune(name, path)
+            return results[name]
+
+        for name in targets:
+            resolve(name)
+        self.print_report()
+        return {name: results[name] for name in targets}
+
+    def _prune(self, name, keep):
+        # Drop cached results of earlier fingerprints of the same stage
+        prefix = name + '-'
+        for fname in os.listdir(self.cacheDir):
+            path = os.path.join(self.cacheDir, fname)
+            if fname.startswith(prefix) and not path.startswith(keep) and \
+                    (fname.endswith('.pkl') or fname.endswith('.outputs.json')):
+                os.remove(path)
+
+    def print_report(self):
+        '''
+        Prints which stages were reused or computed and their timings.
+        '''
+        print('+' * 45)
+        for r in self.report:
+            print('  {0:<12} {1:<9} {2:8.3f} s'.format(r['stage'], r['status'], r['seconds']))
+        print('+' * 45)
+
+
+#############################################################################################
+################################ PROTECTION ANALYSES ########################################
+#############################################################################################
+
+
+## --------------Stage Functions--------------------
+
+def load_stage(csvPath, vatCacheDir, columns=tuple(VAT_COLUMNS)):
+    # Parsed and deduplicated once into the columnar cache, memory-mapped after
+    return load_attribute_table(csvPath, vatCacheDir, list(columns))
+
+
+def recode_stage(dfTable, rules=tuple(TABLE_RULES)):
+    # Group codes with two names and the 'UPPER GILA MOUNTAINS (?)' fix from the notebook
+    return apply_rules(dfTable, list(rules), verbose=True).frame
+
+
+def aggregate_stage(dfTable):
+    return CountCube.from_table(dfTable)
+
+
+def pivot_stage(cube, naturalClasses=tuple(NATURAL_CLASSES)):
+    # Group pivot over all classes, with the class number prefix removed
+    dfSum = cube.rollup(['GAPST_CD', 'CLASS', 'GROUP', 'GROUP_CODE'])
+    dfSum['CLASS'] = strip_class_number(dfSum['CLASS'])
+    dfGroup = add_protection_columns(pad_pivot(dfSum, ['CLASS', 'GROUP', 'GROUP_CODE']))
+
+    # Ecoregion x group pivot over natural, non-Ruderal groups
+    ruderal = [g for g in cube.labels['GROUP'] if 'Ruderal' in str(g)]
+    dfEco = cube.rollup(['GAPST_CD', 'NA_L2NAME', 'GROUP'],
+                        where={'CLASS': list(naturalClasses)}, exclude={'GROUP': ruderal})
+    dfEcoGroup = add_protection_columns(pad_pivot(dfEco, ['NA_L2NAME', 'GROUP']))
+    return {'group': dfGroup, 'ecoGroup': dfEcoGroup}
+
+
+def bin_stage(pivots, edges=EDGES_30):
+    dfBins = bin_protection(pivots['ecoGroup'], by='NA_L2NAME', edges=list(edges),
+                            closed='right', total=None)
+    return dfBins.sort_values('NA_L2NAME').set_index('NA_L2NAME')
+
+
+def plot_stage(pivots, dfBins, outDir):
+    # Outputs are written here; the cached result is the list of files
+    os.makedirs(outDir, exist_ok=True)
+    written = [os.path.join(outDir, 'GroupPercentProtected.csv'),
+               os.path.join(outDir, 'GroupPercentProtectedbyEcoregion.csv')]
+    pivots['group'].to_csv(written[0], index=False)
+    dfBins.to_csv(written[1])
+
+    from .plots import plot_ecoregion_bins
+    written.append(os.path.join(outDir, 'GroupPercentProtectedbyEcoregion.png'))
+    plot_ecoregion_bins(dfBins, written[-1])
+    return written
+
+
+## --------------Building the Pipeline--------------------
+
+def protection_pipeline(csvPath, outDir, cacheDir=None, edges=EDGES_30, rules=TABLE_RULES):
+    '''
+    (str, str, str, list, list) -> Pipeline
+
+    Returns the load -> recode -> aggregate -> pivot -> bin -> plot
+    pipeline for the group and ecoregion protection outputs. The
+    attribute table is kept in a columnar cache under cacheDir/vat.
+
+    Arguments:
+    csvPath -- Path to attribute_table.csv
+    outDir -- Folder for the CSV and figure outputs
+    cacheDir -- Folder for cached stage results, defaults to
+        <outDir>/.pipeline
+    edges -- Interior bin edges of the ecoregion protection bins
+    rules -- Recode rules applied after dedupe, see usnvc.recode
+    '''
+    if cacheDir is None:
+        cacheDir = os.path.join(outDir, '.pipeline')
+    p = Pipeline(cacheDir)
+    p.stage('load', load_stage, files=[csvPath], cache=False,
+            params={'csvPath': os.path.abspath(csvPath),
+                    'vatCacheDir': os.path.abspath(os.path.join(cacheDir, 'vat'))})
+    p.stage('recode', recode_stage, ['load'], params={'rules': tuple(rules)}, cache=False)
+    p.stage('aggregate', aggregate_stage, ['recode'])
+    p.stage('pivot', pivot_stage, ['aggregate'])
+    p.stage('bin', bin_stage, ['pivot'], params={'edges': tuple(edges)})
+    p.stage('plot', plot_stage, ['pivot', 'bin'], params={'outDir': os.path.abspath(outDir)},
+            outputs=True)
+    return p
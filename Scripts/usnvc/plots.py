@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        plots.py
+
+        Charts of the protection analyses.
+
+        matplotlib, seaborn and bokeh are imported inside the functions, so
+        importing usnvc never loads them. With show=False nothing opens a
+        window: matplotlib is switched to the Agg backend (unless pyplot is
+        already in use) and the figures are only saved, so batch runs work
+        on machines without a display. For many charts at once, usnvc.render
+        has faster headless templates of the same charts.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import sys
+
+from .lookups import DB_NATURAL_CLASSES
+
+
+# Abbreviated class names on the x axes
+CLASS_ABBREVIATIONS = ['F & W', 'S & H', 'D & SD', 'PHMS', 'ORV']
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+def pyplot(show=False):
+    '''
+    (bool) -> module
+
+    Returns matplotlib.pyplot, on the non-interactive Agg backend for
+    headless runs.
+    '''
+    if not show and 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _finish(fig, path, show):
+    plt = pyplot(show)
+    if path:
+        fig.savefig(path, dpi=150, bbox_inches='tight')
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
+    return fig
+
+
+## --------------NVC Summarization Charts--------------------
+
+def plot_class_boxplot(dfPivot, path=None, show=False, classes=DB_NATURAL_CLASSES,
+                       by='NVCClass'):
+    '''
+    (DataFrame, str, bool, list, str) -> Figure
+
+    Box plot of the groups' '% Protected 1 & 2' and '% Protected 1, 2 & 3'
+    for each natural class.
+    '''
+    plt = pyplot(show)
+    import seaborn as sns
+
+    dfNat = dfPivot[dfPivot[by].isin(classes)]
+    dfMelt = dfNat.melt(id_vars=by, value_vars=['% Protected 1 & 2', '% Protected 1, 2 & 3'],
+                        var_name='Percent Protected', value_name='Percent of Mapped Area')
+    fig, ax = plt.subplots(figsize=(12, 6))
+    plt.xticks(rotation=45)
+    a = sns.boxplot(data=dfMelt, hue='Percent Protected', x=by, y='Percent of Mapped Area',
+                    order=list(classes), width=0.35, ax=ax)
+    a.set_xlabel('NVC Class', fontsize=12)
+    a.set_ylabel('Percent of Mapped Area', fontsize=12)
+    a.set_xticks(range(len(classes)))
+    a.set_xticklabels(CLASS_ABBREVIATIONS[:len(classes)])
+    a.set_title('NVC Classes by Protection Status', fontsize=16)
+    return _finish(fig, path, show)
+
+
+def plot_class_bins(dfProtBins, path=None, show=False, by='NVCClass'):
+    '''
+    (DataFrame, str, bool, str) -> Figure
+
+    Horizontal bars of the number of groups per class in each
+    '% Protected 1 & 2' bin (LT1, LT17, LT50, GT50 columns).
+    '''
+    plt = pyplot(show)
+    import seaborn as sns
+
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for col, label, color in (('LT17', '< 17% Protected', 'orangered'),
+                              ('LT50', '17-50% Protected', 'y'),
+                              ('GT50', '> 50% Protected', 'forestgreen'),
+                              ('LT1', '< 1% Protected', 'red')):
+        sns.barplot(x=col, y=by, data=dfProtBins, label=label, color=color, ax=ax)
+    ax.legend(ncol=1, loc='lower right', frameon=True)
+    ax.set(xlim=(0, 100), ylabel='',
+           xlabel='Number of NVC Groups in a Class By Protection Amount Category')
+    sns.despine(left=True, bottom=True)
+    return _finish(fig, path, show)
+
+
+def plot_class_bin_counts(dfProtCats, path=None, show=False, classes=DB_NATURAL_CLASSES,
+                          by='NVCClass'):
+    '''
+    (DataFrame, str, bool, list, str) -> Figure
+
+    Vertical bars of the number of groups in each protection category by
+    class.
+    '''
+    plt = pyplot(show)
+    import seaborn as sns
+
+    fig, ax = plt.subplots(figsize=(6, 10))
+    sns.barplot(data=dfProtCats, hue='ProtCat', x=by, y='nGroups', order=list(classes), ax=ax)
+    plt.xticks(rotation=45)
+    ax.set_xlabel('NVC Class', fontsize=12)
+    ax.set_ylabel('Number of NVC Groups', fontsize=12)
+    ax.set_xticks(range(len(classes)))
+    ax.set_xticklabels(CLASS_ABBREVIATIONS[:len(classes)])
+    ax.set_title('Number of Groups in Protection Categories by Class', fontsize=16)
+    leg = ax.legend()
+    leg.set_title('Protection Categories', prop={'size': 11})
+    return _finish(fig, path, show)
+
+
+## --------------Ecoregion Charts--------------------
+
+def plot_ecoregion_bins(dfBins, path=None, show=False,
+                        colors=('red', 'coral', 'yellowgreen', 'darkgreen')):
+    '''
+    (DataFrame, str, bool, list) -> Figure
+
+    Stacked horizontal bars of the number of groups per ecoregion in each
+    percent-protected bin. dfBins is indexed by ecoregion with one column
+    per bin.
+    '''
+    plt = pyplot(show)
+    ax = dfBins.plot.barh(stacked=True, figsize=(12, 10), color=list(colors)[:dfBins.shape[1]])
+    ax.set_ylabel('Level II Ecoregions', fontsize=14)
+    ax.set_xlabel('Number of Groups', fontsize=14)
+    return _finish(ax.figure, path, show)
+
+
+## --------------Management Chart--------------------
+
+def plot_management_summary(dfSource, htmlPath, show=False, yMax=150000):
+    '''
+    (DataFrame, str, bool, float) -> bokeh figure
+
+    Stacked Protected / Multiple Use km2 bars grouped by management
+    category and class (summarize_by_manager output), saved as an HTML
+    file. The browser is only opened when show is True.
+    '''
+    from bokeh.io import output_file, save
+    from bokeh.models import ColumnDataSource, FactorRange, HoverTool, NumeralTickFormatter
+    from bokeh.plotting import figure
+
+    output_file(htmlPath)
+    colors = ['#286000', '#a6e883']  # Protected | Multiple Use
+    factors = list(dfSource.index)
+    source = ColumnDataSource(data={'CatCls': factors,
+                                    'Protected': dfSource['Protected'].to_numpy(),
+                                    'Multiple Use': dfSource['Multiple Use'].to_numpy(),
+                                    'Total Area': dfSource['Total Area'].to_numpy()})
+    p = figure(title='Management by USNVC Class', width=1100, x_range=FactorRange(*factors))
+    # The mouse over tool tip will have areas for protected, multiple use, and total
+    tt = HoverTool(tooltips=[('Protected', '@Protected{0,0}'),
+                             ('Multiple Use', '@{Multiple Use}{0,0}'),
+                             ('Total', '@{Total Area}{0,0}')])
+    p.vbar_stack(['Protected', 'Multiple Use'], x='CatCls', width=0.8, color=colors,
+                 source=source, legend_label=['Protected', 'Multiple Use'])
+    p.add_tools(tt)
+    p.title.align = 'center'
+    p.title.text_font_size = '12pt'
+    p.legend.location = 'top_center'
+    p.legend.orientation = 'horizontal'
+    p.xaxis.major_label_orientation = 1.55
+    p.xaxis.axis_label_text_font_style = 'normal'
+    p.y_range.start = 0
+    p.y_range.end = yMax
+    p.yaxis[0].formatter = NumeralTickFormatter(format='0,0')
+    p.yaxis.axis_label = 'Square Kilometers'
+    p.yaxis.axis_label_text_font_style = 'normal'
+
+    if show:
+        from bokeh.io import show as bokeh_show
+        bokeh_show(p)
+    else:
+        save(p)
+    return p
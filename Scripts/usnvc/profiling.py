@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        profiling.py
+
+        Per-stage timing and memory instrumentation for the scripts.
+
+        RunProfiler records, for each named stage of a run, the wall time,
+        the rows going in and coming out, the change in resident memory and
+        the stage's own peak RSS. The kernel's peak is reset as each stage
+        starts (Linux), so a light stage after a heavy one reports its own
+        peak; where that is not possible the process peak so far is
+        recorded instead, and peakScope says which. A stage is a with block
+        or a decorated
+        function. With profile='cprofile' (or 'pyinstrument' when that
+        package is installed) each stage is also profiled and its top
+        functions are kept in the report.
+
+        At the end of a run, write() saves a JSON report and summary()
+        prints one line per stage, so each production refresh shows where
+        the time went.
+
+            prof = RunProfiler('ManagementSummary')
+            with prof.stage('SQL fetch') as st:
+                df = db.query(sql)
+                st.rows_out(df)
+            prof.summary()
+            prof.write('ManagementSummary-run.json')
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import contextlib
+import datetime
+import functools
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+
+PROFILERS = (None, 'cprofile', 'pyinstrument')
+
+
+#############################################################################################
+######################################## MEMORY #############################################
+#############################################################################################
+
+
+def rss_mb():
+    '''
+    () -> float
+
+    Returns the current resident set size of this process in MB, using
+    psutil when installed and /proc on Linux otherwise. NaN when neither
+    is available.
+    '''
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1048576.0
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (OSError, ValueError, AttributeError):
+        return float('nan')
+
+
+def peak_rss_mb():
+    '''
+    () -> float
+
+    Returns the peak resident set size of this process in MB, or NaN where
+    the resource module is not available (Windows).
+    '''
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def reset_peak_rss():
+    '''
+    () -> bool
+
+    Resets the kernel's record of this process's peak RSS (VmHWM), so
+    stage_peak_rss_mb covers only what runs after the reset. Linux only;
+    returns False where the peak cannot be reset.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def stage_peak_rss_mb():
+    '''
+    () -> float
+
+    Returns the peak RSS in MB since the last reset_peak_rss (VmHWM from
+    /proc), NaN where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return float('nan')
+
+
+def n_rows(obj):
+    '''
+    (object) -> int or None
+
+    Returns len(obj) for frames, arrays and other sized objects, else None.
+    '''
+    try:
+        return int(len(obj))
+    except TypeError:
+        return None
+
+
+#############################################################################################
+######################################## STAGES #############################################
+#############################################################################################
+
+class StageRecord(object):
+    '''
+    Measurements of one stage. rows_in/rows_out can be set inside the
+    with block from a frame or a number.
+    '''
+
+    def __init__(self, name, rowsIn=None):
+        self.name = name
+        self.rowsIn = rowsIn if rowsIn is None or isinstance(rowsIn, int) else n_rows(rowsIn)
+        self.rowsOut = None
+        self.seconds = None
+        self.rssBeforeMB = None
+        self.rssAfterMB = None
+        self.peakRssMB = None
+        self.peakScope = None
+        self.profile = None
+        self.error = None
+
+    def rows_in(self, obj):
+        self.rowsIn = obj if isinstance(obj, int) else n_rows(obj)
+
+    def rows_out(self, obj):
+        self.rowsOut = obj if isinstance(obj, int) else n_rows(obj)
+
+    def as_dict(self):
+        delta = None
+        if self.rssAfterMB is not None and self.rssBeforeMB is not None:
+            delta = round(self.rssAfterMB - self.rssBeforeMB, 2)
+        return {'stage': self.name,
+                'seconds': None if self.seconds is None else round(self.seconds, 6),
+                'rowsIn': self.rowsIn,
+                'rowsOut': self.rowsOut,
+                'rssBeforeMB': _round(self.rssBeforeMB),
+                'rssAfterMB': _round(self.rssAfterMB),
+                'rssDeltaMB': delta,
+                'peakRssMB': _round(self.peakRssMB),
+                'peakScope': self.peakScope,
+                'error': self.error,
+                'profile': self.profile}
+
+
+def _round(x):
+    return None if x is None or x != x else round(x, 2)
+
+
+class RunProfiler(object):
+    '''
+    Collects StageRecords for one run of a script.
+
+    Arguments:
+    name -- Name of the run, e.g. the script name
+    profile -- None, 'cprofile' or 'pyinstrument' to profile every stage
+    topN -- Functions kept per stage from the profile
+    enabled -- When False the stages run without any measurement
+    '''
+
+    def __init__(self, name, profile=None, topN=15, enabled=True):
+        if profile not in PROFILERS:
+            raise ValueError('profile must be one of {0}'.format(PROFILERS))
+        self.name = name
+        self.profile = profile
+        self.topN = topN
+        self.enabled = enabled
+        self.stages = []
+        self.started = datetime.datetime.now()
+        self.t0 = time.perf_counter()
+        # Stages still running with the peak seen so far, and the run's peak
+        self._open = []
+        self._runPeakMB = 0.0
+        self._scoped = False
+
+    def _fold_peak(self):
+        # Folds the peak since the last reset into the open stages and the run
+        if not self._scoped:
+            return
+        peak = stage_peak_rss_mb()
+        for rec in self._open:
+            rec.peakRssMB = max(rec.peakRssMB, peak)
+        self._runPeakMB = max(self._runPeakMB, peak)
+
+    def peak_mb(self):
+        '''
+        () -> float
+
+        Returns the peak RSS of the run so far in MB.
+        '''
+        if not self._scoped:
+            return peak_rss_mb()
+        self._fold_peak()
+        return self._runPeakMB
+
+    ## --------------Stages--------------------
+
+    @contextlib.contextmanager
+    def stage(self, name, rowsIn=None, profile=None):
+        '''
+        (str, object, str) -> context manager yielding a StageRecord
+
+        Times the with block as one stage. rowsIn may be a count or a
+        frame. profile overrides the run's profiler for this stage.
+        '''
+        rec = StageRecord(name, rowsIn)
+        if not self.enabled:
+            yield rec
+            return
+        prof = _start_profile(profile or self.profile)
+        rec.rssBeforeMB = rss_mb()
+        # The run and outer stages keep the peak reached before this reset
+        if not self._scoped:
+            self._runPeakMB = peak_rss_mb()
+        self._fold_peak()
+        if reset_peak_rss():
+            self._scoped = True
+            rec.peakScope = 'stage'
+            rec.peakRssMB = stage_peak_rss_mb()
+        else:
+            rec.peakScope = 'process'
+        self._open.append(rec)
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        except BaseException as e:
+            rec.error = '{0}: {1}'.format(type(e).__name__, e)
+            raise
+        finally:
+            rec.seconds = time.perf_counter() - t0
+            rec.rssAfterMB = rss_mb()
+            self._fold_peak()
+            self._open.remove(rec)
+            if rec.peakScope == 'process':
+                rec.peakRssMB = peak_rss_mb()
+            rec.profile = _stop_profile(prof, self.topN)
+            self.stages.append(rec)
+
+    def timed(self, name=None, profile=None):
+        '''
+        (str, str) -> decorator
+
+        Decorates a function so each call is recorded as a stage. Rows in
+        are taken from the first argument and rows out from the result
+        when they have a length.
+        '''
+        def decorate(func):
+            stageName = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(stageName, args[0] if args else None, profile) as rec:
+                    result = func(*args, **kwargs)
+                    rec.rows_out(result)
+                return result
+            return wrapper
+        return decorate
+
+    ## --------------Report--------------------
+
+    def report(self):
+        '''
+        () -> dict
+
+        Returns the run report: run metadata and one dict per stage.
+        '''
+        return {'run': self.name,
+                'started': self.started.isoformat(timespec='seconds'),
+                'totalSeconds': round(time.perf_counter() - self.t0, 6),
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'peakRssMB': _round(self.peak_mb()),
+                'stages': [s.as_dict() for s in self.stages]}
+
+    def write(self, path):
+        '''
+        (str) -> dict
+
+        Writes the report as JSON and returns it.
+        '''
+        rep = self.report()
+        with open(path, 'w') as f:
+            json.dump(rep, f, indent=1)
+        return rep
+
+    def summary(self, file=None):
+        '''
+        Prints one line per stage: time, share of the run, rows in -> out
+        and memory change.
+        '''
+        file = file or sys.stdout
+        total = sum(s.seconds or 0 for s in self.stages) or 1.0
+        print('+' * 45, file=file)
+        print('{0} stage timings'.format(self.name), file=file)
+        for s in self.stages:
+            d = s.as_dict()
+            rows = '' if s.rowsIn is None and s.rowsOut is None else \
+                '{0} -> {1} rows'.format(_fmt(s.rowsIn), _fmt(s.rowsOut))
+            mem = '' if d['rssDeltaMB'] is None else '{0:+.1f} MB'.format(d['rssDeltaMB'])
+            print('  {0:<24} {1:8.3f} s {2:5.1f}%  {3:<24} {4}'.format(
+                s.name[:24], s.seconds or 0, 100.0 * (s.seconds or 0) / total, rows, mem),
+                file=file)
+        print('  {0:<24} {1:8.3f} s   peak RSS {2} MB'.format(
+            'total', time.perf_counter() - self.t0, _round(self.peak_mb())), file=file)
+        print('+' * 45, file=file)
+
+
+def _fmt(n):
+    return '?' if n is None else '{0:,}'.format(n)
+
+
+## --------------Profilers--------------------
+
+def _start_profile(kind):
+    if kind is None:
+        return None
+    if kind == 'cprofile':
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        return ('cprofile', prof)
+    if kind == 'pyinstrument':
+        from pyinstrument import Profiler
+        prof = Profiler()
+        prof.start()
+        return ('pyinstrument', prof)
+    raise ValueError('profile must be one of {0}'.format(PROFILERS))
+
+
+def _stop_profile(handle, topN):
+    # Returns the top functions by cumulative time, or the pyinstrument text
+    if handle is None:
+        return None
+    kind, prof = handle
+    if kind == 'pyinstrument':
+        prof.stop()
+        return prof.output_text(unicode=False, color=False)
+
+    import pstats
+    prof.disable()
+    stats = pstats.Stats(prof, stream=io.StringIO())
+    rows = []
+    for (fname, line, func), (cc, nc, tt, ct, _) in stats.stats.items():
+        rows.append({'function': '{0}:{1}({2})'.format(os.path.basename(fname), line, func),
+                     'calls': nc, 'tottime': round(tt, 6), 'cumtime': round(ct, 6)})
+    rows.sort(key=lambda r: r['cumtime'], reverse=True)
+    return rows[:topN]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        protection.py
+
+        PAD status pivot and percent-protected columns.
+
+        The notebook and scripts repeat the same steps after every roll-up:
+        pivot the cell counts on GAP status, fill the missing statuses with 0,
+        rename them PAD1 .. PAD4, add the total, the km2 areas and the
+        '% Protected 1 & 2' / '% Protected 1, 2 & 3' percentages. These
+        helpers do that once for any set of index columns.
+
+        When the counts carry the summed true cell area (AREA_KM2, see
+        usnvc.cellarea) the 'PADn km2' columns are those sums; otherwise
+        they are the counts times CELL_KM2, which is only right on the
+        30 m Albers grid.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+import pandas as pd
+
+from .cellarea import AREA_COL
+
+
+# Area of one 30 m cell in square kilometers
+CELL_KM2 = 0.0009
+
+PAD_STATUSES = (1, 2, 3, 4)
+PAD_COLUMNS = ['PAD{0}'.format(s) for s in PAD_STATUSES]
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Pivot on PAD Status--------------------
+
+def pad_pivot(dfCounts, index, status='GAPST_CD', value='COUNT', total='nGroupTotalCells',
+              area=AREA_COL):
+    '''
+    (DataFrame, list, str, str, str, str) -> DataFrame
+
+    Pivots summed cell counts on GAP status. Returns one row per index key
+    with PAD1 .. PAD4 (missing statuses filled with 0) and the total of the
+    four, as in the notebook's group pivot. When dfCounts has an area
+    column it is pivoted the same way into 'PAD1 km2' .. 'PAD4 km2'.
+
+    Arguments:
+    dfCounts -- Frame with the index columns, a status column and counts.
+        Several rows per key and status are summed.
+    index -- Column or list of columns identifying a row of the pivot
+    status -- GAP status column; values may be 1 .. 4 or '1' .. '4'
+    value -- Column of cell counts
+    total -- Name of the total column
+    area -- Column of summed cell areas in km2, used when present
+    '''
+    index = [index] if isinstance(index, str) else list(index)
+    sts = pd.to_numeric(dfCounts[status], errors='coerce')
+    dfCounts = dfCounts.assign(**{status: sts})
+    dfPivot = pd.pivot_table(dfCounts, index=index, columns=status, values=value,
+                             aggfunc='sum', fill_value=0, observed=True)
+    dfPivot = dfPivot.reindex(columns=list(PAD_STATUSES), fill_value=0)
+    dfPivot.columns = PAD_COLUMNS
+    dfPivot[total] = dfPivot[PAD_COLUMNS].sum(axis=1)
+    if area in dfCounts.columns:
+        dfArea = pd.pivot_table(dfCounts, index=index, columns=status, values=area,
+                                aggfunc='sum', fill_value=0, observed=True)
+        dfArea = dfArea.reindex(index=dfPivot.index, columns=list(PAD_STATUSES), fill_value=0)
+        for st, col in zip(PAD_STATUSES, PAD_COLUMNS):
+            dfPivot[col + ' km2'] = dfArea[st].to_numpy(dtype=np.float64)
+    return dfPivot.reset_index()
+
+
+def add_protection_columns(df, cellArea=CELL_KM2, total='nGroupTotalCells'):
+    '''
+    (DataFrame, float, str) -> DataFrame
+
+    Adds the 'PADn km2' area columns and the '% Protected 1 & 2' and
+    '% Protected 1, 2 & 3' percentages to a PAD pivot, in place, and
+    returns it. km2 columns already filled from summed cell areas (see
+    pad_pivot) are kept.
+
+    Arguments:
+    df -- Frame with PAD1 .. PAD4 and a total column
+    cellArea -- Area of one cell in km2
+    total -- Name of the total column
+    '''
+    for col in PAD_COLUMNS:
+        if col + ' km2' not in df.columns:
+            df[col + ' km2'] = df[col] * cellArea
+    tot = df[total].where(df[total] != 0, np.nan)
+    df['% Protected 1 & 2'] = ((df['PAD1'] + df['PAD2']) / tot) * 100
+    df['% Protected 1, 2 & 3'] = ((df['PAD1'] + df['PAD2'] + df['PAD3']) / tot) * 100
+    return df
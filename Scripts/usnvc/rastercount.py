@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        rastercount.py
+
+        Cell counts straight from the aligned 30 m rasters.
+
+        The analyses depend on a raster attribute table exported from a GIS
+        combine of the NVC group, PADUS and ecoregion layers
+        (combnvcpader1.img.vat.dbf, see 'Table Manipulation Working.txt').
+        This module builds the same VAT-style table in Python: the rasters
+        are read window by window, the values of each cell are packed into
+        one integer key, and np.unique counts the keys. The per-window counts
+        are merged by reduction, so windows can be counted in any order, in
+        a pool of worker processes, and resumed from per-window checkpoints
+        after an interruption.
+
+        With areas=True every combination also gets the summed true area of
+        its cells (AREA_KM2, see usnvc.cellarea) from the same pass, in
+        place of COUNT * 0.0009.
+
+        Reading the rasters needs rasterio. The counting functions only use
+        NumPy and work on plain arrays, e.g. for small synthetic tests.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from .cellarea import AREA_COL, AreaGrid
+
+
+# Column names of the combined layers in the exported attribute table
+COMBINE_NAMES = ('NVCGRP_LOOKUP2', 'PADUS2_1DISS6ATT', 'ECOREGIONS_L4')
+
+TILE_SIZE = 2048
+
+log = logging.getLogger(__name__)
+
+
+#############################################################################################
+#################################### TILE COUNTING ##########################################
+#############################################################################################
+
+
+## --------------Windows--------------------
+
+def iter_windows(height, width, tileSize=TILE_SIZE):
+    '''
+    (int, int, int) -> iterator of tuple
+
+    Yields (row_off, col_off, nrows, ncols) windows covering a raster in
+    row-major order.
+    '''
+    for r in range(0, height, tileSize):
+        for c in range(0, width, tileSize):
+            yield (r, c, min(tileSize, height - r), min(tileSize, width - c))
+
+
+## --------------Counting Arrays--------------------
+
+def count_arrays(arrays, nodata=None, areas=None):
+    '''
+    (list, list, ndarray) -> ndarray, ndarray[, ndarray]
+
+    Counts the distinct value combinations of aligned integer arrays.
+    Returns a (k, n_layers) int64 array of combinations and their counts.
+    Cells that are nodata (or masked) in any layer are skipped, as in a
+    GIS combine. With areas, the summed cell areas of each combination
+    are returned as a third array.
+
+    Arguments:
+    arrays -- Equal-shape integer arrays (or masked arrays), one per layer
+    nodata -- Nodata value per layer, None where a layer has none
+    areas -- Cell areas, any shape that broadcasts to the arrays' (e.g.
+        one per row from AreaGrid.window)
+    '''
+    if nodata is None:
+        nodata = [None] * len(arrays)
+    valid = np.ones(np.shape(arrays[0]), dtype=bool)
+    flat = []
+    for a, nd in zip(arrays, nodata):
+        if np.ma.isMaskedArray(a):
+            valid &= ~np.ma.getmaskarray(a)
+            a = a.data
+        a = np.asarray(a)
+        if nd is not None:
+            valid &= a != nd
+        flat.append(a)
+    flat = [a[valid].astype(np.int64) for a in flat]
+    if areas is not None:
+        areas = np.broadcast_to(areas, valid.shape)[valid].astype(np.float64)
+    if not len(flat[0]):
+        empty = (np.empty((0, len(arrays)), dtype=np.int64), np.empty(0, dtype=np.int64))
+        return empty if areas is None else empty + (np.empty(0),)
+
+    # Pack with this window's own value ranges; merge_counts re-packs globally
+    mins = [int(a.min()) for a in flat]
+    radices = [int(a.max()) - m + 1 for a, m in zip(flat, mins)]
+    if np.prod([float(r) for r in radices]) < 2 ** 63:
+        key = np.zeros(len(flat[0]), dtype=np.int64)
+        for a, m, r in zip(flat, mins, radices):
+            key *= r
+            key += a - m
+        uniq, inv, counts = np.unique(key, return_inverse=True, return_counts=True)
+        combos = np.empty((len(uniq), len(flat)), dtype=np.int64)
+        for i in range(len(flat) - 1, -1, -1):
+            combos[:, i] = uniq % radices[i] + mins[i]
+            uniq = uniq // radices[i]
+    else:
+        combos, inv, counts = np.unique(np.column_stack(flat), axis=0, return_inverse=True,
+                                        return_counts=True)
+    if areas is None:
+        return combos, counts
+    # Same inverse index as the counts, so the areas cost one bincount
+    return combos, counts, np.bincount(inv.ravel(), weights=areas, minlength=len(counts))
+
+
+def merge_counts(parts):
+    '''
+    (list) -> ndarray, ndarray
+
+    Merges (combos, counts) pairs, or (combos, counts, areas) triples,
+    from several windows by summing the counts (and areas) of identical
+    combinations. Returns the combinations sorted lexicographically.
+    '''
+    withAreas = bool(parts) and len(parts[0]) == 3
+    parts = [p for p in parts if len(p[1])]
+    if not parts:
+        empty = (np.empty((0, 0), dtype=np.int64), np.empty(0, dtype=np.int64))
+        return empty + (np.empty(0),) if withAreas else empty
+    combos = np.concatenate([p[0] for p in parts])
+    counts = np.concatenate([p[1] for p in parts])
+    uniq, inv = np.unique(combos, axis=0, return_inverse=True)
+    inv = inv.ravel()
+    sums = np.rint(np.bincount(inv, weights=counts, minlength=len(uniq))).astype(np.int64)
+    if not withAreas:
+        return uniq, sums
+    areas = np.concatenate([p[2] for p in parts])
+    return uniq, sums, np.bincount(inv, weights=areas, minlength=len(uniq))
+
+
+def to_vat(combos, counts, areas=None, names=COMBINE_NAMES):
+    '''
+    (ndarray, ndarray, ndarray, list) -> DataFrame
+
+    Returns a VAT-style table: VALUE (1 .. n), COUNT, AREA_KM2 when areas
+    are given, and one column per combined layer.
+    '''
+    dfVat = pd.DataFrame({'VALUE': np.arange(1, len(counts) + 1, dtype=np.int64),
+                          'COUNT': counts})
+    if areas is not None:
+        dfVat[AREA_COL] = areas
+    for i, name in enumerate(names):
+        dfVat[name] = combos[:, i] if len(combos) else np.empty(0, dtype=np.int64)
+    return dfVat
+
+
+def window_areas(areas, window):
+    '''
+    (AreaGrid or ndarray, tuple) -> ndarray
+
+    Returns the cell areas of a (row_off, col_off, nrows, ncols) window
+    from an AreaGrid, or from an array of areas per cell (2-D) or per row
+    (1-D or one column).
+    '''
+    if areas is None:
+        return None
+    if isinstance(areas, AreaGrid):
+        return areas.window(window)
+    r, c, h, w = window
+    areas = np.asarray(areas)
+    if areas.ndim == 1:
+        return areas[r:r + h, None]
+    if areas.shape[1] == 1:
+        return areas[r:r + h]
+    return areas[r:r + h, c:c + w]
+
+
+def combine_arrays(arrays, names=COMBINE_NAMES, nodata=None, tileSize=TILE_SIZE, areas=None):
+    '''
+    (list, list, list, int, AreaGrid or ndarray) -> DataFrame
+
+    In-memory counterpart of combine_rasters for arrays: counts window by
+    window and returns the VAT-style table, with AREA_KM2 when cell areas
+    are given (see window_areas).
+    '''
+    height, width = np.shape(arrays[0])
+    parts = []
+    for win in iter_windows(height, width, tileSize):
+        r, c, h, w = win
+        parts.append(count_arrays([a[r:r + h, c:c + w] for a in arrays], nodata,
+                                  window_areas(areas, win)))
+    return to_vat(*merge_counts(parts), names=names)
+
+
+#############################################################################################
+#################################### RASTER FILES ###########################################
+#############################################################################################
+
+
+def check_alignment(paths):
+    '''
+    (list) -> tuple
+
+    Opens the rasters and checks they share size, transform and CRS.
+    Returns (height, width, nodata list). Raises ValueError otherwise.
+    '''
+    import rasterio
+
+    ref, nodata = None, []
+    for p in paths:
+        with rasterio.open(p) as src:
+            grid = (src.height, src.width, src.transform, src.crs)
+            nodata.append(src.nodata)
+        if ref is None:
+            ref = grid
+        elif grid != ref:
+            raise ValueError('{0} is not aligned with {1}'.format(p, paths[0]))
+    return ref[0], ref[1], nodata
+
+
+def count_tile(paths, window, nodata=None, tileCacheDir=None, areas=None):
+    '''
+    (list, tuple, list, str, AreaGrid) -> ndarray, ndarray[, ndarray]
+
+    Reads one (row_off, col_off, nrows, ncols) window of every raster and
+    counts its value combinations, and sums their cell areas when given
+    the rasters' AreaGrid. A module-level function so it can be sent to
+    worker processes.
+
+    With a tileCacheDir the counts are stored under a hash of the window's
+    cell values, so a window whose values did not change (e.g. outside the
+    areas edited in a new PADUS release) is not counted again. With areas
+    the hash also covers the grid and the window position.
+    '''
+    import rasterio
+    from rasterio.windows import Window
+
+    r, c, h, w = window
+    arrays, nd = [], []
+    for i, p in enumerate(paths):
+        with rasterio.open(p) as src:
+            arrays.append(src.read(1, window=Window(c, r, w, h), masked=True))
+            nd.append(src.nodata if nodata is None else nodata[i])
+    cellAreas = window_areas(areas, window)
+    if tileCacheDir is None:
+        return count_arrays(arrays, nd, cellAreas)
+
+    digest = hashlib.sha1(repr(nd).encode())
+    if areas is not None:
+        digest.update('{0}|{1}'.format(areas.key, window).encode())
+    for a in arrays:
+        digest.update(str(a.dtype).encode())
+        digest.update(np.ascontiguousarray(a.data).tobytes())
+        digest.update(np.packbits(np.ma.getmaskarray(a)).tobytes())
+    path = os.path.join(tileCacheDir, digest.hexdigest() + '.npz')
+    part = _load_part(path)
+    if part is not None:
+        return part
+    part = count_arrays(arrays, nd, cellAreas)
+    _save_part(path, part)
+    return part
+
+
+def _load_part(path):
+    try:
+        with np.load(path) as z:
+            if 'areas' in z.files:
+                return z['combos'], z['counts'], z['areas']
+            return z['combos'], z['counts']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_part(path, part):
+    # Written under a temporary name first so a crash never leaves a
+    # truncated file
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    arrays = dict(zip(('combos', 'counts', 'areas'), part))
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def combine_rasters(paths, names=COMBINE_NAMES, tileSize=TILE_SIZE, workers=1,
+                    checkpointDir=None, mergeEvery=64, tileCacheDir=None, areas=False,
+                    areaCacheDir=None):
+    '''
+    (list, list, int, int, str, int, str, bool, str) -> DataFrame
+
+    Counts the joint histogram of aligned rasters window by window and
+    returns the VAT-style COUNT table, like a GIS combine.
+
+    With workers > 1 the windows are counted in a process pool. Each worker
+    sends back only its window's (combinations, counts) pair, and the
+    pairs are merged into a running total every mergeEvery windows. The
+    result is identical to the serial run because the merge sorts and sums
+    the same combinations.
+
+    With a checkpointDir every finished window is saved there. An
+    interrupted run started again with the same inputs only counts the
+    missing windows. Checkpoints from different inputs or tile sizes are
+    discarded.
+
+    A tileCacheDir keeps window counts across input versions, keyed by the
+    window's cell values (see count_tile). Rerunning after one raster is
+    replaced only counts the windows whose values changed.
+
+    With areas=True the table also has AREA_KM2, the true area of each
+    combination's cells from the rasters' geotransform and CRS (see
+    usnvc.cellarea).
+
+    Arguments:
+    paths -- Raster paths in the same order as names, e.g. the NVC group
+        lookup, PADUS unit and L4 ecoregion rasters
+    names -- Column name for each raster's values
+    tileSize -- Window edge length in cells
+    workers -- Number of worker processes, 1 to count in this process
+    checkpointDir -- Folder for per-window checkpoints, None for no
+        checkpointing
+    mergeEvery -- Windows collected between merges of the running total
+    tileCacheDir -- Folder for content-addressed window counts, None for
+        no caching
+    areas -- Also sum the cell areas
+    areaCacheDir -- Folder for the cached per-row areas of the grid
+    '''
+    height, width, nodata = check_alignment(paths)
+    grid = AreaGrid.from_raster(paths[0], areaCacheDir) if areas else None
+    if tileCacheDir is not None:
+        os.makedirs(tileCacheDir, exist_ok=True)
+    windows = list(iter_windows(height, width, tileSize))
+
+    ckpt = None
+    if checkpointDir is not None:
+        ckpt = TileCheckpoint(checkpointDir, paths, tileSize, areas=bool(areas))
+
+    total = None
+    pending = []
+
+    def collect(part):
+        nonlocal total, pending
+        pending.append(part)
+        if len(pending) >= mergeEvery:
+            total = merge_counts(pending if total is None else [total] + pending)
+            pending = []
+
+    todo = []
+    for win in windows:
+        part = ckpt.load(win) if ckpt is not None else None
+        if part is None:
+            todo.append(win)
+        else:
+            collect(part)
+    log.info('%d windows, %d from checkpoints, %d to count',
+             len(windows), len(windows) - len(todo), len(todo))
+
+    t0 = time.perf_counter()
+    for i, (win, part) in enumerate(_count_windows(paths, todo, nodata, workers, tileCacheDir,
+                                                    grid)):
+        if ckpt is not None:
+            ckpt.save(win, part)
+        collect(part)
+        if (i + 1) % mergeEvery == 0 or i + 1 == len(todo):
+            log.info('%d / %d windows counted in %.1f s', i + 1, len(todo),
+                     time.perf_counter() - t0)
+
+    parts = pending if total is None else [total] + pending
+    return to_vat(*merge_counts(parts), names=names)
+
+
+def _count_windows(paths, windows, nodata, workers, tileCacheDir=None, areas=None):
+    '''
+    Yields (window, (combos, counts[, areas])) as windows finish, serially
+    or from a process pool. At most 2 * workers windows are in flight, and
+    a finished window is dropped once yielded, so memory does not grow with
+    the number of tiles.
+    '''
+    if workers is None or workers <= 1:
+        for win in windows:
+            yield win, count_tile(paths, win, nodata, tileCacheDir, areas)
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    todo = iter(windows)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}
+
+        def submit():
+            for win in todo:
+                running[pool.submit(count_tile, paths, win, nodata, tileCacheDir, areas)] = win
+                if len(running) >= 2 * workers:
+                    return
+
+        submit()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                win = running.pop(fut)
+                yield win, fut.result()
+            submit()
+
+
+#############################################################################################
+##################################### CHECKPOINTS ###########################################
+#############################################################################################
+
+class TileCheckpoint(object):
+    '''
+    Per-window count files for resuming an interrupted combine.
+
+    The folder holds one .npz per finished window and a manifest with a
+    fingerprint of the inputs (paths, sizes, modification times, tile
+    size and whether areas are summed). A different fingerprint clears the
+    old windows.
+    '''
+
+    def __init__(self, folder, paths, tileSize, areas=False):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.fingerprint = self._fingerprint(paths, tileSize, areas)
+        manifest = os.path.join(folder, 'manifest.json')
+        try:
+            with open(manifest) as f:
+                current = json.load(f).get('fingerprint')
+        except (OSError, ValueError):
+            current = None
+        if current != self.fingerprint:
+            for name in os.listdir(folder):
+                if name.startswith('tile_') and name.endswith('.npz'):
+                    os.remove(os.path.join(folder, name))
+            with open(manifest, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint, 'paths': list(paths),
+                           'tileSize': tileSize}, f)
+
+    @staticmethod
+    def _fingerprint(paths, tileSize, areas=False):
+        h = hashlib.sha1(str(tileSize).encode())
+        if areas:
+            h.update(b'areas')
+        for p in paths:
+            st = os.stat(p)
+            h.update('{0}|{1}|{2}'.format(os.path.abspath(p), st.st_size,
+                                          st.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def _path(self, win):
+        return os.path.join(self.folder, 'tile_{0}_{1}.npz'.format(win[0], win[1]))
+
+    def load(self, win):
+        '''
+        (tuple) -> tuple or None
+
+        Returns the saved (combos, counts[, areas]) of a window, or None.
+        '''
+        return _load_part(self._path(win))
+
+    def save(self, win, part):
+        '''
+        (tuple, tuple) -> None
+
+        Saves a window's counts. The file is written under a temporary
+        name first so a crash never leaves a truncated checkpoint.
+        '''
+        _save_part(self._path(win), part)
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        recode.py
+
+        Declarative recode and filter rules for the attribute table.
+
+        The notebook rewrites string columns one statement at a time: the
+        Great Lakes Dune merges, the 'UPPER GILA MOUNTAINS (?)' fix, the
+        NaturalType assignment over the class names, the Eastern Plantation
+        relabel and the 'Ruderal' / 'Plantation' filters. Each is a full
+        pass over the rows.
+
+        Here the same steps are a table of rules. Every condition is
+        evaluated on a column's category list (a few hundred labels) and
+        turned into a lookup array over the integer codes, so renames only
+        rewrite categories. apply_rules returns the recoded frame and a
+        report of which rules fired, how many rows and how many cells (sum
+        of COUNT) each touched. When the counts are not needed the rules
+        are composed on the label combinations first, and the row work is
+        one code gather per column whatever the number of rules.
+
+        A rule is a dict:
+
+            {'name': ..., 'action': 'rename', 'column': 'GROUP',
+             'where': {'GROUP': {'eq': 'Great Lakes Sand Beach'}},
+             'to': 'Great Lakes Dune'}
+
+        action -- 'rename' (set column to 'to' where matched), 'assign'
+            (set a new or existing column to 'value' where matched, and to
+            'default' on rows it has not been assigned yet), 'keep' (keep
+            only matching rows) or 'drop' (drop matching rows)
+        where -- Column -> condition, all of which must hold. A condition is
+            a dict of one or more of eq, ne, in, not_in, contains,
+            not_contains, regex, isnull. Omitted for a rename, it
+            matches every category of the column.
+
+        Rules run in order, so later rules see earlier renames and drops.
+        load_rules reads the same table from a YAML or JSON file.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+from .lookups import CLASS_SHORT_NAMES, NATURAL_CLASSES, NOT_CONVERTED_CLASSES
+
+
+ACTIONS = ('rename', 'assign', 'keep', 'drop')
+
+
+#############################################################################################
+######################################## RULESETS ###########################################
+#############################################################################################
+
+# Merges and fixes applied to dfTable right after it is loaded
+TABLE_RULES = [
+    {'name': 'great-lakes-sand-beach', 'action': 'rename', 'column': 'GROUP',
+     'where': {'GROUP': {'eq': 'Great Lakes Sand Beach'}}, 'to': 'Great Lakes Dune'},
+    {'name': 'great-lakes-shrub-grass-dune', 'action': 'rename', 'column': 'GROUP',
+     'where': {'GROUP': {'eq': 'Great Lakes Shrub & Grass Dune'}}, 'to': 'Great Lakes Dune'},
+    {'name': 'wash-arroyo', 'action': 'rename', 'column': 'GROUP',
+     'where': {'GROUP': {'eq': 'Cool Semi-Desert Shrub & Herb Wash-Arroyo'}},
+     'to': 'Great Basin-Intermountain Shrub & Herb Wash-Arroyo'},
+    {'name': 'upper-gila-mountains', 'action': 'rename', 'column': 'NA_L2NAME',
+     'where': {'NA_L2NAME': {'eq': 'UPPER GILA MOUNTAINS (?)'}}, 'to': 'UPPER GILA MOUNTAINS'},
+]
+
+# NaturalType for the ecoregion breakdowns; Open Water is left out
+NATURAL_TYPE_RULES = [
+    {'name': 'natural-type', 'action': 'assign', 'column': 'NaturalType',
+     'where': {'CLASS': {'in': NOT_CONVERTED_CLASSES}}, 'value': 'Not Converted',
+     'default': 'Converted'},
+    {'name': 'drop-open-water', 'action': 'drop', 'where': {'CLASS': {'eq': 'Open Water'}}},
+    {'name': 'plantation-not-converted', 'action': 'assign', 'column': 'NaturalType',
+     'where': {'GROUP': {'eq': 'Eastern North American Temperate Forest Plantation'}},
+     'value': 'Not Converted'},
+]
+
+# Natural classes plus the Eastern Temperate Forest Plantations
+PLANTATION_RULES = [
+    {'name': 'natural-and-agricultural', 'action': 'keep',
+     'where': {'CLASS': {'in': NATURAL_CLASSES + ['7 Agricultural & Developed Vegetation']}}},
+    {'name': 'drop-non-plantation', 'action': 'drop',
+     'where': {'CLASS': {'eq': '7 Agricultural & Developed Vegetation'},
+               'GROUP': {'not_contains': 'Plantation'}}},
+    {'name': 'eastern-plantation', 'action': 'rename', 'column': 'CLASS',
+     'where': {'CLASS': {'eq': '7 Agricultural & Developed Vegetation'}},
+     'to': '7 Eastern Plantation'},
+]
+
+# Natural classes without Ruderal groups
+NATURAL_GROUP_RULES = [
+    {'name': 'natural-classes', 'action': 'keep', 'where': {'CLASS': {'in': NATURAL_CLASSES}}},
+    {'name': 'drop-ruderal', 'action': 'drop', 'where': {'GROUP': {'contains': 'Ruderal'}}},
+]
+
+# Shorter class names for plotting
+PLOT_RULES = [
+    {'name': 'polar-high-montane', 'action': 'rename', 'column': 'CLASS',
+     'where': {'CLASS': {'in': list(CLASS_SHORT_NAMES)}}, 'to': 'Polar & High Montane'},
+]
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Conditions on Categories--------------------
+
+def match_labels(labels, cond):
+    '''
+    (list, dict) -> ndarray
+
+    Evaluates one condition on a list of labels (None for missing) and
+    returns a boolean array. Several keys in one condition must all hold.
+    Missing labels only match isnull: True, ne and the not_ tests.
+    '''
+    out = np.ones(len(labels), dtype=bool)
+    for key, arg in cond.items():
+        if key == 'eq':
+            hit = [lab is not None and lab == arg for lab in labels]
+        elif key == 'ne':
+            hit = [lab is None or lab != arg for lab in labels]
+        elif key == 'in':
+            arg = set(arg)
+            hit = [lab is not None and lab in arg for lab in labels]
+        elif key == 'not_in':
+            arg = set(arg)
+            hit = [lab is None or lab not in arg for lab in labels]
+        elif key == 'contains':
+            hit = [lab is not None and arg in str(lab) for lab in labels]
+        elif key == 'not_contains':
+            hit = [lab is None or arg not in str(lab) for lab in labels]
+        elif key == 'regex':
+            pat = re.compile(arg)
+            hit = [lab is not None and pat.search(str(lab)) is not None for lab in labels]
+        elif key == 'isnull':
+            hit = [(lab is None) == bool(arg) for lab in labels]
+        else:
+            raise ValueError('Unknown condition {0!r}'.format(key))
+        out &= np.asarray(hit, dtype=bool)
+    return out
+
+
+def validate_rules(rules):
+    '''
+    (list) -> None
+
+    Checks that each rule has a name, a known action and the keys its
+    action needs. Raises ValueError otherwise.
+    '''
+    names = set()
+    for r in rules:
+        name = r.get('name')
+        if not name or name in names:
+            raise ValueError('Every rule needs a unique name: {0!r}'.format(r))
+        names.add(name)
+        if r.get('action') not in ACTIONS:
+            raise ValueError('Rule {0}: action must be one of {1}'.format(name, ACTIONS))
+        if r['action'] == 'rename' and ('column' not in r or 'to' not in r):
+            raise ValueError('Rule {0}: rename needs column and to'.format(name))
+        if r['action'] == 'assign' and ('column' not in r or 'value' not in r):
+            raise ValueError('Rule {0}: assign needs column and value'.format(name))
+        if r['action'] in ('keep', 'drop') and not r.get('where'):
+            raise ValueError('Rule {0}: {1} needs where'.format(name, r['action']))
+
+
+def load_rules(path):
+    '''
+    (str) -> list
+
+    Reads a ruleset from a .json file or, when PyYAML is installed, a
+    .yaml/.yml file holding a list of rule dicts.
+    '''
+    with open(path) as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            import yaml
+            rules = yaml.safe_load(f)
+        else:
+            rules = json.load(f)
+    validate_rules(rules)
+    return rules
+
+
+#############################################################################################
+##################################### RULE ENGINE ###########################################
+#############################################################################################
+
+class _CodedColumn(object):
+    '''
+    A table column as integer codes into its categories. Code n (one past
+    the last category) stands for missing. current maps each original
+    category to its present label, so a rename only rewrites current.
+    '''
+
+    def __init__(self, s):
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype('category')
+        n = len(s.cat.categories)
+        codes = np.asarray(s.cat.codes, dtype=np.int32)
+        self.codes = np.where(codes < 0, n, codes).astype(np.int32)
+        self.labels = list(s.cat.categories) + [None]
+        self.current = np.arange(n + 1, dtype=np.int32)
+
+    def hits(self, cond):
+        # Condition on the present label of each original category
+        return match_labels([self.labels[c] for c in self.current], cond)
+
+    def row_hits(self, cond):
+        return self.hits(cond)[self.codes]
+
+    def label_id(self, label):
+        if label in self.labels:
+            return self.labels.index(label)
+        self.labels.append(label)
+        return len(self.labels) - 1
+
+    def changed(self):
+        return bool((self.current != np.arange(len(self.current))).any())
+
+    def to_series(self, index, name):
+        # Only labels still in use become categories, in their first order
+        used = [u for u in np.unique(self.current) if self.labels[u] is not None]
+        remap = np.full(len(self.labels), -1, dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+        cat = pd.Categorical.from_codes(remap[self.current][self.codes],
+                                        [self.labels[u] for u in used])
+        return pd.Series(cat, index=index, name=name)
+
+
+class _AssignedColumn(object):
+    '''
+    A column written by assign rules, as row codes into its own labels
+    (-1 until a rule sets the row). Starts from the table's column when
+    the name already exists.
+    '''
+
+    def __init__(self, n, s=None):
+        self.labels = []
+        self.codes = np.full(n, -1, dtype=np.int32)
+        if s is not None:
+            codes, labels = pd.factorize(s)
+            self.codes = codes.astype(np.int32)
+            self.labels = list(labels)
+
+    def set(self, mask, label):
+        if label not in self.labels:
+            self.labels.append(label)
+        self.codes[mask] = self.labels.index(label)
+
+    def unset(self):
+        return self.codes < 0
+
+    def hits(self, cond):
+        return match_labels(self.labels + [None], cond)
+
+    def row_hits(self, cond):
+        return self.hits(cond)[self.codes]
+
+    def to_series(self, index, name):
+        cat = pd.Categorical.from_codes(self.codes, self.labels)
+        return pd.Series(cat, index=index, name=name)
+
+
+class RecodeResult(object):
+    '''
+    Output of apply_rules.
+
+    Attributes:
+    frame -- The recoded frame
+    report -- One row per rule: rule, action, column, fired, nLabels
+        (categories matched), nRows and nCells (sum of the count column)
+    '''
+
+    def __init__(self, frame, report):
+        self.frame = frame
+        self.report = report
+
+    def fired(self):
+        '''
+        () -> list
+
+        Returns the names of the rules that changed at least one row.
+        '''
+        return list(self.report.loc[self.report['fired'], 'rule'])
+
+
+def _rule_columns(df, rules):
+    # Table columns the rules test, rename or assign over
+    names = []
+    for r in rules:
+        for name in list((r.get('where') or {})) + [r.get('column')]:
+            if name in df.columns and name not in names:
+                names.append(name)
+    return names
+
+
+def _compose(df, rules):
+    # The rules only depend on the labels of the rule columns, so they run
+    # on the distinct label combinations (in first-row order) and the
+    # result goes back to the rows as one code gather per column
+    names = _rule_columns(df, rules)
+    series = {}
+    key = np.zeros(len(df), dtype=np.int64)
+    for name in names:
+        s = df[name]
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype('category')
+        series[name] = s
+        codes = np.asarray(s.cat.codes, dtype=np.int64) + 1
+        key, _ = pd.factorize(key * (len(s.cat.categories) + 1) + codes)
+    first = pd.Series(key).drop_duplicates().index.to_numpy()
+    combos = pd.DataFrame({name: s.iloc[first].reset_index(drop=True)
+                           for name, s in series.items()}, columns=names)
+
+    res = _apply_masked(combos, rules, None)
+    kept = res.frame.index.to_numpy()
+    assigned = {r['column'] for r in rules if r['action'] == 'assign'}
+    dfOut = df.copy()
+    for name in res.frame.columns:
+        out = res.frame[name]
+        if name not in assigned and out.cat.categories.equals(series[name].cat.categories) and \
+                np.array_equal(out.cat.codes, combos[name].cat.codes.to_numpy()[kept]):
+            continue
+        codes = np.full(len(combos), -1, dtype=np.int32)
+        codes[kept] = out.cat.codes
+        dfOut[name] = pd.Series(pd.Categorical.from_codes(codes[key], out.cat.categories),
+                                index=df.index, name=name)
+    if len(kept) < len(combos):
+        alive = np.zeros(len(combos), dtype=bool)
+        alive[kept] = True
+        dfOut = dfOut[alive[key]]
+
+    # Counts over the combinations are not row counts
+    report = res.report.copy()
+    report['nRows'] = np.nan
+    report['nCells'] = np.nan
+    return RecodeResult(dfOut, report)
+
+
+def _apply_masked(df, rules, value):
+    # One boolean row mask per rule; gives the row and cell counts
+    cols = {}
+    alive = np.ones(len(df), dtype=bool)
+    weights = df[value].to_numpy(dtype=np.float64) if value in df.columns else None
+
+    def column(name):
+        if name not in cols:
+            cols[name] = _CodedColumn(df[name])
+        return cols[name]
+
+    def row_mask(where):
+        mask = alive.copy()
+        for name, cond in where.items():
+            mask &= column(name).row_hits(cond)
+        return mask
+
+    def n_labels(where):
+        return int(sum(column(k).hits(c)[:-1].sum() for k, c in where.items()))
+
+    records = []
+    for r in rules:
+        action, where = r['action'], r.get('where') or {}
+        rec = {'rule': r['name'], 'action': action, 'column': r.get('column')}
+
+        if action == 'rename':
+            col = column(r['column'])
+            if not isinstance(col, _CodedColumn) or set(where) - {r['column']}:
+                raise ValueError('Rule {0}: a rename can only test the renamed table '
+                                 'column; use assign instead'.format(r['name']))
+            target = col.label_id(r['to'])
+            hit = col.hits(where.get(r['column'], {}))
+            hit[-1] = False
+            hit &= col.current != target
+            mask = hit[col.codes] & alive
+            col.current[hit] = target
+            rec['nLabels'] = int(hit.sum())
+
+        elif action == 'assign':
+            name = r['column']
+            if not isinstance(cols.get(name), _AssignedColumn):
+                cols[name] = _AssignedColumn(len(df), df[name] if name in df.columns else None)
+            acol = cols[name]
+            mask = row_mask(where)
+            acol.set(mask, r['value'])
+            if 'default' in r:
+                acol.set(acol.unset() & alive, r['default'])
+            rec['nLabels'] = n_labels(where)
+
+        else:
+            mask = row_mask(where)
+            if action == 'keep':
+                mask = alive & ~mask
+            alive &= ~mask
+            rec['nLabels'] = n_labels(where)
+
+        rec['nRows'] = int(mask.sum())
+        rec['nCells'] = float(weights[mask].sum()) if weights is not None else float(rec['nRows'])
+        rec['fired'] = rec['nRows'] > 0
+        records.append(rec)
+
+    dfOut = df.copy()
+    for name, col in cols.items():
+        if isinstance(col, _AssignedColumn) or col.changed():
+            dfOut[name] = col.to_series(df.index, name)
+    if not alive.all():
+        dfOut = dfOut[alive]
+
+    report = pd.DataFrame(records, columns=['rule', 'action', 'column', 'fired', 'nLabels',
+                                            'nRows', 'nCells'])
+    if weights is not None and np.all(np.mod(report['nCells'], 1) == 0):
+        report['nCells'] = report['nCells'].astype(np.int64)
+    return RecodeResult(dfOut, report)
+
+
+def apply_rules(df, rules, value='COUNT', verbose=False, counts=True):
+    '''
+    (DataFrame, list, str, bool, bool) -> RecodeResult
+
+    Applies a ruleset (see the module notes). Conditions are evaluated on
+    category labels. With counts, each rule then takes one boolean mask
+    over the rows to count what it touched. Without, the rules are
+    composed on the distinct label combinations of the rule columns and
+    the rows only see one code gather per column (and one for the
+    keep/drop rules); the report then has no nRows or nCells.
+
+    Arguments:
+    df -- Attribute table or any frame with the rule columns
+    rules -- List of rule dicts, e.g. TABLE_RULES + NATURAL_TYPE_RULES
+    value -- Count column summed for the nCells of the report; rows are
+        counted instead when the frame has no such column
+    verbose -- Print the report (implies counts)
+    counts -- Count the rows and cells each rule touched
+    '''
+    validate_rules(rules)
+    if counts or verbose:
+        result = _apply_masked(df, rules, value)
+    else:
+        result = _compose(df, rules)
+    if verbose:
+        print(result.report.to_string(index=False))
+    return result
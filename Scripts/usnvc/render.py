@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        render.py
+
+        Headless batch rendering of the protection charts.
+
+        usnvc.plots draws the charts the way the scripts always have
+        (seaborn, pyplot and a Bokeh page opened in the browser), one new
+        figure per call. That is fine for a look at one chart but slow for
+        a refresh of hundreds of scenarios.
+
+        Here every chart type has a template: a matplotlib Figure on the
+        Agg canvas (pyplot is never imported, so no GUI or display is
+        needed) that is built once per process and only has its data
+        redrawn for each chart. The management chart's HTML page likewise
+        reuses one Bokeh figure and swaps its data source. Each chart can
+        be written as PNG, SVG and a standalone HTML page.
+
+        render_jobs spreads many charts over a process pool; each worker
+        keeps its own templates. From the Scripts folder, every chart of a
+        usnvc.batch output folder can be redrawn from its CSVs:
+
+            python -m usnvc.render batch --formats png svg html --workers 8
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import argparse
+import ast
+import concurrent.futures
+import html
+import io
+import os
+import sys
+import textwrap
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from .lookups import DB_NATURAL_CLASSES, NATURAL_CLASSES, strip_class_number
+from .plots import CLASS_ABBREVIATIONS
+
+
+FORMATS = ('png', 'svg', 'html')
+
+DPI = 150
+
+# Charts drawn for the CSVs written by usnvc.batch: file name -> (chart, options)
+CSV_CHARTS = {'GroupPercentProtected.csv': ('class_boxplot', {}),
+              'GroupPercentProtectedbyEcoregion.csv': ('ecoregion_bins',
+                                                       {'xlabel': 'Number of Groups'}),
+              'MacrogroupPercentProtectedbyEcoregion.csv': ('ecoregion_bins',
+                                                            {'xlabel': 'Number of Macrogroups'}),
+              'EcoregionProtectionBreakdown.csv': ('ecoregion_breakdown', {}),
+              'ManagementSummary.csv': ('management', {})}
+
+ECO_LABELS = {'NA_L2NAME': 'Level II Ecoregions',
+              'US_L3NAME': 'Level III Ecoregions',
+              'US_L4NAME': 'Level IV Ecoregions'}
+
+HTML_PAGE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+# The templates built in this process, chart name -> ChartTemplate
+_TEMPLATES = {}
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+def _class_order(values):
+    # Natural classes present in the data, in plot order, with either naming
+    present = set(values)
+    vatNames = list(strip_class_number(pd.Series(NATURAL_CLASSES)))
+    order = [c for pair in zip(DB_NATURAL_CLASSES, vatNames) for c in pair if c in present]
+    return list(dict.fromkeys(order))
+
+
+def _abbreviation(c):
+    for names in (DB_NATURAL_CLASSES, list(strip_class_number(pd.Series(NATURAL_CLASSES)))):
+        if c in names:
+            return CLASS_ABBREVIATIONS[names.index(c)]
+    return c
+
+
+def _class_column(df):
+    return 'NVCClass' if 'NVCClass' in df.columns else 'CLASS'
+
+
+#############################################################################################
+###################################### TEMPLATES ############################################
+#############################################################################################
+
+
+class ChartTemplate(object):
+    '''
+    A reusable figure for one chart type. Subclasses set figsize and title
+    and implement draw(ax, df, **options); read loads the chart's CSV.
+    '''
+
+    figsize = (12, 8)
+    title = None
+    titlePad = 6
+
+    def __init__(self):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        self.fig = Figure(figsize=self.figsize)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.rendered = 0
+        self._svg = None
+
+    def read(self, path):
+        return pd.read_csv(path, index_col=0)
+
+    def draw(self, ax, df, **options):
+        raise NotImplementedError
+
+    def render(self, df, basePath, formats=('png',), title=None, **options):
+        '''
+        (DataFrame, str, list, str) -> list
+
+        Redraws the template with df and writes basePath.<format> for each
+        format. Returns the files written.
+        '''
+        self.ax.cla()
+        self.fig.set_size_inches(*self.figsize)
+        self.draw(self.ax, df, **options)
+        title = title or self.title
+        if title:
+            self.ax.set_title(title, fontsize=16, pad=self.titlePad)
+        self.rendered += 1
+
+        # The tight bounding box is measured once, not by every savefig
+        bbox = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(0.1)
+        self._svg = None
+        written = []
+        for fmt in formats:
+            path = '{0}.{1}'.format(basePath, fmt)
+            if fmt == 'png':
+                self.fig.savefig(path, format='png', dpi=DPI, bbox_inches=bbox)
+            else:
+                text = self.svg(bbox) if fmt == 'svg' else self.html(df, title, bbox, **options)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+            written.append(path)
+        return written
+
+    def svg(self, bbox):
+        # Drawn once per chart, shared by the .svg file and the HTML page
+        if self._svg is None:
+            buf = io.StringIO()
+            self.fig.savefig(buf, format='svg', bbox_inches=bbox)
+            self._svg = buf.getvalue()
+        return self._svg
+
+    def html(self, df, title, bbox, **options):
+        '''
+        (DataFrame, str, Bbox) -> str
+
+        A standalone page with the drawn figure as inline SVG.
+        '''
+        body = self.svg(bbox)
+        return HTML_PAGE.format(title=html.escape(title or ''), body=body[body.index('<svg'):])
+
+
+## --------------Ecoregion Charts--------------------
+
+class StackedBarsTemplate(ChartTemplate):
+    '''
+    Stacked horizontal bars, one per index value, one segment per column.
+    The figure grows with the number of bars.
+    '''
+
+    colors = ('red', 'coral', 'yellowgreen', 'darkgreen')
+    xlabel = None
+    xlim = None
+
+    def draw(self, ax, df, xlabel=None):
+        self.fig.set_size_inches(self.figsize[0], max(self.figsize[1], 0.22 * len(df)))
+        y = np.arange(len(df))
+        left = np.zeros(len(df))
+        for col, color in zip(df.columns, self.colors):
+            vals = df[col].to_numpy(dtype=np.float64)
+            ax.barh(y, vals, left=left, color=color, label=str(col), height=0.5)
+            left += vals
+        ax.set_yticks(y)
+        ax.set_yticklabels([str(i) for i in df.index])
+        ax.set_ylim(-0.5, len(df) - 0.5)
+        ax.set_ylabel(ECO_LABELS.get(df.index.name, df.index.name), fontsize=14)
+        ax.set_xlabel(xlabel or self.xlabel or '', fontsize=14)
+        if self.xlim:
+            ax.set_xlim(*self.xlim)
+        ax.legend(loc='upper left', bbox_to_anchor=(1.01, 1), frameon=True)
+
+
+class EcoregionBinsTemplate(StackedBarsTemplate):
+    figsize = (12, 10)
+    xlabel = 'Number of Groups'
+
+
+class EcoregionBreakdownTemplate(StackedBarsTemplate):
+    figsize = (12, 10)
+    colors = ('darkgreen', 'yellowgreen', 'tan', 'lightgrey')
+    xlabel = 'Percent of Ecoregion'
+    xlim = (0, 100)
+
+
+## --------------NVC Summarization Charts--------------------
+
+class ClassBoxplotTemplate(ChartTemplate):
+    '''
+    Box plots of the groups' '% Protected 1 & 2' and '% Protected 1, 2 & 3'
+    for each natural class (group pivot).
+    '''
+
+    figsize = (12, 6)
+    title = 'NVC Classes by Protection Status'
+    series = (('% Protected 1 & 2', '#4c72b0'), ('% Protected 1, 2 & 3', '#dd8452'))
+
+    def read(self, path):
+        return pd.read_csv(path)
+
+    def draw(self, ax, df, by=None):
+        from matplotlib.patches import Patch
+        by = by or _class_column(df)
+        classes = _class_order(df[by])
+        x = np.arange(len(classes))
+        for j, (col, color) in enumerate(self.series):
+            data = [df.loc[df[by] == c, col].dropna().to_numpy() for c in classes]
+            bp = ax.boxplot(data, positions=x + (j - 0.5) * 0.35, widths=0.3, patch_artist=True,
+                            manage_ticks=False)
+            for box in bp['boxes']:
+                box.set_facecolor(color)
+        ax.set_xticks(x)
+        ax.set_xticklabels([_abbreviation(c) for c in classes])
+        ax.set_xlim(-0.6, len(classes) - 0.4)
+        ax.set_xlabel('NVC Class', fontsize=12)
+        ax.set_ylabel('Percent of Mapped Area', fontsize=12)
+        ax.legend(handles=[Patch(facecolor=c, label=l) for l, c in self.series],
+                  title='Percent Protected', loc='upper left', bbox_to_anchor=(1.01, 1))
+
+
+class ClassBinsTemplate(ChartTemplate):
+    '''
+    Overlaid horizontal bars of the number of groups per class in each
+    bin (class_protection_bins wide frame: LT1, LT17, LT50, GT50).
+    '''
+
+    figsize = (8, 5)
+    bars = (('LT17', '< 17% Protected', 'orangered'),
+            ('LT50', '17-50% Protected', 'y'),
+            ('GT50', '> 50% Protected', 'forestgreen'),
+            ('LT1', '< 1% Protected', 'red'))
+
+    def read(self, path):
+        return pd.read_csv(path)
+
+    def draw(self, ax, df, by=None):
+        by = by or _class_column(df)
+        y = np.arange(len(df))
+        for col, label, color in self.bars:
+            ax.barh(y, df[col].to_numpy(), color=color, label=label, height=0.8)
+        ax.set_yticks(y)
+        ax.set_yticklabels(list(df[by]))
+        ax.invert_yaxis()
+        ax.set_xlim(0, max(100, df[[b[0] for b in self.bars]].to_numpy().max()))
+        ax.set_xlabel('Number of NVC Groups in a Class By Protection Amount Category')
+        ax.legend(ncol=1, loc='lower right', frameon=True)
+        for side in ('left', 'bottom', 'top', 'right'):
+            ax.spines[side].set_visible(False)
+
+
+class ClassBinCountsTemplate(ChartTemplate):
+    '''
+    Grouped bars of the number of groups in each protection category by
+    class (class_protection_bins long frame: class, ProtCat, nGroups).
+    '''
+
+    figsize = (6, 10)
+    title = 'Number of Groups in Protection Categories by Class'
+
+    def read(self, path):
+        return pd.read_csv(path)
+
+    def draw(self, ax, df, by=None):
+        by = by or _class_column(df)
+        classes = _class_order(df[by])
+        cats = list(pd.unique(df['ProtCat']))
+        dfWide = df.pivot_table(index=by, columns='ProtCat', values='nGroups', aggfunc='sum',
+                                fill_value=0).reindex(index=classes, columns=cats, fill_value=0)
+        x = np.arange(len(classes))
+        width = 0.8 / max(len(cats), 1)
+        for j, cat in enumerate(cats):
+            ax.bar(x - 0.4 + (j + 0.5) * width, dfWide[cat].to_numpy(), width, label=str(cat))
+        ax.set_xticks(x)
+        ax.set_xticklabels([_abbreviation(c) for c in classes], rotation=45)
+        ax.set_xlabel('NVC Class', fontsize=12)
+        ax.set_ylabel('Number of NVC Groups', fontsize=12)
+        leg = ax.legend(loc='upper right')
+        leg.set_title('Protection Categories', prop={'size': 11})
+
+
+## --------------Management Chart--------------------
+
+class ManagementTemplate(ChartTemplate):
+    '''
+    Stacked Protected / Multiple Use km2 bars grouped by management
+    category and class (summarize_by_manager output). The HTML page is the
+    interactive Bokeh chart of ManagementSummary.py when Bokeh is
+    installed, the static chart otherwise.
+    '''
+
+    figsize = (16, 7)
+    title = 'Management by USNVC Class'
+    titlePad = 32
+    colors = ('#286000', '#a6e883')  # Protected | Multiple Use
+
+    def __init__(self):
+        ChartTemplate.__init__(self)
+        self._bokeh = None
+
+    def read(self, path):
+        df = pd.read_csv(path, index_col=0)
+        df.index = pd.Index([ast.literal_eval(i) for i in df.index], name='CatCls',
+                            tupleize_cols=False)
+        return df
+
+    def _positions(self, df):
+        # One bar per row with a gap between management categories
+        cats = [c for c, _ in df.index]
+        newCat = np.r_[0, [a != b for a, b in zip(cats[1:], cats[:-1])]].cumsum()
+        return np.arange(len(df)) + newCat * 0.8, cats
+
+    def draw(self, ax, df, yMax=None):
+        from matplotlib.ticker import FuncFormatter
+        x, cats = self._positions(df)
+        bottom = np.zeros(len(df))
+        for col, color in zip(('Protected', 'Multiple Use'), self.colors):
+            vals = df[col].to_numpy(dtype=np.float64)
+            ax.bar(x, vals, 0.8, bottom=bottom, color=color, label=col)
+            bottom += vals
+        ax.set_xticks(x)
+        ax.set_xticklabels([n for _, n in df.index], rotation=90, fontsize=8)
+        for cat in pd.unique(pd.Series(cats)):
+            at = x[[c == cat for c in cats]]
+            ax.text(at.mean(), 1.01, textwrap.fill(cat, 18), transform=ax.get_xaxis_transform(),
+                    ha='center', va='bottom', fontsize=9)
+        if len(df):
+            ax.set_xlim(x.min() - 1, x.max() + 1)
+        ax.set_ylim(0, yMax or max(bottom.max(initial=0) * 1.1, 1))
+        ax.yaxis.set_major_formatter(FuncFormatter(lambda v, pos: '{0:,.0f}'.format(v)))
+        ax.set_ylabel('Square Kilometers')
+        ax.legend(loc='upper center', ncol=2, bbox_to_anchor=(0.5, -0.35))
+
+    def _bokeh_figure(self):
+        # Built once; each page only replaces the data and the ranges
+        from bokeh.models import ColumnDataSource, FactorRange, HoverTool, NumeralTickFormatter
+        from bokeh.plotting import figure
+
+        source = ColumnDataSource(data={'CatCls': [], 'Protected': [], 'Multiple Use': [],
+                                        'Total Area': []})
+        p = figure(title=self.title, width=1100, x_range=FactorRange())
+        p.vbar_stack(['Protected', 'Multiple Use'], x='CatCls', width=0.8,
+                     color=list(self.colors), source=source,
+                     legend_label=['Protected', 'Multiple Use'])
+        p.add_tools(HoverTool(tooltips=[('Protected', '@Protected{0,0}'),
+                                        ('Multiple Use', '@{Multiple Use}{0,0}'),
+                                        ('Total', '@{Total Area}{0,0}')]))
+        p.title.align = 'center'
+        p.title.text_font_size = '12pt'
+        p.legend.location = 'top_center'
+        p.legend.orientation = 'horizontal'
+        p.xaxis.major_label_orientation = 1.55
+        p.y_range.start = 0
+        p.yaxis[0].formatter = NumeralTickFormatter(format='0,0')
+        p.yaxis.axis_label = 'Square Kilometers'
+        p.yaxis.axis_label_text_font_style = 'normal'
+        return p, source
+
+    def html(self, df, title, bbox, yMax=None):
+        try:
+            from bokeh.embed import file_html
+            from bokeh.resources import CDN
+        except ImportError:
+            return ChartTemplate.html(self, df, title, bbox)
+        if self._bokeh is None:
+            self._bokeh = self._bokeh_figure()
+        p, source = self._bokeh
+        factors = list(df.index)
+        source.data = {'CatCls': factors,
+                       'Protected': df['Protected'].to_numpy(),
+                       'Multiple Use': df['Multiple Use'].to_numpy(),
+                       'Total Area': df['Total Area'].to_numpy()}
+        p.x_range.factors = factors
+        p.y_range.end = yMax or (float(df['Total Area'].max()) * 1.1 if len(df) else 1)
+        p.title.text = title or self.title
+        return file_html(p, CDN, title or self.title)
+
+
+CHARTS = {'ecoregion_bins': EcoregionBinsTemplate,
+          'ecoregion_breakdown': EcoregionBreakdownTemplate,
+          'class_boxplot': ClassBoxplotTemplate,
+          'class_bins': ClassBinsTemplate,
+          'class_bin_counts': ClassBinCountsTemplate,
+          'management': ManagementTemplate}
+
+
+#############################################################################################
+###################################### RENDERING ############################################
+#############################################################################################
+
+
+def get_template(chart):
+    '''
+    (str) -> ChartTemplate
+
+    Returns this process's template of a chart type, building it on first
+    use.
+    '''
+    if chart not in _TEMPLATES:
+        if chart not in CHARTS:
+            raise KeyError('Unknown chart {0}; one of {1}'.format(chart, sorted(CHARTS)))
+        _TEMPLATES[chart] = CHARTS[chart]()
+    return _TEMPLATES[chart]
+
+
+def render_chart(chart, data, basePath, formats=('png',), title=None, **options):
+    '''
+    (str, DataFrame or str, str, list, str) -> list
+
+    Draws one chart with the process's template and writes
+    basePath.<format> for each format. Returns the files written.
+
+    Arguments:
+    chart -- Chart type, a key of CHARTS
+    data -- Chart frame, or the path of the CSV it was saved to
+    basePath -- Output path without the extension
+    formats -- Any of FORMATS
+    title -- Chart title, the template's default when None
+    options -- Passed to the template's draw, e.g. xlabel or yMax
+    '''
+    bad = set(formats) - set(FORMATS)
+    if bad:
+        raise ValueError('Unknown formats {0}; use {1}'.format(sorted(bad), FORMATS))
+    template = get_template(chart)
+    df = template.read(data) if isinstance(data, str) else data
+    return template.render(df, basePath, formats, title, **options)
+
+
+def _render_job(job):
+    t0 = time.perf_counter()
+    job = dict(job)
+    try:
+        files = render_chart(job.pop('chart'), job.pop('data'), job.pop('basePath'), **job)
+        return {'files': files, 'seconds': round(time.perf_counter() - t0, 4)}
+    except Exception:
+        return {'files': [], 'error': traceback.format_exc()}
+
+
+def csv_jobs(folder, formats=('png',)):
+    '''
+    (str, list) -> list
+
+    Returns a render job for every chart CSV (see CSV_CHARTS) under
+    folder. Each chart is written next to its CSV.
+    '''
+    jobs = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name in CSV_CHARTS:
+                chart, options = CSV_CHARTS[name]
+                path = os.path.join(root, name)
+                jobs.append(dict(options, chart=chart, data=path, basePath=path[:-4],
+                                 formats=list(formats)))
+    return jobs
+
+
+def render_jobs(jobs, workers=None, verbose=True):
+    '''
+    (list, int, bool) -> list
+
+    Renders many charts over a process pool. Each job is a dict of
+    render_chart arguments (chart, data, basePath, formats, title and
+    options); CSV paths are cheaper to send to the workers than frames.
+    Returns one record per job, in job order, with the files written and
+    the seconds taken, or the error.
+
+    Arguments:
+    jobs -- Render jobs
+    workers -- Worker processes, all cores by default; 1 renders here
+    verbose -- Print the number of charts per minute
+    '''
+    t0 = time.perf_counter()
+    workers = max(1, min(int(workers or os.cpu_count() or 1), len(jobs)))
+    if workers == 1:
+        records = [_render_job(j) for j in jobs]
+    else:
+        # Chunks of one chart type keep each worker on one template at a time
+        order = sorted(range(len(jobs)), key=lambda i: jobs[i]['chart'])
+        chunk = max(1, len(jobs) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            done = list(pool.map(_render_job, [jobs[i] for i in order], chunksize=chunk))
+        records = [None] * len(jobs)
+        for i, rec in zip(order, done):
+            records[i] = rec
+    seconds = time.perf_counter() - t0
+
+    for job, rec in zip(jobs, records):
+        rec['chart'], rec['basePath'] = job['chart'], job['basePath']
+    if verbose:
+        failed = [r for r in records if r.get('error')]
+        print('{0} charts on {1} workers in {2:.1f} s: {3:.0f} charts/minute'.format(
+            len(jobs), workers, seconds, len(jobs) / seconds * 60 if seconds else 0))
+        for r in failed:
+            print('+' * 45)
+            print('{0} failed:\n{1}'.format(r['basePath'], r['error']))
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the USNVC charts from their CSVs')
+    parser.add_argument('folder', help='Folder searched for chart CSVs, e.g. a batch outDir')
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=FORMATS)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes, 1 to render in this process')
+    args = parser.parse_args(argv)
+    records = render_jobs(csv_jobs(args.folder, args.formats), args.workers)
+    return 1 if any(r.get('error') for r in records) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        rollup.py
+
+        Hierarchical roll-ups (group -> macrogroup -> class, L4 -> L3 -> L2)
+        from one aggregation per scenario.
+
+        The notebook builds the class summaries, the group pivot, the group
+        and macrogroup by ecoregion bins and the ecoregion breakdown as
+        separate passes over dfTable, each with its own filters (natural
+        classes, non-Ruderal groups) and its own pivot / fillna / PAD
+        recompute steps, so nothing ties their totals together.
+
+        RollupEngine indexes the paths of each hierarchy found in the cube:
+
+            nvc         NaturalType -> CLASS -> MACROGROUP -> GROUP ->
+                        GROUP_CODE
+            eco         NA_L2NAME -> US_L3NAME -> US_L4NAME
+            manager     MANG_TYPE -> MANG_NAME
+            status      GAPST_CD
+
+        A path is one distinct chain of labels. Paths are sorted, so every
+        node of a coarser level (a macrogroup, an L3 ecoregion) covers one
+        contiguous run of paths, and rolling a path axis up to that level
+        is a single np.add.reduceat over the run starts.
+
+        aggregate sums the cube rows once into a dense array over the paths
+        of a few hierarchies (e.g. nvc x eco x status) after masking the
+        rows with the scenario filters. RollupSums then answers any level
+        from that array by segment sums:
+
+            rollup      the frame of CountCube.rollup, for the PAD pivots
+                        and the management summary
+            tensor      a CountTensor, for the ecoregion bins and dfC
+
+        With sparse=True the sums are kept only for the path combinations
+        present (SparseRollupSums), so all four hierarchies fit in one
+        aggregation, where the dense nvc x eco x manager x status array
+        would not. Each query projects those cells onto the trees it uses
+        (one bincount over the cells, kept for reuse) and answers from the
+        dense RollupSums of the projection.
+
+        Filters on an aggregated hierarchy (the natural classes, Ruderal
+        groups) are masks on its path axis, so every output of a scenario
+        comes out of the same sums.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+
+from .cellarea import AREA_COL
+from .cube import CountCube, pack_keys, unpack_keys
+from .lookups import ECO_LEVELS
+from .tensor import CountTensor
+
+
+# Hierarchies indexed by the engine, coarse to fine. Cube dimensions in
+# none of them become single-level hierarchies of their own.
+ROLLUP_TREES = [('nvc', ['NaturalType', 'CLASS', 'MACROGROUP', 'GROUP', 'GROUP_CODE']),
+                ('eco', list(ECO_LEVELS)),
+                ('manager', ['MANG_TYPE', 'MANG_NAME']),
+                ('status', ['GAPST_CD'])]
+
+# Measure counting the cube rows summed into each cell
+ROWS = '_rows'
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+def _filter_codes(labels, vals):
+    # Codes selected by a filter value or list, -1 for None as in CountCube.slice
+    if np.isscalar(vals) or vals is None:
+        vals = [vals]
+    idx = labels.get_indexer([v for v in vals if v is not None])
+    idx = list(idx[idx >= 0])
+    if any(v is None for v in vals):
+        idx.append(-1)
+    return idx
+
+
+def _along(mask, axis, ndim):
+    # Reshapes a 1-D mask to broadcast along one axis
+    shape = [1] * ndim
+    shape[axis] = len(mask)
+    return mask.reshape(shape)
+
+
+#############################################################################################
+##################################### HIERARCHIES ###########################################
+#############################################################################################
+
+class RollupTree(object):
+    '''
+    Sorted distinct label paths of one hierarchy.
+
+    Attributes:
+    name -- Hierarchy name, e.g. nvc
+    levels -- Level (dimension) names, coarse to fine
+    labels -- Dictionary of level -> Index of labels (the cube's)
+    pathCodes -- Dictionary of level -> label code of every path, -1 for
+        missing
+    starts -- Dictionary of level -> index of the first path of every node
+        of that level; a node is a distinct path prefix
+    '''
+
+    def __init__(self, name, levels, labels, pathCodes):
+        self.name = name
+        self.levels = list(levels)
+        self.labels = labels
+        self.pathCodes = pathCodes
+        n = len(pathCodes[self.levels[0]])
+        change = np.zeros(n, dtype=bool)
+        change[:1] = True
+        self.starts = {}
+        for lev in self.levels:
+            c = pathCodes[lev]
+            change[1:] |= c[1:] != c[:-1]
+            self.starts[lev] = np.flatnonzero(change)
+
+    @classmethod
+    def from_cube(cls, cube, name, levels):
+        '''
+        (CountCube, str, list) -> RollupTree, ndarray
+
+        Returns the tree of the cube's distinct paths over the levels and
+        the path of every cube row.
+        '''
+        radices = [len(cube.labels[d]) for d in levels]
+        key = pack_keys([cube.codes[d] for d in levels], radices)
+        # Packed keys sort like the label tuples, missing labels last
+        uniq, inv = np.unique(key, return_inverse=True)
+        pathCodes = dict(zip(levels, unpack_keys(uniq, radices)))
+        labels = {d: cube.labels[d] for d in levels}
+        return cls(name, levels, labels, pathCodes), inv.ravel()
+
+    def __len__(self):
+        return len(self.pathCodes[self.levels[0]])
+
+    def __repr__(self):
+        return 'RollupTree({0}: {1}; {2} paths)'.format(
+            self.name, ' -> '.join(self.levels), len(self))
+
+    def path_mask(self, where=None, exclude=None):
+        '''
+        (dict, dict) -> ndarray
+
+        Returns the paths matching the filters on this tree's levels, see
+        CountCube.slice. Filters on other dimensions are ignored.
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        for filters, keep in ((where, True), (exclude, False)):
+            for d, vals in (filters or {}).items():
+                if d in self.levels:
+                    hit = np.isin(self.pathCodes[d], _filter_codes(self.labels[d], vals))
+                    mask &= hit if keep else ~hit
+        return mask
+
+    def reduce(self, arr, axis, levels):
+        '''
+        (ndarray, int, list) -> ndarray, list
+
+        Sums the path axis of arr up to the distinct label combinations of
+        the given levels. Returns the array with that axis over the
+        combinations, and one code array per level. Without levels the
+        axis is summed out.
+
+        Arguments:
+        arr -- Array with a path axis
+        axis -- Index of the path axis
+        levels -- Levels of this tree to keep
+        '''
+        if not levels:
+            return arr.sum(axis=axis), []
+        deep = self.levels[max(self.levels.index(lev) for lev in levels)]
+        starts = self.starts[deep]
+        # Paths are sorted, so each node of the deepest level is one run
+        if len(starts) == len(self):
+            nodes = arr
+        elif len(starts):
+            nodes = np.add.reduceat(arr, starts, axis=axis)
+        else:
+            nodes = np.zeros(arr.shape[:axis] + (0,) + arr.shape[axis + 1:])
+        codes = [self.pathCodes[lev][starts] for lev in levels]
+        if list(levels) == self.levels[:self.levels.index(deep) + 1]:
+            # Full prefixes are already distinct
+            return nodes, codes
+
+        # Levels skipped (e.g. GROUP without MACROGROUP) can repeat a combination
+        radices = [len(self.labels[lev]) for lev in levels]
+        uniq, inv = np.unique(pack_keys(codes, radices), return_inverse=True)
+        if len(uniq) == len(starts):
+            return nodes, codes
+        moved = np.moveaxis(nodes, axis, 0)
+        out = np.zeros((len(uniq),) + moved.shape[1:])
+        np.add.at(out, inv.ravel(), moved)
+        return np.moveaxis(out, 0, axis), unpack_keys(uniq, radices)
+
+
+#############################################################################################
+####################################### ENGINE ##############################################
+#############################################################################################
+
+class RollupEngine(object):
+    '''
+    Path indexes over a CountCube for hierarchical roll-ups.
+
+    Attributes:
+    cube -- The indexed CountCube
+    trees -- Dictionary of tree name -> RollupTree, in ROLLUP_TREES order
+    rowPaths -- Dictionary of tree name -> path of every cube row
+    '''
+
+    def __init__(self, cube, trees, rowPaths):
+        self.cube = cube
+        self.trees = trees
+        self.rowPaths = rowPaths
+
+    @classmethod
+    def from_cube(cls, cube, trees=ROLLUP_TREES):
+        '''
+        (CountCube, list) -> RollupEngine
+
+        Indexes the paths of every hierarchy in the cube.
+
+        Arguments:
+        cube -- CountCube
+        trees -- (name, levels) pairs; levels missing from the cube are
+            skipped
+        '''
+        built, rowPaths, used = {}, {}, set()
+        for name, levels in list(trees) + [(d, [d]) for d in cube.dims]:
+            levels = [d for d in levels if d in cube.dims and d not in used]
+            if not levels:
+                continue
+            used.update(levels)
+            built[name], rowPaths[name] = RollupTree.from_cube(cube, name, levels)
+        return cls(cube, built, rowPaths)
+
+    def __repr__(self):
+        return 'RollupEngine({0})'.format('; '.join(
+            '{0}={1}'.format(t.name, len(t)) for t in self.trees.values()))
+
+    def tree_of(self, dim):
+        '''
+        (str) -> RollupTree
+
+        Returns the tree a dimension belongs to.
+        '''
+        for tree in self.trees.values():
+            if dim in tree.levels:
+                return tree
+        raise KeyError('Not a cube dimension: {0}'.format(dim))
+
+    def mask(self, where=None, exclude=None):
+        '''
+        (dict, dict) -> ndarray
+
+        Returns the cube rows matching the filters, as CountCube.slice
+        would select them, through the path masks of each tree.
+        '''
+        mask = np.ones(len(self.cube), dtype=bool)
+        for d in list(where or {}) + list(exclude or {}):
+            self.tree_of(d)
+        for name, tree in self.trees.items():
+            pm = tree.path_mask(where, exclude)
+            if not pm.all():
+                mask &= pm[self.rowPaths[name]]
+        return mask
+
+    def aggregate(self, trees, where=None, exclude=None, mask=None, sparse=False):
+        '''
+        (list, dict, dict, ndarray, bool) -> RollupSums
+
+        Sums the cube rows kept by the filters over the paths of the given
+        trees: one bincount per measure (the counts, AREA_KM2 when the cube
+        has areas, and the number of cube rows). The sums are a dense array
+        (RollupSums), or with sparse the present path combinations only
+        (SparseRollupSums).
+
+        Arguments:
+        trees -- Tree names, e.g. ['nvc', 'eco', 'status']
+        where -- Optional filters, see CountCube.slice
+        exclude -- Optional exclusions
+        mask -- Cube rows to keep, instead of where and exclude
+        sparse -- Keep only the present cells
+        '''
+        trees = [self.trees[t] for t in trees]
+        if mask is None:
+            mask = self.mask(where, exclude)
+        shape = tuple(len(t) for t in trees)
+        flat = np.ravel_multi_index([self.rowPaths[t.name][mask] for t in trees], shape)
+        if sparse:
+            flat, cells = np.unique(flat, return_inverse=True)
+            cells, size = cells.ravel(), len(flat)
+        else:
+            cells, size = flat, int(np.prod(shape))
+        cube = self.cube
+        measures = {cube.value: cube.counts[mask].astype(np.float64)}
+        if cube.areas is not None:
+            measures[AREA_COL] = cube.areas[mask]
+        sums = {name: np.bincount(cells, weights=w, minlength=size)
+                for name, w in measures.items()}
+        sums[ROWS] = np.bincount(cells, minlength=size)
+        if sparse:
+            paths = np.unravel_index(flat, shape)
+            return SparseRollupSums(trees, paths, sums, cube.value, cube.counts.dtype,
+                                    int(mask.sum()))
+        sums = {name: arr.reshape(shape) for name, arr in sums.items()}
+        return RollupSums(trees, sums, cube.value, cube.counts.dtype, int(mask.sum()))
+
+
+class RollupSums(object):
+    '''
+    Cube sums over the paths of a few trees, from RollupEngine.aggregate.
+
+    Attributes:
+    trees -- RollupTree of each axis
+    sums -- Dictionary of measure name -> array over the path axes
+    value -- Name of the count measure
+    countDtype -- dtype of the cube counts
+    nRows -- Cube rows summed
+    '''
+
+    def __init__(self, trees, sums, value, countDtype, nRows):
+        self.trees = list(trees)
+        self.sums = sums
+        self.value = value
+        self.countDtype = countDtype
+        self.nRows = nRows
+
+    def __repr__(self):
+        return 'RollupSums({0}; {1} cube rows)'.format(
+            ' x '.join('{0}={1}'.format(t.name, len(t)) for t in self.trees), self.nRows)
+
+    def _levels(self, dims):
+        # Requested levels of every axis, in tree level order
+        dims = list(dims)
+        known = [d for t in self.trees for d in t.levels]
+        unknown = [d for d in dims if d not in known]
+        if unknown:
+            raise KeyError('Not dimensions of the aggregated trees: {0}'.format(unknown))
+        return [[d for d in t.levels if d in dims] for t in self.trees]
+
+    def _reduce(self, dims, where, exclude, measures):
+        '''
+        Masks the paths with the filters and reduces every axis to the
+        requested levels. Returns the reduced arrays and, per axis, a
+        dictionary of level -> codes.
+        '''
+        self._levels(list(where or {}) + list(exclude or {}))
+        levels = self._levels(dims)
+        out = {name: self.sums[name] for name in measures}
+        axisCodes = [{} for _ in self.trees]
+
+        def shrink(i):
+            if not levels[i]:
+                return 0.0
+            t = self.trees[i]
+            deep = max(t.levels.index(lev) for lev in levels[i])
+            return len(t.starts[t.levels[deep]]) / max(1, len(t))
+
+        # Axes that shrink the most go first, so the later segment sums run
+        # on small arrays. Summed-out axes stay as length 1 until the end.
+        for i in sorted(range(len(self.trees)), key=shrink):
+            t = self.trees[i]
+            pm = t.path_mask(where, exclude)
+            for name in measures:
+                arr = out[name]
+                if not pm.all():
+                    arr = arr * _along(pm, i, arr.ndim)
+                if levels[i]:
+                    arr, codes = t.reduce(arr, i, levels[i])
+                    axisCodes[i] = dict(zip(levels[i], codes))
+                else:
+                    arr = arr.sum(axis=i, keepdims=True)
+                out[name] = arr
+        drop = tuple(i for i in range(len(self.trees)) if not levels[i])
+        out = {name: arr.squeeze(axis=drop) for name, arr in out.items()}
+        return out, axisCodes
+
+    ## --------------Roll-ups--------------------
+
+    def rollup(self, by, where=None, exclude=None, dropna=True):
+        '''
+        (list, dict, dict, bool) -> DataFrame
+
+        Sums over every dimension not in by. Returns the same frame as
+        CountCube.rollup on the aggregated cube rows.
+
+        Arguments:
+        by -- Dimensions to keep, from the aggregated trees
+        where -- Optional filters on the aggregated trees
+        exclude -- Optional exclusions
+        dropna -- Drop combinations where any key is missing
+        '''
+        by = [by] if isinstance(by, str) else list(by)
+        measures = [self.value, ROWS] + ([AREA_COL] if AREA_COL in self.sums else [])
+        out, axisCodes = self._reduce(by, where, exclude, measures)
+        cells = np.nonzero(out[ROWS])
+        axes = [a for a, c in enumerate(axisCodes) if c]
+        codes = {d: axisCodes[a][d][cells[axes.index(a)]] for a in axes for d in axisCodes[a]}
+        labels = {d: t.labels[d] for t in self.trees for d in t.levels if d in by}
+        counts = out[self.value][cells]
+        if self.countDtype.kind in 'iub':
+            counts = np.rint(counts).astype(self.countDtype)
+        areas = out[AREA_COL][cells] if AREA_COL in out else None
+        # The combinations are distinct; the small cube formats and sorts them
+        cube = CountCube(by, {d: codes[d] for d in by}, labels, counts, self.value, areas)
+        return cube.rollup(by, dropna=dropna)
+
+    def tensor(self, dims, where=None, exclude=None):
+        '''
+        (list, dict, dict) -> CountTensor
+
+        Returns the CountTensor over dims (at most one level per tree), with
+        the axes in the order given.
+
+        Arguments:
+        dims -- Dimensions, e.g. [eco, 'GROUP', 'GAPST_CD']
+        where -- Optional filters on the aggregated trees
+        exclude -- Optional exclusions
+        '''
+        dims = list(dims)
+        levels = self._levels(dims)
+        if any(len(lev) > 1 for lev in levels):
+            raise ValueError('A tensor takes at most one level of each tree')
+        measures = [self.value] + ([AREA_COL] if AREA_COL in self.sums else [])
+        out, axisCodes = self._reduce(dims, where, exclude, measures)
+        kept = [(a, d) for a, lev in enumerate(levels) for d in lev]
+        labels = {d: self.trees[a].labels[d] for a, d in kept}
+
+        values = {}
+        for name, arr in out.items():
+            # Scatter each axis from its present labels into every label slot
+            for i, (a, d) in enumerate(kept):
+                codes = axisCodes[a][d]
+                slots = np.where(codes < 0, len(labels[d]), codes)
+                full = np.zeros(arr.shape[:i] + (len(labels[d]) + 1,) + arr.shape[i + 1:])
+                moved = np.moveaxis(full, i, 0)
+                moved[slots] = np.moveaxis(arr, i, 0)
+                arr = np.moveaxis(moved, 0, i)
+            order = [d for _, d in kept]
+            values[name] = np.transpose(arr, [order.index(d) for d in dims])
+        return CountTensor(dims, labels, values)
+
+
+class SparseRollupSums(object):
+    '''
+    Cube sums over the present path combinations of a few trees, from
+    RollupEngine.aggregate with sparse=True. rollup and tensor take the
+    same arguments as RollupSums and answer from the dense projection onto
+    the trees they use.
+
+    Attributes:
+    trees -- RollupTree of each axis
+    paths -- Path index on each axis of every present cell
+    sums -- Dictionary of measure name -> sum of every present cell
+    value -- Name of the count measure
+    countDtype -- dtype of the cube counts
+    nRows -- Cube rows summed
+    '''
+
+    def __init__(self, trees, paths, sums, value, countDtype, nRows):
+        self.trees = list(trees)
+        self.paths = list(paths)
+        self.sums = sums
+        self.value = value
+        self.countDtype = countDtype
+        self.nRows = nRows
+        self._projections = {}
+
+    def __repr__(self):
+        return 'SparseRollupSums({0}; {1} cells; {2} cube rows)'.format(
+            ' x '.join('{0}={1}'.format(t.name, len(t)) for t in self.trees),
+            len(self.sums[ROWS]), self.nRows)
+
+    def project(self, trees):
+        '''
+        (list) -> RollupSums
+
+        Returns the dense sums over the paths of some of the trees, the
+        others summed out. Projections are kept for later queries.
+
+        Arguments:
+        trees -- Tree names, in any order; the axes follow self.trees
+        '''
+        axes = [a for a, t in enumerate(self.trees) if t.name in trees]
+        key = tuple(axes)
+        if key not in self._projections:
+            shape = tuple(len(self.trees[a]) for a in axes)
+            size = int(np.prod(shape))
+            flat = np.ravel_multi_index([self.paths[a] for a in axes], shape)
+            sums = {name: np.bincount(flat, weights=w, minlength=size).reshape(shape)
+                    for name, w in self.sums.items()}
+            sums[ROWS] = np.rint(sums[ROWS]).astype(np.int64)
+            self._projections[key] = RollupSums([self.trees[a] for a in axes], sums,
+                                                self.value, self.countDtype, self.nRows)
+        return self._projections[key]
+
+    def _trees_of(self, dims):
+        # Trees holding any of the dimensions
+        dims = set(dims)
+        names = [t.name for t in self.trees if dims & set(t.levels)]
+        known = {d for t in self.trees for d in t.levels}
+        if not dims <= known:
+            raise KeyError('Not dimensions of the aggregated trees: {0}'.format(
+                sorted(dims - known)))
+        return names
+
+    def rollup(self, by, where=None, exclude=None, dropna=True):
+        '''
+        (list, dict, dict, bool) -> DataFrame
+
+        RollupSums.rollup on the projection onto the trees of by and the
+        filters.
+        '''
+        by = [by] if isinstance(by, str) else list(by)
+        used = by + list(where or {}) + list(exclude or {})
+        return self.project(self._trees_of(used)).rollup(by, where, exclude, dropna)
+
+    def tensor(self, dims, where=None, exclude=None):
+        '''
+        (list, dict, dict) -> CountTensor
+
+        RollupSums.tensor on the projection onto the trees of dims and the
+        filters.
+        '''
+        used = list(dims) + list(where or {}) + list(exclude or {})
+        return self.project(self._trees_of(used)).tensor(dims, where, exclude)
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        service.py
+
+        Local HTTP / JSON query service over the count cube.
+
+        The Bokeh hover chart in ManagementSummary.html answers one fixed
+        question; anything else meant editing the notebook and running it
+        again. This service loads the base CountCube once (as usnvc.batch
+        does) and answers GET queries against it:
+
+            /protection   % protected per group, macrogroup or class,
+                          optionally per ecoregion
+            /bins         groups (or macrogroups) per percent-protected bin
+                          for each ecoregion or class
+            /breakdown    % PAD 1 & 2 / 3 / 4 Converted / 4 Not Converted
+                          per ecoregion (dfC)
+            /management   cells and km2 by ManageCat x class x status
+            /dims         labels of the filter dimensions
+            /stats        cache hit ratio, entries, bytes, p50 / p99 latency
+
+        Parameters (numbers comma separated, labels repeated, e.g.
+        class=Forest%20%26%20Woodland&class=Desert%20%26%20Semi-Desert):
+
+            status      GAP statuses counted as protected (/management:
+                        kept), default 1,2
+            manageCat   ManageCat labels to keep
+            class       NVC classes to keep, with or without the number
+            eco         ecoregion level, NA_L2NAME, US_L3NAME or US_L4NAME
+            ecoregion   ecoregion labels (at eco) to keep
+            by          /protection: GROUP, MACROGROUP or CLASS;
+                        /bins: CLASS or the eco level
+            perEco      /protection: 1 for one row per ecoregion and group
+            level       /bins: GROUP or MACROGROUP
+            edges       /bins: interior bin edges, default 1,17,30
+            closed      /bins: right, left or open
+            natural     /bins: 1 (default) to count only natural classes
+                        and non-Ruderal groups, as the notebook and
+                        usnvc.batch do; 0 for every class and group
+
+        Every query is normalized (defaults filled, lists sorted and
+        de-duplicated) so equivalent URLs share one entry of a size-bounded
+        LRU cache holding the encoded JSON. Only the standard library is
+        used for serving; nothing leaves the machine.
+
+        Run from the Scripts folder:
+
+            python -m usnvc.service --synthetic 1000000 --port 8765
+            python -m usnvc.service --source attribute_table.csv --cache-mb 128
+
+        then e.g. http://127.0.0.1:8765/bins?eco=US_L3NAME&status=1,2,3
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import argparse
+import collections
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+from .batch import _filters, _protection_pivot, build_base_cube, status_label
+from .binning import CLOSED_RULES, EDGES_30
+from .cellarea import AREA_COL
+from .cube import CountCube
+from .lookups import CLASS_NUMBER, ECO_LEVELS, NATURAL_CLASSES, manage_category
+from .protection import CELL_KM2
+from .tensor import CountTensor
+
+
+ROUTES = ('protection', 'bins', 'breakdown', 'management')
+
+# Defaults of every query parameter; a query's key is its filled-in copy
+DEFAULT_QUERY = {'status': (1, 2),
+                 'manageCat': (),
+                 'class': (),
+                 'eco': 'NA_L2NAME',
+                 'ecoregion': (),
+                 'by': None,
+                 'perEco': '0',
+                 'level': 'GROUP',
+                 'edges': tuple(float(e) for e in EDGES_30),
+                 'closed': 'right',
+                 'natural': '1'}
+
+# Labels may hold commas, so only the number lists are split on them
+NUMBER_LISTS = ('status', 'edges')
+LABEL_LISTS = ('manageCat', 'class', 'ecoregion')
+
+# Latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+#############################################################################################
+###################################### LRU CACHE ############################################
+#############################################################################################
+
+class LRUCache(object):
+    '''
+    Least recently used cache of encoded results, bounded by total bytes
+    and by number of entries.
+
+    Attributes:
+    maxBytes -- Largest total size of the stored values
+    maxEntries -- Largest number of entries
+    hits, misses -- Lookup counts
+    '''
+
+    def __init__(self, maxBytes=64 * 2 ** 20, maxEntries=1024):
+        self.maxBytes = int(maxBytes)
+        self.maxEntries = int(maxEntries)
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        '''
+        (str) -> bytes
+
+        Returns the cached value and marks it recently used, None on a miss.
+        '''
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        '''
+        (str, bytes) -> None
+
+        Stores a value, evicting the least recently used entries until the
+        cache fits. Values larger than maxBytes are not stored.
+        '''
+        if len(value) > self.maxBytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.maxBytes or len(self._items) > self.maxEntries:
+                _, dropped = self._items.popitem(last=False)
+                self._bytes -= len(dropped)
+                self.evictions += 1
+
+    def stats(self):
+        '''
+        () -> dict
+
+        Returns the entry count, bytes, hits, misses and hit ratio.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._items), 'bytes': self._bytes,
+                    'maxBytes': self.maxBytes, 'maxEntries': self.maxEntries,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hitRatio': round(self.hits / lookups, 4) if lookups else None}
+
+
+#############################################################################################
+####################################### QUERIES #############################################
+#############################################################################################
+
+
+def _split(values):
+    out = []
+    for v in values:
+        out.extend(x.strip() for x in v.split(',') if x.strip())
+    return out
+
+
+def normalize_query(route, params):
+    '''
+    (str, dict) -> dict
+
+    Returns the query with defaults filled in and lists sorted and
+    de-duplicated, the form its cache key is built from. Raises
+    ValueError for unknown routes, parameters or values.
+
+    Arguments:
+    route -- One of ROUTES
+    params -- Dictionary of parameter -> list of strings, as from
+        urllib.parse.parse_qs
+    '''
+    if route not in ROUTES:
+        raise ValueError('Unknown query {0}; use one of {1}'.format(route, ROUTES))
+    unknown = set(params) - set(DEFAULT_QUERY)
+    if unknown:
+        raise ValueError('Unknown parameters: {0}'.format(sorted(unknown)))
+
+    q = dict(DEFAULT_QUERY)
+    for name, values in params.items():
+        if name in NUMBER_LISTS:
+            q[name] = _split(values)
+        elif name in LABEL_LISTS:
+            q[name] = list(values)
+        else:
+            q[name] = values[-1]
+    try:
+        q['status'] = tuple(sorted({int(s) for s in q['status']}))
+        q['edges'] = tuple(sorted({float(e) for e in q['edges']}))
+    except ValueError:
+        raise ValueError('status must be integers and edges numbers')
+    for name in LABEL_LISTS:
+        q[name] = tuple(sorted(set(q[name])))
+    q['class'] = tuple(sorted({CLASS_NUMBER.sub('', c).strip() for c in q['class']}))
+
+    if q['eco'] not in ECO_LEVELS:
+        raise ValueError('eco must be one of {0}'.format(ECO_LEVELS))
+    if not set(q['status']) <= {1, 2, 3, 4} or not q['status']:
+        raise ValueError('status must be GAP status codes 1 - 4')
+    if q['closed'] not in CLOSED_RULES:
+        raise ValueError('closed must be one of {0}'.format(CLOSED_RULES))
+    if q['level'] not in ('GROUP', 'MACROGROUP'):
+        raise ValueError('level must be GROUP or MACROGROUP')
+    if q['perEco'] not in ('0', '1'):
+        raise ValueError('perEco must be 0 or 1')
+    if q['natural'] not in ('0', '1'):
+        raise ValueError('natural must be 0 or 1')
+    if route == 'protection':
+        q['by'] = q['by'] or 'GROUP'
+        if q['by'] not in ('GROUP', 'MACROGROUP', 'CLASS'):
+            raise ValueError('by must be GROUP, MACROGROUP or CLASS')
+    elif route == 'bins':
+        q['by'] = q['by'] or q['eco']
+        if q['by'] not in ('CLASS', q['eco']):
+            raise ValueError('by must be CLASS or the eco level')
+    else:
+        q['by'] = None
+    # Drop the parameters the route does not use, so they do not split the cache
+    used = {'protection': ('status', 'manageCat', 'class', 'eco', 'ecoregion', 'by', 'perEco'),
+            'bins': ('status', 'manageCat', 'class', 'eco', 'ecoregion', 'by', 'level', 'edges',
+                     'closed', 'natural'),
+            'breakdown': ('manageCat', 'class', 'eco', 'ecoregion'),
+            'management': ('status', 'manageCat', 'class', 'eco', 'ecoregion')}[route]
+    return {k: q[k] for k in used}
+
+
+def query_key(route, query):
+    '''
+    (str, dict) -> str
+
+    Returns the cache key of a normalized query.
+    '''
+    return json.dumps([route, query], sort_keys=True)
+
+
+class QueryEngine(object):
+    '''
+    Answers normalized queries from a CountCube.
+
+    Attributes:
+    cube -- Base CountCube with NaturalType, as from batch.build_base_cube
+    '''
+
+    def __init__(self, cube):
+        self.cube = cube
+        classes = pd.Series(cube.labels['CLASS'])
+        self._classKeys = classes.map(lambda c: CLASS_NUMBER.sub('', c).strip()
+                                      if isinstance(c, str) else c)
+        self._ruderal = [g for g in cube.labels['GROUP'] if 'Ruderal' in str(g)]
+
+    def _where(self, q):
+        where = {}
+        if q.get('manageCat'):
+            where['ManageCat'] = list(q['manageCat'])
+        if q.get('class'):
+            hit = self._classKeys.isin(q['class']).to_numpy()
+            where['CLASS'] = list(self.cube.labels['CLASS'][hit])
+        if q.get('ecoregion'):
+            where[q['eco']] = list(q['ecoregion'])
+        return _filters(self.cube, where)
+
+    def run(self, route, q):
+        '''
+        (str, dict) -> DataFrame
+
+        Returns the result frame of a normalized query.
+        '''
+        where = self._where(q)
+        cube = self.cube.slice(where) if where else self.cube
+        return getattr(self, '_' + route)(cube, q)
+
+    def _protection(self, cube, q):
+        keys = ([q['eco']] if q['perEco'] == '1' else []) + \
+            (['CLASS'] if q['by'] != 'CLASS' else []) + [q['by']]
+        if q['by'] == 'GROUP':
+            keys.append('GROUP_CODE')
+        value = '% Protected ' + status_label(q['status'])
+        return _protection_pivot(cube, keys, q['status'], value)
+
+    def _bins(self, cube, q):
+        where, exclude = None, None
+        if q['natural'] == '1':
+            where, exclude = {'CLASS': list(NATURAL_CLASSES)}, {'GROUP': self._ruderal}
+        tensor = CountTensor.from_cube(cube, [q['by'], q['level'], 'GAPST_CD'],
+                                       where=where, exclude=exclude)
+        return tensor.bin_counts(q['by'], q['level'], q['status'], q['edges'],
+                                 q['closed']).sort_index().reset_index()
+
+    def _breakdown(self, cube, q):
+        return CountTensor.from_cube(cube, [q['eco'], 'GAPST_CD', 'NaturalType']) \
+            .breakdown(q['eco']).reset_index()
+
+    def _management(self, cube, q):
+        dfSum = cube.rollup(['MANG_NAME', 'CLASS', 'GAPST_CD'])
+        dfSum['ManageCat'] = manage_category(dfSum['MANG_NAME'])
+        sts = pd.to_numeric(dfSum['GAPST_CD'], errors='coerce')
+        dfSum = dfSum[sts.isin(q['status']).to_numpy()]
+        if AREA_COL not in dfSum.columns:
+            dfSum[AREA_COL] = dfSum['COUNT'] * CELL_KM2
+        dfOut = dfSum.groupby(['ManageCat', 'CLASS', 'GAPST_CD'], observed=True)[
+            ['COUNT', AREA_COL]].sum().reset_index()
+        return dfOut.rename(columns={AREA_COL: 'km2'})
+
+    def dims(self):
+        '''
+        () -> dict
+
+        Returns the labels a client can filter on.
+        '''
+        out = {'ManageCat': sorted(manage_category(pd.Series(self.cube.labels['MANG_NAME']))
+                                   .dropna().astype(str).unique()),
+               'CLASS': [str(c) for c in self.cube.labels['CLASS']]}
+        for lev in ECO_LEVELS:
+            if lev in self.cube.labels:
+                out[lev] = [str(c) for c in self.cube.labels[lev]]
+        return out
+
+
+#############################################################################################
+####################################### SERVICE #############################################
+#############################################################################################
+
+class QueryService(object):
+    '''
+    Cache, latency log and engine shared by the request handlers.
+    '''
+
+    def __init__(self, cube, maxBytes=64 * 2 ** 20, maxEntries=1024):
+        self.engine = QueryEngine(cube)
+        self.cache = LRUCache(maxBytes, maxEntries)
+        self._latency = collections.deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def answer(self, route, params):
+        '''
+        (str, dict) -> bytes, bool
+
+        Returns the JSON body of a query and whether it came from the
+        cache. Raises ValueError or KeyError for bad queries.
+        '''
+        t0 = time.perf_counter()
+        q = normalize_query(route, params)
+        key = query_key(route, q)
+        body = self.cache.get(key)
+        hit = body is not None
+        if not hit:
+            df = self.engine.run(route, q)
+            body = '{{"query": {0}, "columns": {1}, "rows": {2}}}'.format(
+                json.dumps(dict(q, route=route)), json.dumps([str(c) for c in df.columns]),
+                df.to_json(orient='values', double_precision=6)).encode()
+            self.cache.put(key, body)
+        self.record(time.perf_counter() - t0, hit)
+        return body, hit
+
+    def record(self, seconds, hit):
+        with self._lock:
+            self._latency.append((seconds, hit))
+
+    def stats(self):
+        '''
+        () -> dict
+
+        Returns the cache statistics and the p50 / p99 latency in ms of the
+        last LATENCY_WINDOW queries, overall and for hits and misses.
+        '''
+        with self._lock:
+            lat = np.array([s for s, _ in self._latency])
+            hits = np.array([h for _, h in self._latency], dtype=bool)
+        out = dict(self.cache.stats(), queries=len(lat),
+                   uptimeSeconds=round(time.time() - self.started, 1))
+        for name, sel in (('', slice(None)), ('Hit', hits), ('Miss', ~hits)):
+            vals = lat[sel] * 1000
+            for p in (50, 99):
+                out['p{0}{1}Ms'.format(p, name)] = \
+                    round(float(np.percentile(vals, p)), 3) if len(vals) else None
+        return out
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    service = None
+    quiet = True
+
+    def _send(self, status, body, extra=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (extra or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        route = url.path.strip('/')
+        params = urllib.parse.parse_qs(url.query)
+        if route == 'stats':
+            return self._send(200, json.dumps(self.service.stats()).encode())
+        if route == 'dims':
+            return self._send(200, json.dumps(self.service.engine.dims()).encode())
+        try:
+            body, hit = self.service.answer(route, params)
+        except (ValueError, KeyError) as e:
+            status = 404 if route not in ROUTES else 400
+            return self._send(status, json.dumps({'error': str(e)}).encode())
+        self._send(200, body, {'X-Cache': 'HIT' if hit else 'MISS'})
+
+    def log_message(self, fmt, *args):
+        if not self.quiet:
+            http.server.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+def make_server(cube, host='127.0.0.1', port=8765, maxBytes=64 * 2 ** 20, maxEntries=1024,
+                quiet=True):
+    '''
+    (CountCube, str, int, int, int, bool) -> ThreadingHTTPServer
+
+    Returns a threaded HTTP server answering queries on the cube; call
+    serve_forever() on it. Port 0 picks a free port (server_address).
+    '''
+    service = QueryService(cube, maxBytes, maxEntries)
+    handler = type('Handler', (_Handler,), {'service': service, 'quiet': quiet})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local USNVC summary query service')
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument('--source', help='attribute_table.csv')
+    src.add_argument('--synthetic', type=float, help='Rows of a synthetic table')
+    src.add_argument('--cube', help='Folder of a saved CountCube (CountCube.save)')
+    parser.add_argument('--cache-dir', default=None, help='Columnar cache of the CSV')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-mb', type=float, default=64, help='Result cache size in MB')
+    parser.add_argument('--cache-entries', type=int, default=1024)
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args(argv)
+
+    if args.cube:
+        cube = CountCube.load(args.cube)
+    else:
+        manifest = {'source': args.source, 'cacheDir': args.cache_dir,
+                    'synthetic': int(args.synthetic) if args.synthetic else None}
+        cube = build_base_cube(manifest)
+    server = make_server(cube, args.host, args.port, int(args.cache_mb * 2 ** 20),
+                         args.cache_entries, quiet=not args.verbose)
+    print('Serving {0} on http://{1}:{2}/ (stats at /stats)'.format(cube, *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        streaming.py
+
+        Chunked reads of the attribute table and of SQL results, folded into
+        running per-key cell counts.
+
+        pd.read_csv and psql.read_sql load the whole result before anything
+        is summed. For finer raster combines (L4 ecoregions x PADUS units x
+        NVC groups) that is millions of rows. Here rows arrive in chunks
+        (read_csv chunksize / cursor.fetchmany), each chunk is summed by key
+        and added to a CountAccumulator, and the chunk is dropped. Peak memory
+        is one chunk plus the distinct keys, and throughput is logged as
+        rows/sec as the stream goes.
+
+        The notebook's drop_duplicates over the analysis columns is kept with
+        RowDeduper, which remembers a 64-bit hash per distinct row instead of
+        the rows themselves. read_csv and fetchmany pick column dtypes per
+        chunk (GAPST_CD is int64 in a chunk without blanks and float64 in
+        one with), so rows are hashed in a normalized form that does not
+        depend on them.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from .protection import add_protection_columns, pad_pivot
+from .vatcache import VAT_COLUMNS
+
+
+log = logging.getLogger(__name__)
+
+CHUNKSIZE = 500000
+
+HASH_PRIME = np.uint64(1099511628211)
+NA_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+def _row_hash(chunk):
+    '''
+    64-bit hash of every row over all columns. Numbers are hashed as
+    float64 and missing values as one constant, since a column parses as
+    int in one chunk and float (or all-NaN float for a text column) in
+    another when only some chunks have missing values.
+    '''
+    h = np.zeros(len(chunk), dtype=np.uint64)
+    for col in chunk.columns:
+        s = chunk[col]
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            v = s.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            v = s.to_numpy(dtype=object)
+        colHash = pd.util.hash_array(v)
+        colHash[s.isna().to_numpy()] = NA_HASH
+        # uint64 arithmetic wraps around
+        h = h * HASH_PRIME + colHash
+    return h
+
+
+#############################################################################################
+###################################### CHUNK SOURCES ########################################
+#############################################################################################
+
+
+def iter_csv_chunks(csvPath, chunksize=CHUNKSIZE, columns=VAT_COLUMNS):
+    '''
+    (str, int, list) -> iterator of DataFrame
+
+    Yields the attribute table CSV in chunks with uppercase column names,
+    keeping only the analysis columns.
+    '''
+    upper = set(c.upper() for c in columns)
+    reader = pd.read_csv(csvPath, chunksize=chunksize,
+                         usecols=lambda c: c.upper() in upper)
+    for chunk in reader:
+        chunk.columns = [x.upper() for x in chunk.columns]
+        yield chunk[list(columns)]
+
+
+def iter_sql_chunks(db, sql, chunksize=CHUNKSIZE, params=None):
+    '''
+    (AnalyticDB, str, int, list) -> iterator of DataFrame
+
+    Yields the result of a query in chunks with cursor.fetchmany, on a
+    pooled connection of a usnvc.database.AnalyticDB.
+    '''
+    with db.connection() as conn:
+        cur = conn.cursor()
+        if params is None:
+            cur.execute(sql)
+        else:
+            cur.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records([tuple(r) for r in rows], columns=cols)
+
+
+#############################################################################################
+##################################### ACCUMULATORS ##########################################
+#############################################################################################
+
+class RowDeduper(object):
+    '''
+    Drops rows already seen in earlier chunks (or earlier in the same chunk),
+    like DataFrame.drop_duplicates over the whole stream. Only one uint64
+    hash per distinct row is kept, see _row_hash.
+    '''
+
+    def __init__(self):
+        self.seen = np.empty(0, dtype=np.uint64)
+
+    def __call__(self, chunk):
+        h = _row_hash(chunk)
+        # First occurrence of each hash within the chunk
+        uniq, first = np.unique(h, return_index=True)
+        pos = np.searchsorted(self.seen, uniq)
+        pos[pos == len(self.seen)] = 0
+        new = self.seen[pos] != uniq if len(self.seen) else np.ones(len(uniq), dtype=bool)
+        self.seen = np.union1d(self.seen, uniq[new])
+        keep = np.zeros(len(chunk), dtype=bool)
+        keep[first[new]] = True
+        return chunk[keep]
+
+
+class CountAccumulator(object):
+    '''
+    Running sum of a count column per key over a stream of chunks.
+
+    Each chunk is reduced with groupby(keys).sum() before it is merged, so
+    the accumulator only ever holds one row per distinct key.
+    '''
+
+    def __init__(self, keys, value='COUNT'):
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.value = value
+        self.total = None
+        self.nRows = 0
+        self.nChunks = 0
+
+    def add(self, chunk):
+        '''
+        (DataFrame) -> None
+
+        Folds one chunk into the running sums. Rows with a missing key are
+        skipped, as groupby does.
+        '''
+        part = chunk.groupby(self.keys, sort=False, observed=True)[self.value].sum()
+        if self.total is None:
+            self.total = part
+        else:
+            self.total = self.total.add(part, fill_value=0)
+        self.nRows += len(chunk)
+        self.nChunks += 1
+
+    def __len__(self):
+        return 0 if self.total is None else len(self.total)
+
+    def result(self):
+        '''
+        () -> DataFrame
+
+        Returns the sums as df.groupby(keys)[value].sum().reset_index()
+        would for the whole stream.
+        '''
+        if self.total is None:
+            return pd.DataFrame(columns=self.keys + [self.value])
+        total = self.total.sort_index()
+        if total.dtype.kind == 'f' and np.all(np.mod(total.to_numpy(), 1) == 0):
+            # add(fill_value=0) upcasts to float; cell counts are whole numbers
+            total = total.astype(np.int64)
+        return total.reset_index()
+
+
+#############################################################################################
+####################################### STREAMING ###########################################
+#############################################################################################
+
+
+def stream_counts(chunks, keys, value='COUNT', dedupe=False, transform=None, logEvery=1):
+    '''
+    (iterator, list, str, bool, function, int) -> DataFrame
+
+    Sums value by keys over a stream of chunks and returns the
+    reset-index group-by frame. Progress (rows, rows/sec, distinct keys)
+    is logged every logEvery chunks.
+
+    Arguments:
+    chunks -- Iterator of DataFrames, e.g. iter_csv_chunks(...)
+    keys -- Column or list of columns to sum within
+    value -- Column of cell counts
+    dedupe -- Drop rows repeated anywhere in the stream first, like the
+        notebook's drop_duplicates on the attribute table
+    transform -- Optional function applied to each chunk after dedupe,
+        e.g. recodes or class filters; returns the chunk to count
+    logEvery -- Chunks between progress messages
+    '''
+    acc = CountAccumulator(keys, value)
+    dedup = RowDeduper() if dedupe else None
+    t0 = time.perf_counter()
+    nRead = 0
+    for chunk in chunks:
+        nRead += len(chunk)
+        if dedup is not None:
+            chunk = dedup(chunk)
+        if transform is not None:
+            chunk = transform(chunk)
+        acc.add(chunk)
+        if logEvery and acc.nChunks % logEvery == 0:
+            secs = time.perf_counter() - t0
+            log.info('%d rows read, %.0f rows/sec, %d keys', nRead,
+                     nRead / secs if secs > 0 else 0, len(acc))
+    secs = time.perf_counter() - t0
+    log.info('Done: %d rows in %.1f s (%.0f rows/sec), %d keys', nRead, secs,
+             nRead / secs if secs > 0 else 0, len(acc))
+    return acc.result()
+
+
+def stream_group_pivot(chunks, index=('CLASS', 'GROUP', 'GROUP_CODE'), status='GAPST_CD',
+                       value='COUNT', dedupe=True, transform=None, logEvery=1):
+    '''
+    (iterator, list, str, str, bool, function, int) -> DataFrame
+
+    Builds the PAD1 .. PAD4 group pivot (with km2 and percent protected
+    columns) from a stream of attribute table chunks with bounded memory.
+    The result matches the in-memory groupby / pivot of the notebook.
+
+    Arguments:
+    chunks -- Iterator of DataFrames, e.g. iter_csv_chunks(...)
+    index -- Columns identifying a row of the pivot
+    status -- GAP status column
+    value -- Column of cell counts
+    dedupe -- Drop duplicate rows across the stream (the notebook does)
+    transform -- Optional function applied to each chunk before counting
+    logEvery -- Chunks between progress messages
+    '''
+    index = [index] if isinstance(index, str) else list(index)
+    dfSum = stream_counts(chunks, [status] + index, value, dedupe, transform, logEvery)
+    return add_protection_columns(pad_pivot(dfSum, index, status, value))
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        summarytable.py
+
+        Materialized NVC protection summary table in the GAP analytic
+        database.
+
+        NVCSummarization.py and ManagementSummary.py each joined lu_boundary,
+        lu_boundary_gap_landfire, gap_landfire and the PAD table on every
+        run. build_summary_table does that join once and stores the cell
+        counts by PAD status x manager x class x group x ecoregion in
+        nvc_protection_summary, with indexes on the common group-by keys.
+        The scripts then run small aggregate queries against that table.
+
+        The ecoregion of each cell comes from lu_boundary, whose ecoregion
+        layer column (ECO_COLUMN, the boundary layer behind the VAT's
+        ECOREGIONS_L4) gives the L4 ecoregion of every boundary value.
+
+        The parameters the table was built with (PAD table, ecoregion
+        column) and signatures of the source tables are kept in
+        nvc_protection_summary_meta. ensure_summary_table rebuilds the
+        table when either changes. The sources are compared through the
+        catalog (row counts and modify dates), which costs no scan; the
+        full signature (row counts and the summed cell count) is taken at
+        build time and checked only with verify=True.
+
+        PAD is LEFT joined so cells outside PAD-US are kept with a NULL
+        status. Group totals therefore come from the same table, and status 4
+        is still derived as total - (1 + 2 + 3), because the PAD layer in the
+        analytic database leaves much of CONUS NULL.
+
+        The SQL is written for SQL Server ('mssql'), SQLite ('sqlite') and
+        DuckDB ('duckdb') so the same workflow runs against a local copy of
+        the tables (see database.py).
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import hashlib
+
+
+SUMMARY_TABLE = 'nvc_protection_summary'
+
+META_TABLE = 'nvc_protection_summary_meta'
+
+# Bump this when the summary table's SQL changes so old tables get rebuilt
+SUMMARY_VERSION = 2
+
+# Column of lu_boundary with the ecoregion layer value of each boundary
+ECO_COLUMN = 'ecoregions_l4'
+
+DIALECTS = ('mssql', 'sqlite', 'duckdb')
+
+# Columns of the summary table and their SQL types
+SUMMARY_COLUMNS = [('pad_status', 'VARCHAR(2)'),
+                   ('manage_name', 'VARCHAR(255)'),
+                   ('manage_type', 'VARCHAR(255)'),
+                   ('nvc_class', 'VARCHAR(255)'),
+                   ('nvc_group', 'VARCHAR(255)'),
+                   ('ecoregion', 'VARCHAR(255)'),
+                   ('n_cells', 'BIGINT')]
+
+# Columns of the table recording how each summary table was built
+META_COLUMNS = [('summary_table', 'VARCHAR(255)'),
+                ('pad_table', 'VARCHAR(255)'),
+                ('eco_column', 'VARCHAR(255)'),
+                ('version', 'INTEGER'),
+                ('source_signature', 'VARCHAR(255)')]
+
+SUMMARY_INDEXES = {'ix_nvcps_group': ['nvc_group', 'pad_status'],
+                   'ix_nvcps_class': ['nvc_class', 'pad_status'],
+                   'ix_nvcps_manage': ['manage_name', 'pad_status'],
+                   'ix_nvcps_eco': ['ecoregion', 'pad_status']}
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Building the Summary Table--------------------
+
+def summary_table_sql(dialect='mssql', padTable='padus1_4', ecoColumn=ECO_COLUMN,
+                      table=SUMMARY_TABLE):
+    '''
+    (str, str, str, str) -> list
+
+    Returns the SQL statements that (re)build the summary table, in order.
+
+    Arguments:
+    dialect -- 'mssql', 'sqlite' or 'duckdb'
+    padTable -- PAD table joined through lu_boundary, e.g. padus1_4
+    ecoColumn -- Column of lu_boundary holding the ecoregion of each
+        boundary value. When None the ecoregion column is left NULL.
+    table -- Name of the summary table
+    '''
+    if dialect not in DIALECTS:
+        raise ValueError('dialect must be one of {0}'.format(DIALECTS))
+
+    if dialect == 'mssql':
+        drop = "IF OBJECT_ID('{0}', 'U') IS NOT NULL DROP TABLE {0}".format(table)
+    else:
+        drop = 'DROP TABLE IF EXISTS {0}'.format(table)
+
+    create = 'CREATE TABLE {0} (\n\t{1}\n)'.format(
+        table, ',\n\t'.join('{0} {1}'.format(c, t) for c, t in SUMMARY_COLUMNS))
+
+    eco = 'CAST(lu_boundary.{0} AS VARCHAR(255))'.format(ecoColumn) if ecoColumn else \
+        'CAST(NULL AS VARCHAR(255))'
+    ecoGroup = ',\n\tlu_boundary.{0}'.format(ecoColumn) if ecoColumn else ''
+    insert = '''INSERT INTO {table} ({cols})
+SELECT
+	{pad}.gap_sts,
+	{pad}.d_mang_nam,
+	{pad}.d_mang_typ,
+	gap_landfire.nvc_class,
+	gap_landfire.nvc_group,
+	{eco},
+	sum(lu_boundary_gap_landfire.count)
+FROM	lu_boundary_gap_landfire
+	INNER JOIN gap_landfire
+	ON	lu_boundary_gap_landfire.gap_landfire = gap_landfire.value
+	INNER JOIN lu_boundary
+	ON	lu_boundary.value = lu_boundary_gap_landfire.boundary
+	LEFT JOIN {pad}
+	ON	lu_boundary.{pad} = {pad}.objectid
+GROUP BY
+	{pad}.gap_sts,
+	{pad}.d_mang_nam,
+	{pad}.d_mang_typ,
+	gap_landfire.nvc_class,
+	gap_landfire.nvc_group{ecoGroup}'''.format(
+        table=table, cols=', '.join(c for c, _ in SUMMARY_COLUMNS),
+        pad=padTable, eco=eco, ecoGroup=ecoGroup)
+
+    indexes = ['CREATE INDEX {0} ON {1} ({2})'.format(name, table, ', '.join(cols))
+               for name, cols in SUMMARY_INDEXES.items()]
+    return [drop, create, insert] + indexes
+
+
+def build_summary_table(conn, dialect='mssql', padTable='padus1_4', ecoColumn=ECO_COLUMN,
+                        table=SUMMARY_TABLE, signature=None):
+    '''
+    (connection, str, str, str, str, str) -> int
+
+    Builds (or rebuilds) the summary table through a DB-API connection,
+    records how it was built in META_TABLE and returns its row count.
+
+    Arguments:
+    conn -- DB-API connection to the analytic database
+    dialect -- 'mssql', 'sqlite' or 'duckdb'
+    padTable -- PAD table joined through lu_boundary, e.g. padus1_4
+    ecoColumn -- Column of lu_boundary holding the ecoregion, or None
+    table -- Name of the summary table
+    signature -- Source signature if already computed, see
+        source_signature
+    '''
+    if signature is None:
+        signature = source_signature(conn, padTable, dialect)
+    cur = conn.cursor()
+    for stmt in summary_table_sql(dialect, padTable, ecoColumn, table):
+        cur.execute(stmt)
+    if not summary_table_exists(conn, META_TABLE, dialect):
+        cur.execute('CREATE TABLE {0} (\n\t{1}\n)'.format(
+            META_TABLE, ',\n\t'.join('{0} {1}'.format(c, t) for c, t in META_COLUMNS)))
+    cur.execute('DELETE FROM {0} WHERE summary_table = ?'.format(META_TABLE), (table,))
+    cur.execute('INSERT INTO {0} ({1}) VALUES (?, ?, ?, ?, ?)'.format(
+        META_TABLE, ', '.join(c for c, _ in META_COLUMNS)),
+        _build_params(table, padTable, ecoColumn, signature))
+    conn.commit()
+    cur.execute('SELECT count(*) FROM {0}'.format(table))
+    return cur.fetchone()[0]
+
+
+def summary_table_exists(conn, table=SUMMARY_TABLE, dialect='mssql'):
+    '''
+    (connection, str, str) -> bool
+
+    Checks whether a table exists, from the database catalog.
+    '''
+    if dialect == 'sqlite':
+        sql = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+    else:
+        sql = 'SELECT count(*) FROM information_schema.tables WHERE table_name = ?'
+    cur = conn.cursor()
+    cur.execute(sql, (table,))
+    return cur.fetchone()[0] > 0
+
+
+def _source_tables(padTable):
+    return ['lu_boundary', 'lu_boundary_gap_landfire', 'gap_landfire', padTable]
+
+
+def _digest(parts):
+    return hashlib.sha1(';'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def catalog_signature(conn, padTable='padus1_4', dialect='mssql'):
+    '''
+    (connection, str, str) -> str
+
+    Returns a cheap signature of the source tables, read from the catalog
+    without scanning them: row counts and modify dates from
+    sys.dm_db_partition_stats / sys.tables on SQL Server, the estimated
+    sizes from duckdb_tables() on DuckDB, and the largest rowid (one index
+    seek) on SQLite. Reloading a table changes it.
+    '''
+    names = _source_tables(padTable)
+    cur = conn.cursor()
+    if dialect == 'mssql':
+        cur.execute('''SELECT t.name, t.modify_date, sum(s.row_count)
+FROM	sys.tables t
+	INNER JOIN sys.dm_db_partition_stats s
+	ON	s.object_id = t.object_id AND s.index_id IN (0, 1)
+WHERE	t.name IN (?, ?, ?, ?)
+GROUP BY t.name, t.modify_date''', names)
+        rows = cur.fetchall()
+    elif dialect == 'duckdb':
+        cur.execute('''SELECT table_name, estimated_size, column_count
+FROM	duckdb_tables()
+WHERE	table_name IN (?, ?, ?, ?)''', names)
+        rows = cur.fetchall()
+    else:
+        rows = []
+        for name in names:
+            cur.execute('SELECT max(rowid) FROM {0}'.format(name))
+            rows.append((name, cur.fetchone()[0]))
+    return _digest(sorted(tuple(str(v) for v in r) for r in rows))
+
+
+def scan_signature(conn, padTable='padus1_4'):
+    '''
+    (connection, str) -> str
+
+    Returns a signature of the source tables from their contents: the row
+    count of each and the summed cell count of lu_boundary_gap_landfire.
+    Scans the tables, so it is only taken when building the summary or
+    when asked to verify it.
+    '''
+    cur = conn.cursor()
+    parts = []
+    for name in _source_tables(padTable):
+        cur.execute('SELECT count(*) FROM {0}'.format(name))
+        parts.append('{0}={1}'.format(name, cur.fetchone()[0]))
+    cur.execute('SELECT sum(lu_boundary_gap_landfire.count) FROM lu_boundary_gap_landfire')
+    parts.append('cells={0}'.format(cur.fetchone()[0]))
+    return _digest(parts)
+
+
+def source_signature(conn, padTable='padus1_4', dialect='mssql', verify=True):
+    '''
+    (connection, str, str, bool) -> str
+
+    Returns the signature stored with a summary table: the catalog
+    signature, then with verify the scan signature, separated by '|'.
+    '''
+    sig = catalog_signature(conn, padTable, dialect)
+    return sig + '|' + scan_signature(conn, padTable) if verify else sig
+
+
+def _build_params(table, padTable, ecoColumn, signature):
+    # One META_TABLE row, in META_COLUMNS order
+    return (table, padTable, ecoColumn or '', SUMMARY_VERSION, signature)
+
+
+def summary_table_is_current(conn, dialect='mssql', padTable='padus1_4', ecoColumn=ECO_COLUMN,
+                             table=SUMMARY_TABLE, verify=False):
+    '''
+    (connection, str, str, str, str, bool) -> bool
+
+    Checks whether the summary table exists and was built with these
+    parameters from the current source tables. The sources are compared by
+    their catalog signature; verify also compares the scan signature,
+    which reads the whole of lu_boundary_gap_landfire.
+    '''
+    if not (summary_table_exists(conn, table, dialect) and
+            summary_table_exists(conn, META_TABLE, dialect)):
+        return False
+    cur = conn.cursor()
+    cur.execute('SELECT {0} FROM {1} WHERE summary_table = ?'.format(
+        ', '.join(c for c, _ in META_COLUMNS), META_TABLE), (table,))
+    row = cur.fetchone()
+    if row is None:
+        return False
+    stored = row[-1] if verify else (row[-1] or '').split('|')[0]
+    signature = source_signature(conn, padTable, dialect, verify)
+    return tuple(row[:-1]) + (stored,) == _build_params(table, padTable, ecoColumn, signature)
+
+
+def ensure_summary_table(conn, dialect='mssql', padTable='padus1_4', ecoColumn=ECO_COLUMN,
+                         table=SUMMARY_TABLE, rebuild=False, verify=False):
+    '''
+    (connection, str, str, str, str, bool, bool) -> bool
+
+    Builds the summary table unless it is current (see
+    summary_table_is_current). Returns True when it was (re)built.
+
+    Arguments:
+    conn -- DB-API connection to the analytic database
+    dialect -- 'mssql', 'sqlite' or 'duckdb'
+    padTable -- PAD table joined through lu_boundary
+    ecoColumn -- Column of lu_boundary holding the ecoregion
+    table -- Name of the summary table
+    rebuild -- Rebuild even if current
+    verify -- Also check the sources by scanning them, not only by the
+        catalog
+    '''
+    if not rebuild and summary_table_is_current(conn, dialect, padTable, ecoColumn, table,
+                                                verify):
+        return False
+    build_summary_table(conn, dialect, padTable, ecoColumn, table)
+    return True
+
+
+## --------------Queries Against the Summary Table--------------------
+
+def group_pivot_sql(table=SUMMARY_TABLE):
+    '''
+    (str) -> str
+
+    Returns the NVC group x PAD status query used by NVCSummarization.py.
+    Columns: NVCClass, NVCGroup, nGroupTotalCells, PAD1, PAD2, PAD3.
+    Status 4 is left to be derived from the total.
+    '''
+    return '''SELECT
+	nvc_class AS NVCClass,
+	nvc_group AS NVCGroup,
+	sum(n_cells) AS nGroupTotalCells,
+	sum(CASE WHEN pad_status = '1' THEN n_cells ELSE 0 END) AS PAD1,
+	sum(CASE WHEN pad_status = '2' THEN n_cells ELSE 0 END) AS PAD2,
+	sum(CASE WHEN pad_status = '3' THEN n_cells ELSE 0 END) AS PAD3
+FROM	{0}
+GROUP BY
+	nvc_class,
+	nvc_group
+ORDER BY nvc_group'''.format(table)
+
+
+def management_sql(table=SUMMARY_TABLE):
+    '''
+    (str) -> str
+
+    Returns the PAD status x manager x class query used by
+    ManagementSummary.py. Cells outside PAD-US are left out, matching the
+    former INNER JOIN on the PAD table.
+    '''
+    return '''SELECT
+	pad_status AS PADStatus,
+	manage_name AS ManageName,
+	manage_type AS ManageType,
+	nvc_class AS NVCClass,
+	sum(n_cells) AS nCells
+FROM	{0}
+WHERE	pad_status IS NOT NULL
+GROUP BY
+	manage_name,
+	manage_type,
+	pad_status,
+	nvc_class'''.format(table)
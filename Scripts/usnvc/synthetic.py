@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        synthetic.py
+
+        Synthetic attribute tables for benchmarks and trials.
+
+        make_attribute_table returns a frame with the VAT_COLUMNS of
+        attribute_table.csv and cardinalities close to the national combine:
+        about 300 NVC groups in 100 macrogroups and the 15 classes, about
+        1,000 L4 ecoregions nested in L3 and L2, tens of thousands of PADUS
+        units with their managers and GAP status 1 - 4, and cells outside
+        PAD-US with no status. String columns are built as categoricals, so
+        10^8 rows fit in a few GB.
+
+        Group and ecoregion names are placeholders, except for a handful of
+        the real names the notebook recodes (Great Lakes Dune, Ruderal and
+        Plantation groups, 'UPPER GILA MOUNTAINS (?)'), so the recode rules
+        fire on synthetic data too.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+import pandas as pd
+
+from .lookups import MANAGE_CATEGORIES, NVC_CLASSES
+from .vatcache import VAT_COLUMNS
+
+
+# Real group names mixed into the synthetic ones
+NAMED_GROUPS = ['Great Lakes Sand Beach',
+'Great Lakes Shrub & Grass Dune',
+'Great Lakes Dune',
+'Cool Semi-Desert Shrub & Herb Wash-Arroyo',
+'Great Basin-Intermountain Shrub & Herb Wash-Arroyo',
+'Eastern North American Temperate Forest Plantation',
+'Southeastern North American Ruderal Forest',
+'Western North American Ruderal Grassland & Shrubland']
+
+MANAGER_TYPES = ['FED', 'STAT', 'LOC', 'PVT', 'NGO', 'TRIB', 'JNT', 'UNK']
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+def _categorical(codes, labels):
+    return pd.Categorical.from_codes(np.asarray(codes, dtype=np.int32), list(labels))
+
+
+def make_attribute_table(nRows, nGroups=300, nMacrogroups=100, nL4=1000, nL3=85, nL2=20,
+                         nUnits=30000, padShare=0.4, dupShare=0.01, seed=0):
+    '''
+    (int, int, int, int, int, int, int, float, float, int) -> DataFrame
+
+    Returns a synthetic attribute table of nRows rows with the VAT_COLUMNS.
+
+    Arguments:
+    nRows -- Number of rows
+    nGroups, nMacrogroups -- NVC groups and macrogroups; macrogroups are
+        spread over the NVC_CLASSES
+    nL4, nL3, nL2 -- Ecoregions at each level, nested
+    nUnits -- PADUS units, each with a manager, type and GAP status
+    padShare -- Share of rows inside a PADUS unit; the rest have no status
+    dupShare -- Share of rows repeated, for the dedupe step
+    seed -- Random seed
+    '''
+    rng = np.random.default_rng(seed)
+    nUnique = max(1, int(round(nRows * (1 - dupShare))))
+
+    # NVC hierarchy: group -> macrogroup -> class. Skewed so a few groups
+    # cover most of the cells, as in the real data.
+    macroClass = rng.integers(0, len(NVC_CLASSES), nMacrogroups)
+    groupMacro = rng.integers(0, nMacrogroups, nGroups)
+    groupNames = list(NAMED_GROUPS[:nGroups]) + \
+        ['NVC Group {0:03d}'.format(i) for i in range(len(NAMED_GROUPS), nGroups)]
+    groupW = rng.pareto(1.2, nGroups) + 0.05
+    group = rng.choice(nGroups, nUnique, p=groupW / groupW.sum())
+
+    # Ecoregions: L4 -> L3 -> L2
+    l3L2 = rng.integers(0, nL2, nL3)
+    l4L3 = rng.integers(0, nL3, nL4)
+    l2Names = ['ECOREGION L2 {0:02d}'.format(i) for i in range(nL2)]
+    if nL2:
+        l2Names[-1] = 'UPPER GILA MOUNTAINS (?)'
+    l4 = rng.integers(0, nL4, nUnique)
+
+    # PADUS units with a manager, type and GAP status
+    managers = list(MANAGE_CATEGORIES)
+    unitMang = rng.integers(0, len(managers), nUnits)
+    unitType = rng.integers(0, len(MANAGER_TYPES), nUnits)
+    unitGap = rng.choice(4, nUnits, p=[0.08, 0.12, 0.45, 0.35])
+    inPad = rng.random(nUnique) < padShare
+    unit = np.where(inPad, rng.integers(0, nUnits, nUnique), -1)
+
+    count = np.maximum(1, rng.lognormal(3.0, 1.6, nUnique)).astype(np.int64)
+
+    macro = groupMacro[group]
+    cls = macroClass[macro]
+    l3 = l4L3[l4]
+    l2 = l3L2[l3]
+    padMask = unit >= 0
+    u = np.where(padMask, unit, 0)
+
+    df = pd.DataFrame({
+        'GAPST_CD': np.where(padMask, unitGap[u] + 1, np.nan),
+        'COUNT': count,
+        'MANG_NAME': _categorical(np.where(padMask, unitMang[u], -1), managers),
+        'MANG_TYPE': _categorical(np.where(padMask, unitType[u], -1), MANAGER_TYPES),
+        'CLASS': _categorical(cls, NVC_CLASSES),
+        'NVCGRP_LOOKUP2': group + 1,
+        'GROUP_CODE': _categorical(group, ['G{0:03d}'.format(i) for i in range(nGroups)]),
+        'GROUP': _categorical(group, groupNames),
+        'PADUS2_1DISS6ATT': np.where(padMask, unit + 1, 0),
+        'ECOREGIONS_L4': l4 + 1,
+        'NVC_NAME': _categorical(group, groupNames),
+        'NVC_CLASS': _categorical(cls, NVC_CLASSES),
+        'MACROGROUP': _categorical(macro, ['NVC Macrogroup {0:03d}'.format(i)
+                                           for i in range(nMacrogroups)]),
+        'MACROGRO_1': _categorical(macro, ['M{0:03d}'.format(i) for i in range(nMacrogroups)]),
+        'US_L4CODE': _categorical(l4, ['{0}{1}'.format(i // 26, chr(97 + i % 26))
+                                       for i in range(nL4)]),
+        'US_L4NAME': _categorical(l4, ['Ecoregion L4 {0:04d}'.format(i) for i in range(nL4)]),
+        'US_L3CODE': l3 + 1,
+        'US_L3NAME': _categorical(l3, ['Ecoregion L3 {0:03d}'.format(i) for i in range(nL3)]),
+        'NA_L2CODE': _categorical(l2, ['{0}.{1}'.format(i // 4 + 5, i % 4 + 1)
+                                       for i in range(nL2)]),
+        'NA_L2NAME': _categorical(l2, l2Names)})
+
+    if nRows > nUnique:
+        dups = rng.integers(0, nUnique, nRows - nUnique)
+        df = pd.concat([df, df.iloc[dups]], ignore_index=True)
+        df = df.iloc[rng.permutation(nRows)].reset_index(drop=True)
+    return df[VAT_COLUMNS]
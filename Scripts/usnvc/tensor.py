@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        tensor.py
+
+        Cell counts as an (ecoregion x group x status x natural type)
+        array for one-shot ecoregion breakdowns.
+
+        The ecoregion section of the v3 notebook reaches dfC (% PAD 1 & 2,
+        % PAD 3, % PAD 4 Converted / Not Converted per L2 ecoregion) through
+        dfS5 .. dfS9a, dfPAD12, dfPAD3 and dfPAD4Type, about ten chained
+        groupby / filter / pivot / concat steps, and the group and
+        macrogroup by ecoregion bin tables repeat the pattern.
+
+        CountTensor fills one array from the cube codes with a single
+        bincount. Every axis has one extra slot at the end for missing
+        labels (cells outside PAD-US have no GAP status). Each breakdown is
+        then an axis sum and a divide:
+
+            dfC                 sum over groups -> (eco, status, type)
+            % protected         sum of the status slots over the eco x
+                                group totals -> (eco, group)
+            bin counts          np.digitize of that matrix, one bincount
+
+        The array is dense by default. With sparse=True it is kept as a
+        scipy.sparse CSR matrix (ecoregion rows x the other axes
+        flattened), which stays small at L4 ecoregions x groups where most
+        combinations are empty; sums then run as sparse matrix products.
+        scipy is only needed for the sparse form.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+import pandas as pd
+
+from .binning import EDGES_30, assign_bins, bin_labels
+from .cellarea import AREA_COL
+from .cube import CountCube
+
+
+TENSOR_DIMS = ['NA_L2NAME', 'GROUP', 'GAPST_CD', 'NaturalType']
+
+BREAKDOWN_COLUMNS = ['% PAD 1 & 2', '% PAD 3', '% PAD 4 Converted', '% PAD 4 Not Converted']
+
+
+#############################################################################################
+###################################### COUNT TENSOR #########################################
+#############################################################################################
+
+class CountTensor(object):
+    '''
+    Summed cell counts over every combination of a few cube dimensions.
+
+    Attributes:
+    dims -- Dimension names, one per axis; the first one gives the rows of
+        the sparse form
+    labels -- Dictionary of dimension name -> Index of labels. Axis d has
+        len(labels[d]) + 1 slots, the last one for missing labels.
+    shape -- Axis lengths
+    values -- Dictionary of measure name (COUNT, AREA_KM2) -> dense array
+        or CSR matrix
+    sparse -- Whether the values are CSR matrices
+    '''
+
+    def __init__(self, dims, labels, values, sparse=False):
+        self.dims = list(dims)
+        self.labels = labels
+        self.shape = tuple(len(labels[d]) + 1 for d in self.dims)
+        self.values = values
+        self.sparse = sparse
+
+    @classmethod
+    def from_cube(cls, cube, dims=TENSOR_DIMS, sparse=False, where=None, exclude=None):
+        '''
+        (CountCube, list, bool, dict, dict) -> CountTensor
+
+        Fills the tensor from the cube rows with one bincount per measure.
+
+        Arguments:
+        cube -- CountCube with the dims
+        dims -- Dimensions of the axes, e.g. [eco, 'GROUP', 'GAPST_CD',
+            'NaturalType']
+        sparse -- Keep the counts as a CSR matrix (needs scipy)
+        where -- Optional filters, see CountCube.slice
+        exclude -- Optional exclusions, see CountCube.slice
+        '''
+        dims = list(dims)
+        missing = [d for d in dims if d not in cube.dims]
+        if missing:
+            raise KeyError('Not cube dimensions: {0}'.format(missing))
+        if where or exclude:
+            cube = cube.slice(where, exclude)
+        labels = {d: cube.labels[d] for d in dims}
+        shape = tuple(len(labels[d]) + 1 for d in dims)
+        # Missing codes (-1) land in the last slot of their axis
+        codes = [np.where(cube.codes[d] < 0, len(labels[d]), cube.codes[d]).astype(np.int64)
+                 for d in dims]
+        measures = {cube.value: np.asarray(cube.counts, dtype=np.float64)}
+        if cube.areas is not None:
+            measures[AREA_COL] = np.asarray(cube.areas, dtype=np.float64)
+
+        values = {}
+        if sparse:
+            from scipy import sparse as sp
+            nCols = int(np.prod(shape[1:]))
+            cols = np.ravel_multi_index(codes[1:], shape[1:]) if len(dims) > 1 else \
+                np.zeros(len(codes[0]), dtype=np.int64)
+            for name, w in measures.items():
+                # Duplicate (row, col) pairs are summed on conversion
+                values[name] = sp.csr_array((w, (codes[0], cols)), shape=(shape[0], nCols))
+        else:
+            flat = np.ravel_multi_index(codes, shape)
+            size = int(np.prod(shape))
+            for name, w in measures.items():
+                values[name] = np.bincount(flat, weights=w, minlength=size).reshape(shape)
+        return cls(dims, labels, values, sparse)
+
+    @classmethod
+    def from_table(cls, df, dims=TENSOR_DIMS, sparse=False, value='COUNT'):
+        '''
+        (DataFrame, list, bool, str) -> CountTensor
+
+        Builds the tensor straight from an attribute table.
+        '''
+        return cls.from_cube(CountCube.from_table(df, dims, value), dims, sparse)
+
+    def __repr__(self):
+        return 'CountTensor({0}{1})'.format(
+            ', '.join('{0}={1}'.format(d, n) for d, n in zip(self.dims, self.shape)),
+            '; sparse' if self.sparse else '')
+
+    @property
+    def value(self):
+        '''
+        Measure the breakdowns use: AREA_KM2 when present, else the counts.
+        '''
+        return AREA_COL if AREA_COL in self.values else next(iter(self.values))
+
+    ## --------------Axis Sums--------------------
+
+    def sum(self, keep, value=None):
+        '''
+        (list, str) -> ndarray
+
+        Sums over every axis not in keep. Returns a dense array with the
+        kept axes in tensor order, missing slots included.
+
+        Arguments:
+        keep -- Dimensions to keep
+        value -- Measure to sum, defaults to the value property
+        '''
+        keep = [keep] if isinstance(keep, str) else list(keep)
+        axes = [i for i, d in enumerate(self.dims) if d in keep]
+        data = self.values[value or self.value]
+        if not self.sparse:
+            drop = tuple(i for i in range(len(self.dims)) if i not in axes)
+            return data.sum(axis=drop)
+
+        from scipy import sparse as sp
+        inner = self.shape[1:]
+        keptInner = [i - 1 for i in axes if i > 0]
+        nCols = int(np.prod(inner))
+        if len(keptInner) == len(inner):
+            out = data
+        else:
+            # Indicator matrix from flattened inner columns to kept columns
+            idx = np.unravel_index(np.arange(nCols), inner)
+            target = np.ravel_multi_index([idx[i] for i in keptInner],
+                                          [inner[i] for i in keptInner]) \
+                if keptInner else np.zeros(nCols, dtype=np.int64)
+            nOut = int(np.prod([inner[i] for i in keptInner]))
+            collapse = sp.csr_array((np.ones(nCols), (np.arange(nCols), target)),
+                                    shape=(nCols, nOut))
+            out = data @ collapse
+        if 0 not in axes:
+            out = np.asarray(out.sum(axis=0)).ravel()
+            return out.reshape([inner[i] for i in keptInner])
+        return out.toarray().reshape([self.shape[0]] + [inner[i] for i in keptInner])
+
+    def sum_as(self, dims, value=None):
+        '''
+        (list, str) -> ndarray
+
+        Same as sum, with the kept axes in the order given.
+        '''
+        order = [self.dims.index(d) for d in dims]
+        return np.transpose(self.sum(dims, value), np.argsort(np.argsort(order)))
+
+    def _present(self, dim, totals):
+        '''
+        Index of the labelled slots of an axis with any cells, and those
+        labels.
+        '''
+        n = len(self.labels[dim])
+        pos = np.flatnonzero(totals[:n] != 0)
+        return pos, self.labels[dim].take(pos)
+
+    def _status_slots(self, statuses, status='GAPST_CD'):
+        lab = self.labels[status]
+        num = pd.to_numeric(pd.Series(lab), errors='coerce').to_numpy()
+        return np.flatnonzero(np.isin(num, [float(s) for s in statuses]))
+
+    ## --------------Breakdowns--------------------
+
+    def breakdown(self, eco=None, status='GAPST_CD', natural='NaturalType'):
+        '''
+        (str, str, str) -> DataFrame
+
+        Returns dfC: one row per ecoregion with the percent of its cells
+        (or area) in % PAD 1 & 2, % PAD 3, % PAD 4 Converted and % PAD 4
+        Not Converted. Cells without a GAP status count as PAD 4, as in
+        ecoregion_protection_breakdown.
+        '''
+        eco = eco or self.dims[0]
+        s = self.sum_as([eco, status, natural])
+        total = s.sum(axis=(1, 2))
+        pos, ecoLabels = self._present(eco, total)
+        s, total = s[pos], total[pos]
+
+        pad12 = s[:, self._status_slots((1, 2), status)].sum(axis=(1, 2))
+        pad3 = s[:, self._status_slots((3,), status)].sum(axis=(1, 2))
+        # Status 4 and the missing-status slot
+        pad4 = s[:, np.append(self._status_slots((4,), status), s.shape[1] - 1)].sum(axis=1)
+        typeLab = list(self.labels[natural])
+        cols = [pad12, pad3]
+        for t in ('Converted', 'Not Converted'):
+            cols.append(pad4[:, typeLab.index(t)] if t in typeLab else np.zeros(len(pos)))
+        dfC = pd.DataFrame(np.column_stack(cols) / total[:, None] * 100,
+                           index=pd.Index(ecoLabels, name=eco), columns=BREAKDOWN_COLUMNS)
+        return dfC
+
+    def percent_protected(self, eco, level, statuses=(1, 2), status='GAPST_CD'):
+        '''
+        (str, str, tuple, str) -> ndarray, ndarray
+
+        Returns the (eco x level) matrix of percent protected, NaN where a
+        combination has no cells, and the eco x level total matrix. Missing
+        slots are left out, including cells without a GAP status, as in the
+        PAD pivots (the roll-ups drop missing keys).
+        '''
+        s = self.sum_as([eco, level, status])
+        s = s[:len(self.labels[eco]), :len(self.labels[level]), :len(self.labels[status])]
+        total = s.sum(axis=2)
+        prot = s[:, :, self._status_slots(statuses, status)].sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, prot / total * 100, np.nan), total
+
+    def bin_counts(self, eco, level, statuses=(1, 2), edges=EDGES_30, closed='right',
+                   labels=None, status='GAPST_CD'):
+        '''
+        (str, str, tuple, list, str, list, str) -> DataFrame
+
+        Counts the level's members (groups, macrogroups) of every ecoregion
+        in each percent-protected bin, the GroupPercentProtectedbyEcoregion
+        table: one row per ecoregion with cells, one column per bin.
+        '''
+        edges = list(edges)
+        if labels is None:
+            labels = bin_labels(edges)
+        pct, total = self.percent_protected(eco, level, statuses, status)
+        bins = assign_bins(pct.ravel(), edges, closed).reshape(pct.shape)
+        nBins = len(labels)
+        rows = np.repeat(np.arange(pct.shape[0]), pct.shape[1]).reshape(pct.shape)
+        keep = bins >= 0
+        counts = np.bincount(rows[keep] * nBins + bins[keep],
+                             minlength=pct.shape[0] * nBins).reshape(pct.shape[0], nBins)
+        pos, ecoLabels = self._present(eco, total.sum(axis=1))
+        return pd.DataFrame(counts[pos], index=pd.Index(ecoLabels, name=eco), columns=labels)
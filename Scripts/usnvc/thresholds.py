@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        thresholds.py
+
+        Threshold sweeps over the NVC group protection pivot.
+
+        Answers "how many NVC groups are below X % protected" for many X at
+        once, for any status definition (1 & 2, 1-3 ...), overall or per
+        class / ecoregion. The per-group percentages are computed and sorted
+        once; every threshold is then a binary search (np.searchsorted) into
+        the sorted values, so a grid of thousands of thresholds costs about
+        as much as one pass over the groups.
+
+        The input is the group pivot built in the notebook and in
+        NVCSummarization.py: one row per group with PAD1 .. PAD4 cell counts
+        and nGroupTotalCells.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+import pandas as pd
+
+
+# GAP status definitions used for "% Protected" columns
+STATUS_SETS = {'1 & 2': (1, 2),
+               '1, 2 & 3': (1, 2, 3)}
+
+TOTAL_COL = 'nGroupTotalCells'
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Percent Protected--------------------
+
+def percent_protected(dfPivot, statuses=(1, 2), total=TOTAL_COL):
+    '''
+    (DataFrame, tuple, str) -> ndarray
+
+    Returns the percent of each group's cells in the given GAP statuses,
+    i.e. the '% Protected 1 & 2' column for statuses (1, 2).
+
+    Arguments:
+    dfPivot -- Group pivot with PAD1 .. PAD4 and total cell columns
+    statuses -- GAP status codes counted as protected, or a key of STATUS_SETS
+    total -- Column holding each group's total cell count
+    '''
+    if isinstance(statuses, str):
+        statuses = STATUS_SETS[statuses]
+    cells = np.zeros(len(dfPivot), dtype=np.float64)
+    for st in statuses:
+        cells += dfPivot['PAD{0}'.format(st)].to_numpy(dtype=np.float64)
+    tot = dfPivot[total].to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cells / tot * 100
+
+
+#############################################################################################
+################################### THRESHOLD SWEEP #########################################
+#############################################################################################
+
+class ThresholdSweep(object):
+    '''
+    Sorted per-group percentages ready for threshold queries.
+
+    Groups are sorted by (key, percent) once. Each key (class, ecoregion or
+    the whole table) owns a contiguous segment of the sorted values, so
+    counting the groups below a threshold is a searchsorted inside the
+    segment.
+
+    Attributes:
+    keys -- Frame of key labels, one row per segment
+    values -- Sorted percentages
+    offsets -- Segment boundaries into values, len(keys) + 1 long
+    '''
+
+    def __init__(self, dfPivot, by=None, statuses=(1, 2), total=TOTAL_COL):
+        '''
+        Arguments:
+        dfPivot -- Group pivot with PAD1 .. PAD4 and total cell columns
+        by -- Column or list of columns to sweep within, None for all groups
+        statuses -- GAP status codes counted as protected, or a key of
+            STATUS_SETS
+        total -- Column holding each group's total cell count
+        '''
+        pct = percent_protected(dfPivot, statuses, total)
+        # Groups with no mapped cells have no percentage and are left out
+        keep = ~np.isnan(pct)
+        pct = pct[keep]
+        dfKeep = dfPivot[keep]
+
+        if by is None:
+            self.by = []
+            codes = np.zeros(len(pct), dtype=np.int64)
+            self.keys = pd.DataFrame(index=[0])
+        else:
+            self.by = [by] if isinstance(by, str) else list(by)
+            dfKeys = dfKeep[self.by].reset_index(drop=True)
+            # One code per distinct key combination, in sorted key order
+            codes = dfKeys.groupby(self.by, sort=True, dropna=False).ngroup().to_numpy()
+            _, first = np.unique(codes, return_index=True)
+            self.keys = dfKeys.iloc[first].reset_index(drop=True)
+
+        order = np.lexsort((pct, codes))
+        self.values = pct[order]
+        self.offsets = np.searchsorted(codes[order], np.arange(len(self.keys) + 1))
+
+    def __len__(self):
+        return len(self.values)
+
+    ## --------------Counting--------------------
+
+    def count_below(self, thresholds, inclusive=False):
+        '''
+        (array, bool) -> ndarray
+
+        Returns a (keys, thresholds) matrix with the number of groups below
+        each threshold within each key.
+
+        Arguments:
+        thresholds -- Percent thresholds, any order
+        inclusive -- Count groups equal to the threshold too (<= instead of <)
+        '''
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        side = 'right' if inclusive else 'left'
+        out = np.empty((len(self.keys), len(thresholds)), dtype=np.int64)
+        for i in range(len(self.keys)):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            out[i] = np.searchsorted(self.values[lo:hi], thresholds, side=side)
+        return out
+
+    def count_between(self, lower, upper, closed='right'):
+        '''
+        (float, float, str) -> ndarray
+
+        Returns the number of groups per key with lower < pct <= upper
+        (closed='right'), lower <= pct < upper ('left') or
+        lower < pct < upper ('open').
+        '''
+        if closed == 'right':
+            hi = self.count_below(upper, inclusive=True)
+            lo = self.count_below(lower, inclusive=True)
+        elif closed == 'left':
+            hi = self.count_below(upper)
+            lo = self.count_below(lower)
+        elif closed == 'open':
+            hi = self.count_below(upper)
+            lo = self.count_below(lower, inclusive=True)
+        else:
+            raise ValueError("closed must be 'right', 'left' or 'open'")
+        return (hi - lo)[:, 0]
+
+    def totals(self):
+        '''
+        () -> ndarray
+
+        Returns the number of groups per key.
+        '''
+        return np.diff(self.offsets)
+
+    ## --------------Curves--------------------
+
+    def curve(self, thresholds, inclusive=False):
+        '''
+        (array, bool) -> DataFrame
+
+        Returns the groups-below-threshold curve in long form: one row per
+        key and threshold with the count and the fraction of the key's
+        groups.
+        '''
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        counts = self.count_below(thresholds, inclusive)
+        nT = len(thresholds)
+        dfCurve = self.keys.loc[self.keys.index.repeat(nT)].reset_index(drop=True)
+        dfCurve['Threshold'] = np.tile(thresholds, len(self.keys))
+        dfCurve['nGroupsBelow'] = counts.ravel()
+        dfCurve['nGroups'] = np.repeat(self.totals(), nT)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dfCurve['FractionBelow'] = dfCurve['nGroupsBelow'] / dfCurve['nGroups']
+        return dfCurve
+
+    def table(self, thresholds, inclusive=False):
+        '''
+        (array, bool) -> DataFrame
+
+        Returns the counts in wide form: one row per key and one column per
+        threshold.
+        '''
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        counts = self.count_below(thresholds, inclusive)
+        dfTab = pd.DataFrame(counts, columns=thresholds)
+        if self.by:
+            dfTab.index = pd.MultiIndex.from_frame(self.keys) if len(self.by) > 1 \
+                else pd.Index(self.keys[self.by[0]])
+        return dfTab
+
+
+def sweep(dfPivot, thresholds, by=None, statuses=(1, 2), inclusive=False, total=TOTAL_COL):
+    '''
+    (DataFrame, array, list, tuple, bool, str) -> DataFrame
+
+    Shortcut for ThresholdSweep(...).curve(thresholds).
+    '''
+    return ThresholdSweep(dfPivot, by, statuses, total).curve(thresholds, inclusive)
+
+
+def sweep_status_sets(dfPivot, thresholds, by=None, statusSets=STATUS_SETS,
+                      inclusive=False, total=TOTAL_COL):
+    '''
+    (DataFrame, array, list, dict, bool, str) -> DataFrame
+
+    Runs the sweep for several status definitions and stacks the curves
+    with a 'Status' column holding the definition name.
+    '''
+    frames = []
+    for name, statuses in statusSets.items():
+        dfCurve = sweep(dfPivot, thresholds, by, statuses, inclusive, total)
+        dfCurve.insert(0, 'Status', name)
+        frames.append(dfCurve)
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        uncertainty.py
+
+        Monte Carlo confidence intervals for percent protected and the
+        percent-protected bin counts.
+
+        The group percentages treat every mapped cell as correctly
+        classified. With the NVC raster's accuracy a share of the cells
+        mapped to a class belong to another one, so a group sitting near the
+        17 or 30 % edge may well fall in the neighbouring bin.
+
+        Each replicate draws the true cell counts behind the mapped ones
+        from a confusion matrix of the classes (rows mapped, columns
+        reference):
+
+            kept     cells of a group that are truly of its class,
+                     Binomial(mapped cells, P[class, class]) per PAD status
+            inflow   cells mapped to other classes that truly belong to the
+                     group's class, Binomial(class cells, P[other, class]),
+                     shared among the class's groups by their mapped cells
+
+        Misclassification stays within a stratum (e.g. the L2 ecoregion of
+        an ecoregion x group pivot) and never changes the PAD status, which
+        comes from PAD-US. When the matrix holds the accuracy assessment's
+        sample counts its rows are redrawn per replicate from
+        Dirichlet(counts + prior), so the CIs also carry the assessment's
+        own sampling error.
+
+        Replicates run in chunks as (replicates x groups x statuses) arrays;
+        there is no loop over replicates or groups.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import numpy as np
+import pandas as pd
+
+from .binning import EDGES_30, _group_codes, assign_bins, bin_labels
+from .lookups import CLASS_NUMBER
+from .protection import PAD_COLUMNS
+from .thresholds import STATUS_SETS
+
+
+# Pseudo-count added to every cell of a count matrix before the Dirichlet draw
+DIRICHLET_PRIOR = 0.5
+
+# Largest number of elements of the class-to-class inflow draws per chunk
+CHUNK_ELEMENTS = 2 * 10 ** 7
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Confusion Matrices--------------------
+
+def _class_key(label):
+    return CLASS_NUMBER.sub('', label).strip() if isinstance(label, str) else label
+
+
+def confusion_from_accuracy(classes, accuracy=0.8):
+    '''
+    (list, float or dict) -> DataFrame
+
+    Returns a row-normalized confusion matrix (rows mapped, columns
+    reference) with the given user's accuracy on the diagonal and the
+    error spread evenly over the other classes. Use it when only the
+    per-class accuracies of the map are known.
+
+    Arguments:
+    classes -- Class names
+    accuracy -- One accuracy for all classes or a dictionary of
+        class -> accuracy; classes left out of the dictionary are exact
+    '''
+    classes = list(classes)
+    k = len(classes)
+    if isinstance(accuracy, dict):
+        acc = np.array([accuracy.get(c, 1.0) for c in classes], dtype=np.float64)
+    else:
+        acc = np.full(k, float(accuracy))
+    if ((acc < 0) | (acc > 1)).any():
+        raise ValueError('Accuracies must be between 0 and 1')
+    off = (1.0 - acc) / max(k - 1, 1)
+    mat = np.repeat(off[:, None], k, axis=1)
+    mat[np.arange(k), np.arange(k)] = acc
+    return pd.DataFrame(mat, index=classes, columns=classes)
+
+
+def _align_confusion(confusion, classes):
+    '''
+    Returns the confusion matrix as a (K, K) float array over the given
+    classes, matching labels with or without the '1 ' .. '7 ' prefix.
+    Classes missing from the matrix get an exact (identity) row and column.
+    '''
+    rows = {_class_key(c): i for i, c in enumerate(confusion.index)}
+    cols = {_class_key(c): i for i, c in enumerate(confusion.columns)}
+    mat = confusion.to_numpy(dtype=np.float64)
+    if (mat < 0).any():
+        raise ValueError('Confusion matrix entries must not be negative')
+
+    k = len(classes)
+    out = np.zeros((k, k), dtype=np.float64)
+    ri = np.array([rows.get(_class_key(c), -1) for c in classes])
+    ci = np.array([cols.get(_class_key(c), -1) for c in classes])
+    both = np.flatnonzero(ri >= 0)
+    sub = np.flatnonzero(ci >= 0)
+    out[np.ix_(both, sub)] = mat[np.ix_(ri[both], ci[sub])]
+    empty = out.sum(axis=1) == 0
+    out[empty, empty] = 1.0
+    return out
+
+
+def draw_class_probabilities(matrix, nReplicates, rng, resample=True, prior=DIRICHLET_PRIOR):
+    '''
+    (ndarray, int, Generator, bool, float) -> ndarray
+
+    Returns an (nReplicates, K, K) stack of row-stochastic matrices.
+    A matrix of sample counts is redrawn per replicate from Dirichlet rows
+    (normalized gamma draws, all replicates at once); a matrix of
+    proportions, or resample=False, gives the row-normalized matrix in
+    every replicate.
+
+    Arguments:
+    matrix -- (K, K) confusion matrix, rows mapped, columns reference
+    nReplicates -- Number of replicates
+    rng -- numpy Generator
+    resample -- Redraw count matrices per replicate
+    prior -- Dirichlet pseudo-count added to the sample counts
+    '''
+    rowSums = matrix.sum(axis=1, keepdims=True)
+    isCounts = resample and (rowSums > 1.0 + 1e-9).any()
+    if not isCounts:
+        probs = matrix / np.where(rowSums > 0, rowSums, 1.0)
+        return np.broadcast_to(probs, (nReplicates,) + matrix.shape)
+    # Rows without assessment samples keep their identity row exactly
+    sampled = (rowSums[:, 0] > 1.0 + 1e-9)
+    alpha = np.where(sampled[:, None], matrix + prior, 0.0)
+    draws = rng.standard_gamma(np.broadcast_to(alpha, (nReplicates,) + matrix.shape))
+    probs = draws / draws.sum(axis=2, keepdims=True).clip(min=1e-300)
+    fixed = ~sampled
+    probs[:, fixed] = (matrix[fixed] / np.where(rowSums[fixed] > 0, rowSums[fixed], 1.0))
+    return probs
+
+
+## --------------Replicate Counts--------------------
+
+def simulate_counts(counts, classCodes, strataCodes, probs, rng):
+    '''
+    (ndarray, ndarray, ndarray, ndarray, Generator) -> ndarray
+
+    Draws the true cell counts behind the mapped counts for a chunk of
+    replicates. Returns an (r, groups, statuses) float array.
+
+    Arguments:
+    counts -- (groups, statuses) mapped cell counts
+    classCodes -- Class code of each group, 0 .. K-1
+    strataCodes -- Stratum code of each group, 0 .. Z-1
+    probs -- (r, K, K) row-stochastic class matrices, one per replicate
+    rng -- numpy Generator
+    '''
+    r, k = probs.shape[0], probs.shape[1]
+    g, s = counts.shape
+    z = int(strataCodes.max()) + 1 if g else 0
+
+    # Mapped cells per stratum, class and status
+    flat = (strataCodes.astype(np.int64) * k + classCodes)
+    classCells = np.zeros((z * k, s), dtype=np.int64)
+    np.add.at(classCells, flat, counts)
+    classCells = classCells.reshape(z, k, s)
+
+    diag = probs[:, classCodes, classCodes]
+    kept = rng.binomial(counts[None, :, :], diag[:, :, None])
+
+    # Off-diagonal draws: cells of class i (rows) that truly are class j
+    offDiag = probs * (1.0 - np.eye(k))[None]
+    flows = rng.binomial(classCells.transpose(0, 2, 1)[None, :, :, :, None],
+                         offDiag[:, None, None, :, :])
+    inflow = flows.sum(axis=3)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = counts / classCells[strataCodes, classCodes, :]
+    share = np.nan_to_num(share)
+    # inflow is (r, Z, S, K); pick each group's stratum and class
+    groupInflow = inflow[:, strataCodes, :, classCodes].transpose(1, 0, 2)
+    return kept + groupInflow * share[None]
+
+
+#############################################################################################
+################################## PROTECTION BOOTSTRAP #####################################
+#############################################################################################
+
+class ProtectionBootstrap(object):
+    '''
+    Monte Carlo replicates of percent protected for the rows of a PAD
+    pivot.
+
+    Attributes:
+    dfPivot -- The pivot, one row per group (or stratum x group)
+    classCol -- Column holding each row's NVC class
+    strata -- Columns within which cells can be misclassified
+    classes -- Classes of the replicate matrices, in code order
+    percents -- (replicates, rows) float32 matrix of percent protected,
+        filled by run
+    exact -- Percent protected of the mapped counts
+    '''
+
+    def __init__(self, dfPivot, confusion, classCol='CLASS', strata=None, statuses=(1, 2),
+                 resample=True):
+        '''
+        Arguments:
+        dfPivot -- PAD pivot with PAD1 .. PAD4, e.g. from pad_pivot
+        confusion -- Confusion matrix frame, rows mapped and columns
+            reference classes, as sample counts or proportions (see
+            confusion_from_accuracy)
+        classCol -- Class column of the pivot
+        strata -- Column or list of columns that keep misclassified cells
+            in place, e.g. 'NA_L2NAME'; None for the whole table
+        statuses -- GAP status codes counted as protected, or a key of
+            STATUS_SETS
+        resample -- Redraw a count matrix's rows per replicate
+        '''
+        if isinstance(statuses, str):
+            statuses = STATUS_SETS[statuses]
+        self.statuses = tuple(statuses)
+        self.dfPivot = dfPivot.reset_index(drop=True)
+        self.classCol = classCol
+        self.strata = [] if strata is None else ([strata] if isinstance(strata, str)
+                                                 else list(strata))
+        self.resample = resample
+
+        self.counts = self.dfPivot[PAD_COLUMNS].to_numpy(dtype=np.int64)
+        self.classCodes, self.classes = pd.factorize(self.dfPivot[classCol], sort=True)
+        if (self.classCodes < 0).any():
+            raise ValueError('Every row needs a class in {0}'.format(classCol))
+        if self.strata:
+            self.strataCodes = self.dfPivot.groupby(self.strata, sort=True, dropna=False) \
+                .ngroup().to_numpy()
+        else:
+            self.strataCodes = np.zeros(len(self.dfPivot), dtype=np.int64)
+        self.matrix = _align_confusion(confusion, list(self.classes))
+        self.protectedCols = np.array([s - 1 for s in self.statuses])
+        self.exact = self._percent(self.counts.astype(np.float64))
+        self.percents = None
+
+    def __len__(self):
+        return 0 if self.percents is None else len(self.percents)
+
+    def _percent(self, counts):
+        total = counts.sum(axis=-1)
+        prot = counts[..., self.protectedCols].sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, prot / total * 100, np.nan)
+
+    ## --------------Replicates--------------------
+
+    def run(self, nReplicates=2000, seed=None, chunk=None):
+        '''
+        (int, int, int) -> ProtectionBootstrap
+
+        Draws the replicates and keeps their percentages. Returns self.
+
+        Arguments:
+        nReplicates -- Number of Monte Carlo replicates
+        seed -- Seed of the numpy Generator
+        chunk -- Replicates per batch; by default sized so the inflow
+            draws stay under CHUNK_ELEMENTS
+        '''
+        rng = np.random.default_rng(seed)
+        k = len(self.classes)
+        z = int(self.strataCodes.max()) + 1 if len(self.strataCodes) else 1
+        if chunk is None:
+            chunk = max(1, CHUNK_ELEMENTS // max(1, z * k * k * len(PAD_COLUMNS)))
+        self.percents = np.empty((nReplicates, len(self.dfPivot)), dtype=np.float32)
+        for start in range(0, nReplicates, chunk):
+            r = min(chunk, nReplicates - start)
+            probs = draw_class_probabilities(self.matrix, r, rng, self.resample)
+            true = simulate_counts(self.counts, self.classCodes, self.strataCodes, probs, rng)
+            self.percents[start:start + r] = self._percent(true)
+        return self
+
+    def _check_run(self):
+        if self.percents is None:
+            raise RuntimeError('Call run() before asking for intervals')
+
+    ## --------------Intervals--------------------
+
+    def group_intervals(self, level=0.95, edges=EDGES_30, closed='right',
+                        value='% Protected 1 & 2'):
+        '''
+        (float, list, str, str) -> DataFrame
+
+        Returns the pivot's key columns with the exact percentage, the
+        replicate mean, standard deviation and the percentile interval, and
+        the share of replicates in which the row lands in its exact bin.
+
+        Arguments:
+        level -- Confidence level of the interval
+        edges -- Interior bin edges, e.g. (1, 17, 30)
+        closed -- 'right', 'left' or 'open', see usnvc.binning
+        value -- Name of the percentage column
+        '''
+        self._check_run()
+        keyCols = [c for c in self.dfPivot.columns if not self._is_measure(c)]
+        lo, hi = np.nanpercentile(self.percents, [50 * (1 - level), 50 * (1 + level)], axis=0)
+        exactBins = assign_bins(self.exact, edges, closed)
+        bins = assign_bins(self.percents.ravel(), edges, closed).reshape(self.percents.shape)
+
+        dfOut = self.dfPivot[keyCols].copy()
+        dfOut[value] = self.exact
+        with np.errstate(invalid='ignore'):
+            dfOut['Mean'] = np.nanmean(self.percents, axis=0)
+            dfOut['Std'] = np.nanstd(self.percents, axis=0)
+        dfOut['CI Low'] = lo
+        dfOut['CI High'] = hi
+        dfOut['P(Same Bin)'] = (bins == exactBins[None]).mean(axis=0)
+        return dfOut
+
+    def bin_intervals(self, by=None, edges=EDGES_30, closed='right', level=0.95, labels=None,
+                      catName='ProtCat', countName='nGroups'):
+        '''
+        (list, list, str, float, list, str, str) -> DataFrame
+
+        Returns the percent-protected bin counts in long form (one row per
+        key and bin, like bin_protection_long) with the exact count, the
+        replicate mean and the percentile interval. All replicates are
+        counted with one bincount over packed (replicate, key, bin) codes.
+
+        Arguments:
+        by -- Column or list of columns to count within (class, ecoregion
+            ...), None for all rows
+        edges -- Interior bin edges, e.g. (1, 17, 30)
+        closed -- 'right', 'left' or 'open', see usnvc.binning
+        level -- Confidence level of the interval
+        labels -- Bin labels, defaults to bin_labels(edges)
+        catName -- Name of the bin column
+        countName -- Name of the exact count column
+        '''
+        self._check_run()
+        edges = list(edges)
+        if labels is None:
+            labels = bin_labels(edges)
+        nBins = len(labels)
+        if by is None:
+            by = []
+            keyCodes = np.zeros(len(self.dfPivot), dtype=np.int64)
+            nKeys, dfKeys = 1, pd.DataFrame(index=[0])
+        else:
+            by = [by] if isinstance(by, str) else list(by)
+            keyCodes, nKeys, dfKeys = _group_codes(self.dfPivot, by)
+
+        nRep = len(self.percents)
+        bins = assign_bins(self.percents.ravel(), edges, closed).reshape(self.percents.shape)
+        flat = (np.arange(nRep, dtype=np.int64)[:, None] * nKeys + keyCodes[None]) * nBins + bins
+        counts = np.bincount(flat[bins >= 0], minlength=nRep * nKeys * nBins)
+        counts = counts.reshape(nRep, nKeys * nBins)
+
+        exactBins = assign_bins(self.exact, edges, closed)
+        keep = exactBins >= 0
+        exact = np.bincount(keyCodes[keep] * nBins + exactBins[keep], minlength=nKeys * nBins)
+        lo, hi = np.percentile(counts, [50 * (1 - level), 50 * (1 + level)], axis=0)
+
+        dfOut = dfKeys.loc[dfKeys.index.repeat(nBins)].reset_index(drop=True)
+        dfOut[catName] = np.tile(labels, nKeys)
+        dfOut[countName] = exact
+        dfOut['Mean'] = counts.mean(axis=0)
+        dfOut['CI Low'] = lo
+        dfOut['CI High'] = hi
+        return dfOut[by + [catName, countName, 'Mean', 'CI Low', 'CI High']]
+
+    @staticmethod
+    def _is_measure(col):
+        return col.startswith('PAD') or col.startswith('%') or col == 'nGroupTotalCells'
+
+
+def bootstrap_protection(dfPivot, confusion, by=None, classCol='CLASS', strata=None,
+                         nReplicates=2000, seed=None, level=0.95, edges=EDGES_30,
+                         closed='right'):
+    '''
+    (DataFrame, DataFrame, list, str, list, int, int, float, list, str) -> DataFrame, DataFrame
+
+    Shortcut that runs a ProtectionBootstrap and returns the group and bin
+    count intervals.
+    '''
+    boot = ProtectionBootstrap(dfPivot, confusion, classCol, strata).run(nReplicates, seed)
+    return (boot.group_intervals(level, edges, closed),
+            boot.bin_intervals(by, edges, closed, level))
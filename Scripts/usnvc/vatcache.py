@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+'''@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+
+
+
+        vatcache.py
+
+        Columnar cache of the combined raster attribute table
+        (attribute_table.csv).
+
+        The first load parses the CSV, uppercases the column names, keeps
+        only the analysis columns and drops duplicate rows, exactly as the
+        notebooks do. The result is written next to the CSV as one .npy
+        file per column. String columns are stored as integer codes plus
+        a JSON table of their labels. Later loads memory-map the arrays
+        and rebuild dfTable with categorical columns, skipping the CSV
+        parse. The cache is rebuilt when the CSV's hash changes.
+
+
+
+@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Columns pulled out of the attribute table for the analyses
+VAT_COLUMNS = ['GAPST_CD',
+'COUNT',
+'MANG_NAME',
+'MANG_TYPE',
+'CLASS',
+'NVCGRP_LOOKUP2',
+'GROUP_CODE',
+'GROUP',
+'PADUS2_1DISS6ATT',
+'ECOREGIONS_L4',
+'NVC_NAME',
+'NVC_CLASS',
+'MACROGROUP',
+'MACROGRO_1',
+'US_L4CODE',
+'US_L4NAME',
+'US_L3CODE',
+'US_L3NAME',
+'NA_L2CODE',
+'NA_L2NAME']
+
+# Bump this when the on-disk layout changes so old caches get rebuilt
+CACHE_VERSION = 1
+
+MANIFEST = 'manifest.json'
+
+
+#############################################################################################
+################################### LOCAL FUNCTIONS #########################################
+#############################################################################################
+
+
+## --------------Source File Fingerprint--------------------
+
+def file_hash(path, blockSize=1 << 20):
+    '''
+    (str, int) -> str
+
+    Returns the SHA-1 hex digest of a file, read in blocks so large
+    tables are never held in memory.
+
+    Arguments:
+    path -- Path of the file to hash
+    blockSize -- Number of bytes read per block
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def default_cache_dir(csvPath):
+    '''
+    (str) -> str
+
+    Returns the cache directory used for a CSV when none is given:
+    a .vatcache/<file name> folder beside the CSV.
+    '''
+    head, tail = os.path.split(os.path.abspath(csvPath))
+    return os.path.join(head, '.vatcache', os.path.splitext(tail)[0])
+
+
+## --------------Reading the Source Table--------------------
+
+def read_attribute_csv(csvPath, columns=VAT_COLUMNS, dropDuplicates=True):
+    '''
+    (str, list, bool) -> DataFrame
+
+    Reads the attribute table CSV the way the notebooks do: uppercase
+    column names, keep only the analysis columns and drop duplicate rows.
+
+    Arguments:
+    csvPath -- Path to attribute_table.csv
+    columns -- Columns to keep from the table
+    dropDuplicates -- Drop repeated rows of the kept columns
+    '''
+    dfAtt = pd.read_csv(csvPath)
+    # Make all the column names in the CSV data table uppercase
+    dfAtt.columns = [x.upper() for x in dfAtt.columns]
+    # Pull out only the relevant columns and make sure there are no duplicates
+    dfSub = dfAtt[list(columns)]
+    if dropDuplicates:
+        dfSub = dfSub.drop_duplicates()
+    return dfSub.reset_index(drop=True)
+
+
+## --------------Writing and Reading the Cache--------------------
+
+def _manifest_path(cacheDir):
+    return os.path.join(cacheDir, MANIFEST)
+
+
+def _read_manifest(cacheDir):
+    try:
+        with open(_manifest_path(cacheDir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_vat_cache(csvPath, cacheDir=None, columns=VAT_COLUMNS, sourceHash=None):
+    '''
+    (str, str, list, str) -> dict
+
+    Parses the attribute table CSV once and writes the columnar cache.
+    Returns the manifest describing the cached columns.
+
+    Numeric columns are saved as-is. Every other column is dictionary
+    encoded: the labels are written to the manifest and the rows are
+    saved as int32 codes (-1 marks a missing value).
+
+    Arguments:
+    csvPath -- Path to attribute_table.csv
+    cacheDir -- Folder for the cache, defaults to default_cache_dir(csvPath)
+    columns -- Columns to keep from the table
+    sourceHash -- Hash of the CSV if already computed
+    '''
+    if cacheDir is None:
+        cacheDir = default_cache_dir(csvPath)
+    os.makedirs(cacheDir, exist_ok=True)
+    if sourceHash is None:
+        sourceHash = file_hash(csvPath)
+
+    dfTable = read_attribute_csv(csvPath, columns)
+
+    colInfo = []
+    for col in dfTable.columns:
+        s = dfTable[col]
+        fname = '{0}.npy'.format(len(colInfo))
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            np.save(os.path.join(cacheDir, fname), s.to_numpy())
+            colInfo.append({'name': col, 'file': fname, 'kind': 'numeric'})
+        else:
+            try:
+                codes, labels = pd.factorize(s.astype(object), sort=True)
+            except TypeError:
+                # Mixed label types cannot be ordered, keep first-seen order
+                codes, labels = pd.factorize(s.astype(object))
+            np.save(os.path.join(cacheDir, fname), codes.astype(np.int32))
+            colInfo.append({'name': col, 'file': fname, 'kind': 'category',
+                            'categories': [str(x) for x in labels]})
+
+    st = os.stat(csvPath)
+    manifest = {'version': CACHE_VERSION,
+                'source': os.path.abspath(csvPath),
+                'sha1': sourceHash,
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'nrows': len(dfTable),
+                'columns': colInfo}
+    # Write the manifest last so a half-written cache is never trusted
+    tmp = _manifest_path(cacheDir) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, _manifest_path(cacheDir))
+    return manifest
+
+
+def cache_is_current(csvPath, cacheDir=None, columns=VAT_COLUMNS):
+    '''
+    (str, str, list) -> bool, str
+
+    Checks whether the cache still matches the CSV. Returns the answer
+    and the CSV hash (None when the quick size/mtime check was enough).
+
+    An unchanged size and modification time is trusted without hashing.
+    Otherwise the file is hashed, so touching or copying the CSV does not
+    force a rebuild but editing it does.
+    '''
+    if cacheDir is None:
+        cacheDir = default_cache_dir(csvPath)
+    manifest = _read_manifest(cacheDir)
+    if (manifest is None or manifest.get('version') != CACHE_VERSION or
+            [c['name'] for c in manifest['columns']] != list(columns)):
+        return False, None
+
+    st = os.stat(csvPath)
+    if st.st_size == manifest['size'] and st.st_mtime_ns == manifest['mtime_ns']:
+        return True, None
+
+    sourceHash = file_hash(csvPath)
+    if sourceHash != manifest['sha1']:
+        return False, sourceHash
+    # Same content under a new timestamp: refresh the quick-check fields
+    manifest['size'] = st.st_size
+    manifest['mtime_ns'] = st.st_mtime_ns
+    with open(_manifest_path(cacheDir), 'w') as f:
+        json.dump(manifest, f)
+    return True, sourceHash
+
+
+def read_vat_cache(cacheDir, columns=None, categorical=True):
+    '''
+    (str, list, bool) -> DataFrame
+
+    Rebuilds dfTable from a cache folder. Arrays are memory-mapped, so
+    only the requested columns are paged in.
+
+    Arguments:
+    cacheDir -- Folder written by build_vat_cache
+    columns -- Subset of columns to load, all when None
+    categorical -- Return string columns as pandas categoricals. When
+        False they are decoded back to plain object strings.
+    '''
+    manifest = _read_manifest(cacheDir)
+    if manifest is None:
+        raise FileNotFoundError('No attribute table cache in ' + cacheDir)
+
+    data = {}
+    for info in manifest['columns']:
+        if columns is not None and info['name'] not in columns:
+            continue
+        arr = np.load(os.path.join(cacheDir, info['file']), mmap_mode='r')
+        if info['kind'] == 'category':
+            s = pd.Categorical.from_codes(np.asarray(arr), categories=info['categories'])
+            data[info['name']] = s if categorical else np.asarray(s, dtype=object)
+        else:
+            data[info['name']] = arr
+    dfTable = pd.DataFrame(data)
+    if columns is not None:
+        dfTable = dfTable[list(columns)]
+    return dfTable
+
+
+def load_attribute_table(csvPath, cacheDir=None, columns=VAT_COLUMNS,
+                         categorical=True, rebuild=False):
+    '''
+    (str, str, list, bool, bool) -> DataFrame
+
+    Returns the de-duplicated attribute table (dfTable), from the cache
+    when it is current and rebuilding it first when it is not.
+
+    Note that with categorical=True, assigning a label that is not already
+    a category (e.g. 'Great Lakes Dune') needs rename_categories or
+    add_categories rather than .loc string writes.
+
+    Arguments:
+    csvPath -- Path to attribute_table.csv
+    cacheDir -- Folder for the cache, defaults to default_cache_dir(csvPath)
+    columns -- Columns to keep from the table
+    categorical -- Return string columns as pandas categoricals
+    rebuild -- Force the cache to be rebuilt from the CSV
+    '''
+    if cacheDir is None:
+        cacheDir = default_cache_dir(csvPath)
+    sourceHash = None
+    if not rebuild:
+        current, sourceHash = cache_is_current(csvPath, cacheDir, columns)
+        rebuild = not current
+    if rebuild:
+        build_vat_cache(csvPath, cacheDir, columns, sourceHash)
+    return read_vat_cache(cacheDir, categorical=categorical)